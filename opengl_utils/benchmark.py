@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+''' A headless benchmark of TextureStream2D. It needs no window or
+display, just an offscreen context from EGL or OSMesa, so it runs on
+a software GL (Mesa llvmpipe) on a machine without a GPU. For example:
+
+LIBGL_ALWAYS_SOFTWARE=1 EGL_PLATFORM=surfaceless python benchmark.py \\
+        --output results.json --baseline baseline.json
+
+Every combination of the texture sizes, formats, buffer counts and
+buffer usages given is run for a number of frames, in a fresh context
+each time, and the frames per second, MB per second, dropped frames
+and CPU time per upload of each are written out as JSON. If a baseline
+(a previous output) is given, any result that is worse than it by more
+than the tolerance is flagged as a regression, and the exit status is
+1 if there are any.
+
+With --platform null, no context is made at all and the GL calls go
+to opengl_utils.NullGL, which does nothing, so only the time spent in
+Python is measured, and the number of GL calls per frame is counted
+with opengl_utils.RecordingGL.
+'''
+
+import json
+import optparse
+import os
+import sys
+import time
+
+# The formats that can be swept, as
+# name: (gl_format, gl_type, gl_internal_format, dtype, elements per texel)
+FORMATS = {
+        'rgba8': ('GL_RGBA', 'GL_UNSIGNED_BYTE', 'GL_RGBA8', 'uint8', 4),
+        'bgra8': ('GL_BGRA', 'GL_UNSIGNED_INT_8_8_8_8_REV', 'GL_RGBA8',
+            'uint32', 1),
+        'rgb8': ('GL_RGB', 'GL_UNSIGNED_BYTE', 'GL_RGB8', 'uint8', 3),
+        'r8': ('GL_RED', 'GL_UNSIGNED_BYTE', 'GL_R8', 'uint8', 1),
+        'r16': ('GL_RED', 'GL_UNSIGNED_SHORT', 'GL_R16', 'uint16', 1),
+        'r32f': ('GL_RED', 'GL_FLOAT', 'GL_R32F', 'float32', 1)}
+
+USAGES = ('GL_STREAM_DRAW', 'GL_DYNAMIC_DRAW', 'GL_STATIC_DRAW')
+
+# opengl_utils.UPLOAD_METHODS, which can't be imported until the
+# platform is set.
+UPLOAD_METHODS = ('orphan', 'invalidate', 'buffer_sub_data',
+        'client_memory', 'persistent')
+
+# The results compared with the baseline, and whether bigger is better
+COMPARED = {'frames_per_second': True,
+        'mb_per_second': True,
+        'cpu_seconds_per_upload': False,
+        'gl_calls_per_frame': False}
+
+def parse_args(args):
+    parser = optparse.OptionParser(usage='%prog [options]',
+            description=__doc__.split('\n\n')[0].strip())
+
+    parser.add_option('--platform', default='egl',
+            choices=('egl', 'osmesa', 'null'),
+            help='How to get a context: egl, osmesa or null for no '\
+                    'context or GL at all [%default].')
+    parser.add_option('--sizes', default='256,1024',
+            help='Comma separated texture sizes (square, or WxH) '\
+                    '[%default].')
+    parser.add_option('--formats', default='rgba8,rgb8,r16,r32f',
+            help='Comma separated formats, from ' + \
+                    ', '.join(sorted(FORMATS)) + ' [%default].')
+    parser.add_option('--buffers', default='1,2,3',
+            help='Comma separated buffer counts [%default].')
+    parser.add_option('--usages', default='GL_STREAM_DRAW,GL_DYNAMIC_DRAW',
+            help='Comma separated buffer usages, from ' + \
+                    ', '.join(USAGES) + ' [%default].')
+    parser.add_option('--persistent', action='store_true', default=False,
+            help='Use persistently mapped pixel buffers.')
+    parser.add_option('--upload-method', default=None,
+            choices=UPLOAD_METHODS,
+            help='How the frames get to GL, from ' + \
+                    ', '.join(UPLOAD_METHODS) + ' [orphan, or '\
+                    'persistent with --persistent].')
+    parser.add_option('--frames', type='int', default=200,
+            help='Frames to upload for each combination [%default].')
+    parser.add_option('--warmup', type='int', default=10,
+            help='Frames to upload before timing [%default].')
+    parser.add_option('--output', default=None,
+            help='Where to write the JSON results [stdout].')
+    parser.add_option('--baseline', default=None,
+            help='Earlier results to check for regressions against.')
+    parser.add_option('--tolerance', type='float', default=0.1,
+            help='The fraction a result can be worse than the baseline '\
+                    'before it is a regression [%default].')
+
+    options, args = parser.parse_args(args)
+
+    if args:
+        parser.error('Unexpected arguments: ' + ' '.join(args))
+
+    options.sizes = [parse_size(each) for each in options.sizes.split(',')]
+    options.formats = options.formats.split(',')
+    options.buffers = [int(each) for each in options.buffers.split(',')]
+    options.usages = options.usages.split(',')
+
+    for name in options.formats:
+        if name not in FORMATS:
+            parser.error('Unknown format: ' + name)
+
+    for usage in options.usages:
+        if usage not in USAGES:
+            parser.error('Unknown buffer usage: ' + usage)
+
+    return options
+
+def parse_size(size):
+    if 'x' in size:
+        width, height = size.split('x')
+        return (int(width), int(height))
+    else:
+        return (int(size), int(size))
+
+def make_context(platform, size=(16, 16)):
+    ''' Make an offscreen context current and return a function that
+    destroys it. PYOPENGL_PLATFORM must already have been set to
+    match platform before OpenGL was imported.
+    '''
+    import ctypes
+
+    if platform == 'egl':
+        from OpenGL import EGL
+
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major),
+                ctypes.pointer(minor)):
+            raise RuntimeError('Could not initialise EGL. Try setting '\
+                    'EGL_PLATFORM=surfaceless.')
+
+        attributes = (EGL.EGLint * 5)(
+                EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        n_configs = EGL.EGLint()
+        EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1,
+                ctypes.pointer(n_configs))
+
+        if n_configs.value < 1:
+            raise RuntimeError('No suitable EGL config.')
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT,
+                None)
+
+        surface_attributes = (EGL.EGLint * 5)(EGL.EGL_WIDTH, size[0],
+                EGL.EGL_HEIGHT, size[1], EGL.EGL_NONE)
+        surface = EGL.eglCreatePbufferSurface(display, config,
+                surface_attributes)
+
+        if not EGL.eglMakeCurrent(display, surface, surface, context):
+            raise RuntimeError('Could not make the EGL context current.')
+
+        def destroy():
+            EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE,
+                    EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+            EGL.eglDestroySurface(display, surface)
+            EGL.eglDestroyContext(display, context)
+
+    else:
+        from OpenGL import GL, arrays, osmesa
+
+        context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0,
+                0, None)
+
+        if not context:
+            raise RuntimeError('Could not create an OSMesa context.')
+
+        frame_buffer = arrays.GLubyteArray.zeros((size[1], size[0], 4))
+
+        if not osmesa.OSMesaMakeCurrent(context, frame_buffer,
+                GL.GL_UNSIGNED_BYTE, size[0], size[1]):
+            raise RuntimeError('Could not make the OSMesa context current.')
+
+        def destroy():
+            osmesa.OSMesaDestroyContext(context)
+
+    return destroy
+
+def cpu_time():
+    ''' The user plus system CPU time of this process so far.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+def run_one(options, size, format_name, buffers, usage):
+    ''' Benchmark one combination of settings in a new context, and
+    return its results as a dictionary.
+    '''
+    import numpy
+    from OpenGL import GL
+    import opengl_utils
+    from opengl_utils import TextureStream2D
+
+    if options.platform == 'null':
+        gl = opengl_utils.RecordingGL(opengl_utils.NullGL())
+        opengl_utils.set_gl_namespace(gl)
+
+        def destroy_context():
+            opengl_utils.set_gl_namespace(None)
+    else:
+        gl = GL
+        destroy_context = make_context(options.platform)
+
+    try:
+        renderer = gl.glGetString(GL.GL_RENDERER)
+
+        gl_format, gl_type, gl_internal_format, dtype, elements = \
+                FORMATS[format_name]
+
+        stream = TextureStream2D(size, getattr(GL, gl_format),
+                getattr(GL, gl_type), getattr(GL, gl_internal_format),
+                GL.GL_TEXTURE0, buffers=buffers,
+                buffer_usage=getattr(GL, usage),
+                persistent_mapping=options.persistent,
+                upload_method=options.upload_method)
+
+        shape = (size[1], size[0], elements)
+
+        # A couple of different frames, so nothing can be skipped
+        frames = [numpy.random.randint(0, 255, shape).astype(dtype)
+                for n in range(2)]
+
+        for n in range(options.warmup):
+            stream.update_texture(frames[n % 2])
+            stream.bind_texture()
+
+        gl.glFinish()
+        stream.reset_upload_counters()
+
+        if options.platform == 'null':
+            gl.reset()
+
+        start_cpu = cpu_time()
+        start = time.time()
+
+        for n in range(options.frames):
+            stream.update_texture(frames[n % 2])
+
+            # Using the texture makes sure the upload is waited on
+            # as it would be when rendering.
+            stream.bind_texture()
+            gl.glFlush()
+
+        gl.glFinish()
+
+        seconds = time.time() - start
+        cpu_seconds = cpu_time() - start_cpu
+
+        counters = stream.get_upload_counters()
+        stats = stream.stats()
+
+        if options.platform == 'null':
+            gl_calls = sum(gl.counts.values())
+
+    finally:
+        destroy_context()
+
+    accepted = counters['frames_accepted']
+
+    result = {'name': '%dx%d/%s/%d/%s' % (size[0], size[1], format_name,
+                buffers, usage),
+            'renderer': renderer,
+            'size': list(size),
+            'format': format_name,
+            'gl_format': gl_format,
+            'gl_type': gl_type,
+            'buffers': buffers,
+            'buffer_usage': usage,
+            'persistent_mapping': stream.get_persistent_mapping(),
+            'upload_method': stream.get_upload_method(),
+            'frames': options.frames,
+            'frames_accepted': accepted,
+            'frames_dropped': counters['frames_dropped'],
+            'seconds': seconds,
+            'frames_per_second': accepted / seconds,
+            'mb_per_second': counters['bytes_uploaded'] / seconds / 1e6,
+            'cpu_seconds_per_upload': cpu_seconds / max(accepted, 1),
+            'upload_p50': stats['upload']['p50'],
+            'upload_p99': stats['upload']['p99']}
+
+    if options.platform == 'null':
+        # Including the glFlush() and glFinish()
+        result['gl_calls_per_frame'] = gl_calls / float(options.frames)
+
+    return result
+
+def find_regressions(results, baseline, tolerance):
+    ''' Add a list of the regressions against the baseline results
+    to each of results, under 'regressions', and return the total
+    number of them. Results with no match in the baseline are left
+    alone.
+    '''
+    baseline_results = dict([(each['name'], each)
+        for each in baseline['results']])
+
+    n_regressions = 0
+    for result in results:
+        if result['name'] not in baseline_results:
+            continue
+
+        base = baseline_results[result['name']]
+        regressions = []
+
+        for key, bigger_is_better in COMPARED.items():
+            if key not in base or not base[key] or key not in result:
+                continue
+
+            change = (result[key] - base[key]) / float(base[key])
+
+            if not bigger_is_better:
+                change = -change
+
+            if change < -tolerance:
+                regressions.append({'metric': key,
+                    'baseline': base[key],
+                    'value': result[key],
+                    'change': change})
+
+        result['regressions'] = regressions
+        n_regressions += len(regressions)
+
+    return n_regressions
+
+def main(args):
+    options = parse_args(args)
+
+    # This has to be set before OpenGL is imported
+    if options.platform != 'null':
+        os.environ['PYOPENGL_PLATFORM'] = options.platform
+
+    results = []
+    for size in options.sizes:
+        for format_name in options.formats:
+            for buffers in options.buffers:
+                for usage in options.usages:
+                    result = run_one(options, size, format_name, buffers,
+                            usage)
+                    results.append(result)
+
+                    sys.stderr.write('%-40s %8.1f frames/s %8.1f MB/s '\
+                            '%4d dropped\n' % (result['name'],
+                                result['frames_per_second'],
+                                result['mb_per_second'],
+                                result['frames_dropped']))
+
+    output = {'platform': options.platform,
+            'time': time.time(),
+            'results': results}
+
+    n_regressions = 0
+    if options.baseline is not None:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        n_regressions = find_regressions(results, baseline,
+                options.tolerance)
+
+        output['tolerance'] = options.tolerance
+        output['regressions'] = n_regressions
+
+        for result in results:
+            for regression in result.get('regressions', []):
+                sys.stderr.write('REGRESSION %s %s: %g -> %g (%+.1f%%)\n' % (
+                    result['name'], regression['metric'],
+                    regression['baseline'], regression['value'],
+                    100 * regression['change']))
+
+    if options.output is None:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if n_regressions:
+        return 1
+    else:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
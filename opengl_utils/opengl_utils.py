@@ -24,8 +24,19 @@ more pythonic set of objects.
 '''
 import numpy
 from OpenGL import GL
+from OpenGL import images as GL_images
 from OpenGL.GL.ARB import sync as GL_sync
+from OpenGL.GL.EXT import texture_compression_s3tc as GL_s3tc
 import ctypes
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import Queue
 
 # Map the GL types to bytes per texel.
 #
@@ -43,6 +54,7 @@ GL_TYPES = {GL.GL_UNSIGNED_BYTE:           (1, True),
         GL.GL_UNSIGNED_INT:                (4, True),
         GL.GL_INT:                         (4, True),
         GL.GL_FLOAT:                       (4, True),
+        GL.GL_HALF_FLOAT:                  (2, True),
         GL.GL_UNSIGNED_BYTE_3_3_2:         (1, False),
         GL.GL_UNSIGNED_BYTE_2_3_3_REV:     (1, False),
         GL.GL_UNSIGNED_SHORT_5_6_5:        (2, False),
@@ -54,8 +66,20 @@ GL_TYPES = {GL.GL_UNSIGNED_BYTE:           (1, True),
         GL.GL_UNSIGNED_INT_8_8_8_8:        (4, False),
         GL.GL_UNSIGNED_INT_8_8_8_8_REV:    (4, False),
         GL.GL_UNSIGNED_INT_10_10_10_2:     (4, False),
-        GL.GL_UNSIGNED_INT_2_10_10_10_REV: (4, False)}
+        GL.GL_UNSIGNED_INT_2_10_10_10_REV: (4, False),
+        GL.GL_UNSIGNED_INT_10F_11F_11F_REV: (4, False),
+        GL.GL_UNSIGNED_INT_5_9_9_9_REV:    (4, False)}
 
+# The numpy dtypes of the GL types that describe a single
+# component of a texel.
+GL_DTYPES = {GL.GL_UNSIGNED_BYTE:   'uint8',
+        GL.GL_BYTE:                 'int8',
+        GL.GL_UNSIGNED_SHORT:       'uint16',
+        GL.GL_SHORT:                'int16',
+        GL.GL_UNSIGNED_INT:         'uint32',
+        GL.GL_INT:                  'int32',
+        GL.GL_FLOAT:                'float32',
+        GL.GL_HALF_FLOAT:           'float16'}
 
 GL_FORMATS = {\
         GL.GL_COLOR_INDEX:      1,
@@ -63,13 +87,165 @@ GL_FORMATS = {\
         GL.GL_GREEN:            1,
         GL.GL_BLUE:             1,
         GL.GL_ALPHA:            1,
+        GL.GL_RG:               2,
         GL.GL_RGB:              3,
         GL.GL_BGR:              3,
         GL.GL_RGBA:             4,
         GL.GL_BGRA:             4,
         GL.GL_LUMINANCE:        1,
         GL.GL_LUMINANCE_ALPHA:  2,
-        GL.GL_DEPTH_COMPONENT:  2}
+        GL.GL_DEPTH_COMPONENT:  2,
+        GL.GL_RED_INTEGER:      1,
+        GL.GL_RG_INTEGER:       2,
+        GL.GL_RGB_INTEGER:      3,
+        GL.GL_BGR_INTEGER:      3,
+        GL.GL_RGBA_INTEGER:     4,
+        GL.GL_BGRA_INTEGER:     4}
+
+# The sized internal formats that go with the float, half float
+# and integer formats and types, by (format, type). The integer
+# formats need integer samplers (isampler2D and usampler2D) and
+# can't be filtered, so are used with GL_NEAREST.
+GL_INTERNAL_FORMATS = {\
+        (GL.GL_RED, GL.GL_FLOAT):                       GL.GL_R32F,
+        (GL.GL_RG, GL.GL_FLOAT):                        GL.GL_RG32F,
+        (GL.GL_RGB, GL.GL_FLOAT):                       GL.GL_RGB32F,
+        (GL.GL_RGBA, GL.GL_FLOAT):                      GL.GL_RGBA32F,
+        (GL.GL_RED, GL.GL_HALF_FLOAT):                  GL.GL_R16F,
+        (GL.GL_RG, GL.GL_HALF_FLOAT):                   GL.GL_RG16F,
+        (GL.GL_RGB, GL.GL_HALF_FLOAT):                  GL.GL_RGB16F,
+        (GL.GL_RGBA, GL.GL_HALF_FLOAT):                 GL.GL_RGBA16F,
+        (GL.GL_RED_INTEGER, GL.GL_UNSIGNED_BYTE):       GL.GL_R8UI,
+        (GL.GL_RED_INTEGER, GL.GL_BYTE):                GL.GL_R8I,
+        (GL.GL_RED_INTEGER, GL.GL_UNSIGNED_SHORT):      GL.GL_R16UI,
+        (GL.GL_RED_INTEGER, GL.GL_SHORT):               GL.GL_R16I,
+        (GL.GL_RED_INTEGER, GL.GL_UNSIGNED_INT):        GL.GL_R32UI,
+        (GL.GL_RED_INTEGER, GL.GL_INT):                 GL.GL_R32I,
+        (GL.GL_RG_INTEGER, GL.GL_UNSIGNED_BYTE):        GL.GL_RG8UI,
+        (GL.GL_RG_INTEGER, GL.GL_BYTE):                 GL.GL_RG8I,
+        (GL.GL_RG_INTEGER, GL.GL_UNSIGNED_SHORT):       GL.GL_RG16UI,
+        (GL.GL_RG_INTEGER, GL.GL_SHORT):                GL.GL_RG16I,
+        (GL.GL_RG_INTEGER, GL.GL_UNSIGNED_INT):         GL.GL_RG32UI,
+        (GL.GL_RG_INTEGER, GL.GL_INT):                  GL.GL_RG32I,
+        (GL.GL_RGB_INTEGER, GL.GL_UNSIGNED_BYTE):       GL.GL_RGB8UI,
+        (GL.GL_RGB_INTEGER, GL.GL_BYTE):                GL.GL_RGB8I,
+        (GL.GL_RGB_INTEGER, GL.GL_UNSIGNED_SHORT):      GL.GL_RGB16UI,
+        (GL.GL_RGB_INTEGER, GL.GL_SHORT):               GL.GL_RGB16I,
+        (GL.GL_RGB_INTEGER, GL.GL_UNSIGNED_INT):        GL.GL_RGB32UI,
+        (GL.GL_RGB_INTEGER, GL.GL_INT):                 GL.GL_RGB32I,
+        (GL.GL_RGBA_INTEGER, GL.GL_UNSIGNED_BYTE):      GL.GL_RGBA8UI,
+        (GL.GL_RGBA_INTEGER, GL.GL_BYTE):               GL.GL_RGBA8I,
+        (GL.GL_RGBA_INTEGER, GL.GL_UNSIGNED_SHORT):     GL.GL_RGBA16UI,
+        (GL.GL_RGBA_INTEGER, GL.GL_SHORT):              GL.GL_RGBA16I,
+        (GL.GL_RGBA_INTEGER, GL.GL_UNSIGNED_INT):       GL.GL_RGBA32UI,
+        (GL.GL_RGBA_INTEGER, GL.GL_INT):                GL.GL_RGBA32I}
+
+# PyOpenGL doesn't know the half float and packed float types, so
+# can't work out the size of images of them (even to allocate an
+# empty texture). They are the size of an unsigned short and an
+# unsigned int respectively, and the packed floats have 3
+# components.
+GL_images.TYPE_TO_ARRAYTYPE.setdefault(GL.GL_HALF_FLOAT,
+        GL.GL_UNSIGNED_SHORT)
+
+for _packed_type in (GL.GL_UNSIGNED_INT_10F_11F_11F_REV,
+        GL.GL_UNSIGNED_INT_5_9_9_9_REV):
+    GL_images.TYPE_TO_ARRAYTYPE.setdefault(_packed_type, GL.GL_UNSIGNED_INT)
+    GL_images.TIGHT_PACK_FORMATS.setdefault(_packed_type, 3)
+
+GL_images.COMPONENT_COUNTS.setdefault(GL.GL_RG, 2)
+
+# Map the block compressed internal formats (DXT1/3/5, also
+# known as BC1/2/3, and BC4/5) to bytes per block. Each block
+# holds COMPRESSED_BLOCK_SIZE x COMPRESSED_BLOCK_SIZE texels.
+GL_COMPRESSED_FORMATS = {\
+        GL_s3tc.GL_COMPRESSED_RGB_S3TC_DXT1_EXT:    8,
+        GL_s3tc.GL_COMPRESSED_RGBA_S3TC_DXT1_EXT:   8,
+        GL_s3tc.GL_COMPRESSED_RGBA_S3TC_DXT3_EXT:   16,
+        GL_s3tc.GL_COMPRESSED_RGBA_S3TC_DXT5_EXT:   16,
+        GL.GL_COMPRESSED_RED_RGTC1:                 8,
+        GL.GL_COMPRESSED_SIGNED_RED_RGTC1:          8,
+        GL.GL_COMPRESSED_RG_RGTC2:                  16,
+        GL.GL_COMPRESSED_SIGNED_RG_RGTC2:           16}
+
+COMPRESSED_BLOCK_SIZE = 4
+
+# What a texture stream does with a new frame when all its
+# buffers are busy. See TextureStream2D.__init__.
+DROP_NEWEST = 'drop_newest'
+REPLACE_PENDING = 'replace_pending'
+BLOCK = 'block'
+GROW = 'grow'
+
+BACKPRESSURE_POLICIES = (DROP_NEWEST, REPLACE_PENDING, BLOCK, GROW)
+
+# How a TextureStream2D gets each frame to GL. See
+# TextureStream2D.__init__ for details.
+ORPHAN = 'orphan'
+INVALIDATE = 'invalidate'
+BUFFER_SUB_DATA = 'buffer_sub_data'
+CLIENT_MEMORY = 'client_memory'
+PERSISTENT = 'persistent'
+
+UPLOAD_METHODS = (ORPHAN, INVALIDATE, BUFFER_SUB_DATA, CLIENT_MEMORY,
+        PERSISTENT)
+
+# Packed types that describe the same bytes as a type on a little
+# endian machine, when there are 4 components. Drivers often take
+# these without any conversion. See TextureStream2D.__init__
+# (upload_type).
+EQUIVALENT_UPLOAD_TYPES = {
+        GL.GL_UNSIGNED_BYTE: (GL.GL_UNSIGNED_INT_8_8_8_8_REV,)}
+
+# Where UploadAutotuner keeps its results by default
+AUTOTUNE_FILENAME = os.path.join(os.path.expanduser('~'),
+        '.opengl_utils_autotune.json')
+
+# The phases of an upload timed by TextureStream2D. See
+# TextureStream2D.stats().
+UPLOAD_PHASES = ('catch_up', 'orphan', 'map', 'copy', 'unmap',
+        'tex_sub_image', 'upload', 'fence', 'gpu_upload')
+
+class TextureStreamHooks(object):
+    ''' The interface of the hooks that can be added to a
+    TextureStream2D with add_hooks(), for instance to export
+    metrics. Subclass it and override the methods of interest;
+    the methods here do nothing.
+
+    The hooks are called on whichever thread does the work (the
+    upload worker's, for uploads and drops, if there is one), so
+    they should be quick and must not call back into the stream.
+    '''
+    def on_upload(self, stream, upload):
+        '''Called after each upload. upload is a dictionary with
+        'bytes', the number of bytes copied to the pixel buffer,
+        'regions', the number of regions uploaded, 'buffer', the
+        index of the buffer uploaded to, and the time in seconds
+        taken by each phase of the upload, keyed by the names in
+        UPLOAD_PHASES (except 'fence', which isn't known yet).
+        '''
+        pass
+
+    def on_bind(self, stream, buffer_idx):
+        '''Called when the texture of buffer buffer_idx is bound.
+        '''
+        pass
+
+    def on_drop(self, stream, reason):
+        '''Called when a frame is lost because the buffers were
+        busy. reason is 'dropped' if the new frame was ignored, or
+        'replaced' if a pending frame was replaced by it.
+        '''
+        pass
+
+    def on_gpu_upload(self, stream, buffer_idx, seconds):
+        '''Called with the time the card took over an upload to
+        buffer buffer_idx, when the stream has GPU timing (see
+        TextureStream2D.get_gpu_timing()). This is only known
+        some time after the upload, so it is called from a later
+        upload.
+        '''
+        pass
 
 class TextureStream2D(object):
     ''' A class that defines a 2D texture stream. A
@@ -113,11 +289,33 @@ class TextureStream2D(object):
         :
 
     '''
-    
+    # What to do with a new frame when all the buffers are busy.
+    # See __init__ for details.
+    DROP_NEWEST = DROP_NEWEST
+    REPLACE_PENDING = REPLACE_PENDING
+    BLOCK = BLOCK
+    GROW = GROW
+
+    BACKPRESSURE_POLICIES = BACKPRESSURE_POLICIES
+
+    # How each frame gets to GL. See __init__ for details.
+    ORPHAN = ORPHAN
+    INVALIDATE = INVALIDATE
+    BUFFER_SUB_DATA = BUFFER_SUB_DATA
+    CLIENT_MEMORY = CLIENT_MEMORY
+    PERSISTENT = PERSISTENT
+
+    UPLOAD_METHODS = UPLOAD_METHODS
+
     def __init__(self, size, gl_format, gl_type, gl_internal_format,
             texture_unit, buffers=2, 
             buffer_usage=GL.GL_STREAM_DRAW,
-            min_filter=GL.GL_NEAREST, mag_filter=GL.GL_NEAREST):
+            min_filter=GL.GL_NEAREST, mag_filter=GL.GL_NEAREST,
+            persistent_mapping=False, tile_size=None,
+            backpressure=DROP_NEWEST, block_timeout=0.1, max_buffers=None,
+            upload_worker=None, gpu_timing=False, frame_fences=None,
+            upload_method=None, upload_type=None, autotune=False,
+            deferred=False, on_ready=None, fence_poller=None):
         ''' Initialise the texture stream.
 
         size is a tuple or similarly indexable array with
@@ -129,9 +327,18 @@ class TextureStream2D(object):
         http://www.opengl.org/sdk/docs/man/xhtml/glTexImage2D.xml
         
         (under the subheadings given by format, type
-        and internalformat respectively), and the 
+        and internalformat respectively), and the
         arguments should satisfy those descriptions.
-        
+
+        If gl_internal_format is one of the block compressed
+        formats in GL_COMPRESSED_FORMATS, the stream takes
+        data that has already been compressed, and uploads
+        it with glCompressedTexSubImage2D. gl_format and
+        gl_type then only describe the (unused) uncompressed
+        layout, and should be something like GL.GL_RGBA and
+        GL.GL_UNSIGNED_BYTE. See update_texture() for how the
+        data should be laid out.
+
         texture_unit is the OpenGL texture unit that
         should be used for all the texture operations
         related to this texture stream. It should be
@@ -152,7 +359,207 @@ class TextureStream2D(object):
         the buffers. See:
         http://www.opengl.org/sdk/docs/man/xhtml/glBufferData.xml
         for more information (under 'usage').
+
+        If persistent_mapping is True, a single buffer big
+        enough for all the pixel buffers is allocated with
+        immutable storage (ARB_buffer_storage) and mapped
+        once for the lifetime of the instance. Each upload
+        then just copies into the next slice of that mapping,
+        avoiding the orphan/map/unmap cycle that is otherwise
+        done for every upload. If the extension is not
+        available, the usual pixel buffers are used instead;
+        get_persistent_mapping() says which was used.
+        buffer_usage is ignored for a persistent mapping.
+
+        If tile_size is given, update_texture() compares each
+        frame with the last one it uploaded, in tiles of 
+        tile_size texels (either a single number or an (x, y)
+        tuple), and only uploads the tiles that have changed.
+        A frame that hasn't changed at all is not uploaded.
+        get_upload_counters() gives the number of bytes this
+        has saved.
+
+        backpressure sets what happens to a new frame when
+        all the buffers are busy (either being uploaded to or
+        being read from). It should be one of:
+
+        TextureStream2D.DROP_NEWEST: The new frame is ignored.
+        This is the default.
+
+        TextureStream2D.REPLACE_PENDING: The most recent upload
+        that hasn't finished yet is replaced by the new frame
+        (like a mailbox). This keeps the latency down. It isn't
+        possible with a persistent mapping (the pixel buffer
+        may still be in use), in which case the new frame is
+        ignored.
+
+        TextureStream2D.BLOCK: Wait for up to block_timeout
+        seconds for the oldest unfinished upload to finish,
+        and ignore the new frame if it doesn't.
+
+        TextureStream2D.GROW: Add another buffer, up to a total
+        of max_buffers, and ignore the new frame after that. This
+        needs ARB_copy_image to initialise the new texture, and 
+        isn't possible with a persistent mapping, in which case
+        the new frame is ignored.
+
+        get_upload_counters() gives the number of frames that 
+        have been dropped or replaced.
+
+        If upload_worker is a TextureUploadWorker, the uploads
+        are done by its thread on its GL context (which must
+        share objects with the context used for rendering) rather
+        than on the thread that calls update_texture() and 
+        friends. Those methods then just queue the frame and 
+        return. If the queue is full, the backpressure policy
+        applies to the queue: DROP_NEWEST and GROW ignore the
+        new frame, BLOCK waits for up to block_timeout for room,
+        and REPLACE_PENDING replaces the frame this stream has
+        waiting in the queue, if any. The arrays passed are not
+        copied, so they should not be changed until they have
+        been uploaded. acquire_frame() can't be used with an 
+        upload worker. The instance itself must be created on
+        the rendering thread, with the rendering context current.
+
+        If gpu_timing is True, GL_TIMESTAMP queries are put either
+        side of the glTexSubImage2D calls of each upload, to time
+        the upload on the card. The results are read back when they
+        are ready, without waiting for them, and go into the
+        'gpu_upload' entry of stats() and to the on_gpu_upload()
+        hooks. If timer queries (ARB_timer_query) aren't available,
+        there is no GPU timing; get_gpu_timing() says which.
+
+        If frame_fences is a FrameFences, the stream doesn't set a
+        sync of its own after each upload, but relies on the fence
+        that frame_fences.end_frame() sets at the end of the frame,
+        which can be shared by any number of streams. end_frame()
+        must then be called every frame, or the uploads will never
+        be seen to finish, and BLOCK can only wait for uploads
+        made in earlier frames. This can't be used with an upload
+        worker, as the frame's fence is in the rendering context.
+
+        upload_method sets how each frame gets to GL. It should be
+        one of:
+
+        TextureStream2D.ORPHAN: The pixel buffer is orphaned with
+        glBufferData and mapped with glMapBuffer. This is the
+        default.
+
+        TextureStream2D.INVALIDATE: The pixel buffer is mapped with
+        glMapBufferRange and GL_MAP_INVALIDATE_BUFFER_BIT, which
+        orphans it in the same call. This needs
+        ARB_map_buffer_range, and falls back to ORPHAN without it.
+
+        TextureStream2D.BUFFER_SUB_DATA: The frame is copied into
+        client memory, and then into the orphaned pixel buffer
+        with glBufferSubData. The whole buffer is sent each
+        time, so this suits whole frames better than regions.
+
+        TextureStream2D.CLIENT_MEMORY: No pixel buffers are used,
+        and glTexSubImage2D reads the frame out of client memory.
+        The driver copies it before the call returns.
+
+        TextureStream2D.PERSISTENT: The same as persistent_mapping.
+
+        If upload_method is not given, it is PERSISTENT if
+        persistent_mapping is True and ORPHAN otherwise.
+        get_upload_method() says which was used.
+
+        upload_type, if given, is the GL type the frames are passed
+        to GL as, in place of gl_type. It must describe the same
+        bytes as gl_type, so the data is still what gl_type says
+        it should be. EQUIVALENT_UPLOAD_TYPES lists the ones
+        worth trying, such as GL.GL_UNSIGNED_INT_8_8_8_8_REV for
+        GL.GL_UNSIGNED_BYTE with 4 components on a little endian
+        machine, which is the native layout of many drivers
+        (particularly with GL.GL_BGRA).
+
+        If autotune is True, or an UploadAutotuner, the fastest
+        upload_method, upload_type, buffers and buffer_usage for
+        the size and format with this renderer are used in place
+        of those given, provided they are clearly faster than
+        orphaned buffers of gl_type with the buffers and
+        buffer_usage given (so persistent_mapping can't be given
+        as well). They are timed the first time they are
+        asked for, which can take a few seconds, and are kept on
+        disk from then on. autotune=True uses the module's
+        UploadAutotuner (see get_upload_autotuner()).
+
+        Normally the instantiation waits for the card, both before
+        and after the textures are set up, which can add up with
+        many streams. If deferred is True, it doesn't wait at all.
+        The textures are cleared to zeros on the card, with
+        glClearTexImage (ARB_clear_texture) or otherwise from a
+        pixel buffer of zeros, and a fence is set after the
+        clearing. get_ready() says whether that has been signalled,
+        and on_ready, if given, is called with the instance once it
+        has, from fence_poller (a FencePoller, the module's one from
+        get_fence_poller() if not given). The stream can be used
+        straight away, as the uploads and the rendering are queued
+        up behind the clearing. With an upload worker, its context
+        waits on the card for the clearing (with glWaitSync) before
+        the first upload.
         '''
+        # The arguments are checked before any autotuning, which
+        # can take a while.
+        if not GL_TYPES.has_key(gl_type):
+            raise ValueError(repr(gl_type) + ' is not a valid type.')
+        
+        if not GL_FORMATS.has_key(gl_format):
+            raise ValueError(repr(gl_format) + ' is not a valid format.')
+
+        if upload_type is None:
+            upload_type = gl_type
+
+        elif not (GL_TYPES.has_key(upload_type) and
+                _bytes_per_texel(upload_type, gl_format) ==
+                _bytes_per_texel(gl_type, gl_format)):
+            raise ValueError(repr(upload_type) + ' is not the same size '\
+                    'as ' + repr(gl_type) + '.')
+
+        if upload_method is not None and upload_method not in UPLOAD_METHODS:
+            raise ValueError(repr(upload_method) + ' is not a valid '\
+                    'upload method.')
+
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(repr(backpressure) + ' is not a valid '\
+                    'backpressure policy.')
+
+        if frame_fences is not None and upload_worker is not None:
+            raise ValueError('frame_fences can\'t be used with an '\
+                    'upload worker.')
+
+        if autotune and persistent_mapping:
+            raise ValueError('persistent_mapping can\'t be used with '\
+                    'autotune, which chooses the upload method.')
+
+        # The tuned settings replace those given
+        if autotune:
+            if autotune is True:
+                autotune = get_upload_autotuner()
+
+            # Nothing can be replaced or grown with a persistent
+            # mapping.
+            upload_methods = UPLOAD_METHODS
+            if backpressure in (REPLACE_PENDING, GROW):
+                upload_methods = [each for each in UPLOAD_METHODS
+                        if each != PERSISTENT]
+
+            # The settings that are kept unless the tuned ones
+            # are clearly faster
+            default = {'upload_method': ORPHAN,
+                    'upload_type': gl_type,
+                    'buffers': buffers,
+                    'buffer_usage': buffer_usage}
+
+            settings = autotune.get_settings(size, gl_format, gl_type,
+                    gl_internal_format, upload_methods, default)
+
+            buffers = settings['buffers']
+            buffer_usage = settings['buffer_usage']
+            upload_method = settings['upload_method']
+            upload_type = settings['upload_type']
+
         # Args
         self.__size = size
         self.__gl_format = gl_format
@@ -161,109 +568,253 @@ class TextureStream2D(object):
         self.__buffer_usage = buffer_usage
         self.__texture_valid = False
         
-        # The number of pixel buffers that are used for
-        # streaming the textures.
-        self.__n_pixel_buffers = buffers
-        
         self.__texture_unit = texture_unit
 
-        if not GL_TYPES.has_key(self.__gl_type):
-            raise ValueError(repr(self.__gl_type) + ' is not a valid type.')
-        
-        if not GL_FORMATS.has_key(self.__gl_format):
-            raise ValueError(repr(self.__gl_format) + ' is not a valid format.')
+        if tile_size is not None and numpy.isscalar(tile_size):
+            tile_size = (tile_size, tile_size)
+
+        self.__last_frame = None
+
+        self.__counters = {'bytes_uploaded': 0,
+                'bytes_saved': 0,
+                'frames_skipped': 0}
+
+        self.__frame_recorder = None
+
+        self.__hooks = ()
+        self.__stats = _UploadStats()
+        self.__gpu_timer = None
+        self.__worker_ready_sync = None
+
+        self.__upload_type = upload_type
+
+        self.__min_filter = min_filter
+        self.__mag_filter = mag_filter
 
         # Set up variables
         self.__texture_silhouette = None
-        try:
-            self.__copy_sync = [GLSyncObject()] * self.__n_pixel_buffers
-        except GLExtensionNotAvailable:
-            self.__copy_sync = [GLDummySyncObject()] * self.__n_pixel_buffers
-
-        self.__read_idx = 0
-        self.__write_idx = 0
-        
-        for each_sync in self.__copy_sync:
-            status = each_sync.block_until_signalled()
-            if status is type(each_sync).GL_TIMEOUT_EXPIRED:
-                raise RuntimeError('Problem clearing the OpenGL pipeline in a '\
-                    'reasonable time frame.')
 
         # Initialise the textures
         GL.glActiveTexture(self.__texture_unit)
-        self.__textures = GL.glGenTextures(self.__n_pixel_buffers)
-        if self.__n_pixel_buffers == 1:
-            self.__textures = [self.__textures]
+        self.__textures = [self.__create_texture() 
+                for n in range(0, buffers)]
         
-        for each_texture in self.__textures:
-            GL.glBindTexture(GL.GL_TEXTURE_2D, each_texture)
+        # Block compressed data is handled a block at a time, so
+        # a block takes the place of a texel in the data arrays,
+        # and the bytes per texel are the bytes per block.
+        if GL_COMPRESSED_FORMATS.has_key(gl_internal_format):
+            self.__block_size = COMPRESSED_BLOCK_SIZE
+            bytes_per_texel = GL_COMPRESSED_FORMATS[gl_internal_format]
+        else:
+            self.__block_size = 1
+            bytes_per_texel = _bytes_per_texel(self.__gl_type,
+                    self.__gl_format)
 
-            GL.glTexImage2D(
-                GL.GL_TEXTURE_2D,
-                0, self.__gl_internal_format, self.__size[0], self.__size[1],
-                0, self.__gl_format, self.__gl_type, None)
-        
-            # Set up the texture parameters
-            # Nearest neighbour filters, clamping texture coordinates to 
-            # between 0 and 1.
-            GL.glTexParameterf(GL.GL_TEXTURE_2D, \
-                    GL.GL_TEXTURE_MAG_FILTER, mag_filter)
-            GL.glTexParameterf(GL.GL_TEXTURE_2D, \
-                    GL.GL_TEXTURE_MIN_FILTER, min_filter)
-            GL.glTexParameterf(GL.GL_TEXTURE_2D, \
-                    GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
-            GL.glTexParameterf(GL.GL_TEXTURE_2D, \
-                    GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP)
-
-        # We're done with those textures
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        
-        # get the bytes per texel from GL_TYPES and GL_FORMATS
-        if GL_TYPES[self.__gl_type][1]:
-            bytes_per_texel = \
-                    GL_TYPES[self.__gl_type][0] * GL_FORMATS[self.__gl_format]
+        # The size of the texture in blocks, rounded up
+        block = self.__block_size
+        self.__blocks = (-(-self.__size[0] // block),
+                -(-self.__size[1] // block))
+
+        buffer_size = self.__blocks[0]*self.__blocks[1]*bytes_per_texel
+
+        self.__bytes_per_texel = bytes_per_texel
+
+        # Float data is converted to half floats as it is copied
+        if gl_type == GL.GL_HALF_FLOAT:
+            self.__convert_dtype = numpy.dtype(GL_DTYPES[gl_type])
         else:
-            bytes_per_texel = GL_TYPES[self.__gl_type][0]
+            self.__convert_dtype = None
+        self.__buffer_size = buffer_size
+
+        # Leave room in the pixel buffers for rows padded out to 8
+        # bytes, so padded frames can be copied in as they are. See
+        # _copy_to_pixel_buffer().
+        if self.__block_size == 1:
+            self.__pixel_buffer_size = self.__size[1]*_aligned(
+                    self.__size[0]*bytes_per_texel)
+        else:
+            self.__pixel_buffer_size = buffer_size
+
+        # The tiles are compared in whole blocks
+        if tile_size is not None:
+            tile_size = tuple([max(1, each // block) for each in tile_size])
+
+        self.__tile_size = tile_size
+
+        # The shape and dtype of the arrays given by acquire_frame()
+        if self.__block_size > 1:
+            self.__frame_shape = (self.__blocks[1], self.__blocks[0],
+                    bytes_per_texel)
+            self.__frame_dtype = 'uint8'
+        elif GL_TYPES[self.__gl_type][1]:
+            self.__frame_shape = (self.__size[1], self.__size[0], 
+                    GL_FORMATS[self.__gl_format])
+            self.__frame_dtype = GL_DTYPES[self.__gl_type]
+        else:
+            self.__frame_shape = (self.__size[1], self.__size[0])
+            self.__frame_dtype = 'uint%d' % (8*bytes_per_texel)
+
+        self.__frame_acquired = False
+
+        # The regions that have been uploaded to other buffers
+        # since each buffer was last written to, and so need
+        # copying in before it is next written to. See
+        # update_texture_region().
+        self.__stale_regions = [[] for n in range(buffers)]
 
-        buffer_size = self.__size[0]*self.__size[1]*bytes_per_texel
+        # Texture to texture copies need ARB_copy_image. Without
+        # it, a copy of each region is kept instead, but only once
+        # a region smaller than the texture has been uploaded, as
+        # until then each upload covers everything the buffers
+        # have missed.
+        self.__copy_image = bool(GL.glCopyImageSubData)
+        self.__keep_copies = False
 
         # Set up the pixel buffers
-        self.__pixel_buffers = GL.glGenBuffers(self.__n_pixel_buffers)
-        if self.__n_pixel_buffers == 1:
-            self.__pixel_buffers = [self.__pixel_buffers]
+        self.__pixel_buffers = _new_pixel_buffers(buffers, 
+                self.__pixel_buffer_size, buffer_usage, persistent_mapping,
+                upload_method)
 
-        for pixel_buffer in self.__pixel_buffers:
-            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pixel_buffer)
-            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, buffer_size, 
-                    None, self.__buffer_usage)
+        # And the ring that decides which of them to use when
+        self.__ring = _BufferRing(self.__pixel_buffers, buffers,
+                backpressure, block_timeout, max_buffers,
+                self.__insert_buffer, wait=not deferred)
 
-        # we're finished setting up the buffers so
-        # we bind it to 0
-        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
-        
-        # Initialize empty textures (just need to pass a single
-        # texel).
-        for n in range(0,self.__n_pixel_buffers):
-            self.update_texture_with_clear(\
-                    numpy.zeros((1,1,bytes_per_texel), dtype='uint8'))
-        
-        # Delete the syncs just created by the init.
-        for n in range(0,self.__n_pixel_buffers):
-            self.__copy_sync[n].delete_sync()
-        
-        try:
-            init_sync = GLSyncObject()
-        except GLExtensionNotAvailable:
-            self.init_sync = GLDummySyncObject()
+        self.__ring.stats = self.__stats
+        self.__ring.on_drop = self.__on_drop
 
-        status = init_sync.block_until_signalled(timeout=2.0)
-        if status is type(init_sync).GL_TIMEOUT_EXPIRED:
-            raise RuntimeError('Problem initialising the textures in a '\
-                    'reasonable time frame.')
-        
-        # Reinitialise the indices
-        self.__read_idx = 0
-        self.__write_idx = 0
+        if deferred:
+            self.__clear_textures()
+            self.__ready_sync = self.__ring.reset(wait=False)
+
+            # So other contexts can wait for it
+            GL.glFlush()
+
+            if on_ready is not None:
+                self.__ready_sync.when_signalled(
+                        lambda fence: on_ready(self), fence_poller)
+
+        else:
+            # Initialize empty textures (just need to pass a single
+            # texel).
+            for n in range(0, buffers):
+                self.update_texture_with_clear(\
+                        numpy.zeros((1,1,bytes_per_texel), dtype='uint8'))
+
+            self.__ring.reset()
+            self.__ready_sync = None
+
+        # The sync the upload worker's context should wait for
+        # before its first upload
+        if upload_worker is not None:
+            self.__worker_ready_sync = self.__ready_sync
+
+        # All the textures are now the same, and the initial
+        # single texels don't need copies
+        self.__stale_regions = [[] for n in range(buffers)]
+        self.__keep_copies = False
+
+        # The initial clearing doesn't count
+        self.reset_upload_counters()
+
+        # The initialisation isn't timed on the card either
+        if gpu_timing:
+            try:
+                self.__gpu_timer = _GPUTimer(buffers)
+            except GLExtensionNotAvailable:
+                pass
+
+        # Nor are the upload worker and frame fences.
+        self.__ring.upload_worker = upload_worker
+        self.__ring.frame_fences = frame_fences
+
+    def __clear_textures(self):
+        ''' Fill all the textures with zeros on the card, without
+        waiting for anything. glClearTexImage is used if it is
+        available, and otherwise the textures are copied out of a
+        single pixel buffer of zeros, which GL deletes once it is
+        finished with.
+        '''
+        rect = (0, 0, self.__size[0], self.__size[1])
+
+        # Compressed textures can't be cleared
+        clear_texture = bool(GL.glClearTexImage) and self.__block_size == 1
+
+        if not clear_texture:
+            zeros = numpy.zeros(self.__pixel_buffer_size, dtype='uint8')
+
+            zero_buffer = GL.glGenBuffers(1)
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, zero_buffer)
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, zeros.nbytes, zeros,
+                    GL.GL_STATIC_DRAW)
+
+            _set_unpack_layout(alignment=1)
+
+        GL.glActiveTexture(self.__texture_unit)
+
+        for texture in self.__textures:
+            if clear_texture:
+                GL.glClearTexImage(texture, 0, self.__gl_format,
+                        self.__upload_type, None)
+            else:
+                GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+                self.__tex_sub_image(rect, ctypes.c_void_p(0))
+
+        if not clear_texture:
+            _set_unpack_layout()
+            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+            GL.glDeleteBuffers(1, [zero_buffer])
+
+    def __create_texture(self):
+        ''' Create and return a new texture with the size, 
+        format and parameters of this stream. The active 
+        texture unit should already have been set.
+        '''
+        texture = GL.glGenTextures(1)
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+
+        GL.glTexImage2D(
+            GL.GL_TEXTURE_2D,
+            0, self.__gl_internal_format, self.__size[0], self.__size[1],
+            0, self.__gl_format, self.__upload_type, None)
+    
+        # Set up the texture parameters
+        # Nearest neighbour filters, clamping texture coordinates to 
+        # between 0 and 1.
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MAG_FILTER, self.__mag_filter)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MIN_FILTER, self.__min_filter)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP)
+
+        # We're done with the texture
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        return texture
+
+    def __insert_buffer(self, idx):
+        ''' Insert a new texture at idx when the ring grows. 
+        Return False if that can't be done.
+        '''
+        if not self.__copy_image:
+            return False
+
+        GL.glActiveTexture(self.__texture_unit)
+        self.__textures.insert(idx, self.__create_texture())
+
+        if self.__gpu_timer is not None:
+            self.__gpu_timer.insert(idx)
+
+        # The new texture has missed everything.
+        self.__stale_regions.insert(idx, 
+                [((0, 0, self.__size[0], self.__size[1]), None)])
+
+        return True
 
     def __enter__(self):
         self.bind_texture()
@@ -272,33 +823,186 @@ class TextureStream2D(object):
         self.unbind_texture()
         return False
         
-    def __update_read_idx(self):
-        '''Update the read index to the most 
-        recently filled buffer. Return True
-        if the read index is changed, otherwise
-        return False.
+    def get_texture_unit(self):
+        '''Return the texture unit the textures are bound to.
         '''
-        # Count backwards from the write index
-        # until we get to a buffer that has signalled
-        # completion. If none is found, the read index
-        # remains unchanged and return False (else
-        for n in range(0,self.__n_pixel_buffers):
-            idx = (self.__write_idx-n)%self.__n_pixel_buffers
-            if self.__copy_sync[idx].get_fence_signalled_and_delete():
-                self.__read_idx = idx
-                return True
+        return self.__texture_unit
+
+    def get_persistent_mapping(self):
+        '''Return whether the pixel buffers are persistently
+        mapped. This is False if persistent_mapping was not asked
+        for at instantiation, or if it was but the driver does
+        not support it.
+        '''
+        return self.__pixel_buffers.persistent
+
+    def get_upload_method(self):
+        '''Return how each frame gets to GL, which is one of
+        UPLOAD_METHODS. This is ORPHAN if the method asked for at
+        instantiation isn't supported.
+        '''
+        return self.__pixel_buffers.method
+
+    def get_upload_type(self):
+        '''Return the GL type the frames are passed to GL as.
+        This is gl_type unless another upload_type was given (or
+        chosen by the autotuner) at instantiation.
+        '''
+        return self.__upload_type
+
+    def delete(self):
+        '''Delete the textures and pixel buffers of the stream,
+        which can't be used afterwards. The syncs go when they
+        are garbage collected. Any uploads queued on an upload
+        worker should be finished first.
+        '''
+        GL.glDeleteTextures(len(self.__textures), self.__textures)
+        self.__textures = []
+
+        self.__pixel_buffers.delete()
+
+        if self.__gpu_timer is not None:
+            # The queries belong to the context that does the uploads
+            worker = self.__ring.upload_worker
+
+            if worker is None or worker.is_worker_thread():
+                self.__gpu_timer.delete()
+            else:
+                worker.submit(self.__gpu_timer.delete, block=True)
+
+            self.__gpu_timer = None
+
+    def get_gpu_timing(self):
+        '''Return whether the uploads are being timed on the card.
+        This is False if gpu_timing was not asked for at
+        instantiation, or if it was but timer queries are not
+        available.
+        '''
+        return self.__gpu_timer is not None
+
+    def set_frame_recorder(self, frame_recorder):
+        '''Record every array passed to update_texture() from
+        now on with frame_recorder, a FrameRecorder (or anything
+        with a write_frame(data) method), before anything else is
+        done with it, so frames that are dropped or skipped are
+        recorded too. Pass None to stop recording.
+
+        The recorder is not closed by the stream.
+        '''
+        self.__frame_recorder = frame_recorder
+
+    def get_upload_counters(self):
+        '''Return a dictionary of counters describing the
+        uploads so far:
+
+        'bytes_uploaded' is the number of bytes copied to 
+        the pixel buffers.
+        'bytes_saved' is the number of bytes passed to 
+        update_texture() that were not uploaded because they
+        were the same as the previous frame (only when a 
+        tile_size was given).
+        'frames_skipped' is the number of frames passed to
+        update_texture() that were not uploaded at all because
+        they were the same as the previous frame.
+        'frames_accepted' is the number of frames (or regions)
+        that were uploaded.
+        'frames_dropped' is the number of frames (or regions)
+        that were ignored because all the buffers were busy.
+        'frames_replaced' is the number of frames that were
+        replaced by a newer frame before their upload had
+        finished (or, with an upload worker, started), so were
+        never displayed.
+        '''
+        counters = dict(self.__counters)
+        counters.update(self.__ring.counters)
+        return counters
+
+    def reset_upload_counters(self):
+        '''Set all the counters returned by
+        get_upload_counters() back to zero, and clear the
+        statistics returned by stats().
+        '''
+        for key in self.__counters:
+            self.__counters[key] = 0
+
+        self.__ring.reset_counters()
+        self.__stats.reset()
+
+    def stats(self):
+        '''Return a dictionary of statistics of how long the
+        uploads have taken. For each phase in UPLOAD_PHASES
+        there is a dictionary with 'count', the number of times
+        it has been timed, and 'mean', 'p50' and 'p99', the mean,
+        median and 99th percentile of the last 1000 times, in
+        seconds (or None before it has been timed). The phases
+        are:
+
+        'catch_up': copying in the regions the buffer missed.
+        'orphan': orphaning the pixel buffer with glBufferData
+        (not done with a persistent mapping).
+        'map': mapping the pixel buffer.
+        'copy': copying the data into the pixel buffer (or, for
+        acquire_frame(), the time the frame was held).
+        'unmap': unmapping the pixel buffer.
+        'tex_sub_image': the glTexSubImage2D calls.
+        'upload': the whole upload, from mapping to setting the
+        fence.
+        'fence': from setting the fence to finding it signalled,
+        so this depends on how often the texture is bound.
+        'gpu_upload': the time the card took over the
+        glTexSubImage2D calls, if the stream has GPU timing.
+
+        Apart from 'gpu_upload', these are the times taken on the
+        CPU, so the GL calls are mostly timed as long as they take
+        to queue up (or to wait for the driver), not to happen on
+        the card.
+
+        'bytes_per_second' is the number of bytes copied to the
+        pixel buffers per second of upload time over the last
+        1000 uploads.
+        '''
+        return self.__stats.stats()
+
+    def add_hooks(self, hooks):
+        '''Add hooks, a TextureStreamHooks, to be called on each
+        upload, bind and drop. When there are no hooks, this
+        costs next to nothing.
+        '''
+        self.__hooks = self.__hooks + (hooks,)
+
+    def remove_hooks(self, hooks):
+        '''Remove hooks previously added with add_hooks().
+        '''
+        self.__hooks = tuple([each for each in self.__hooks
+            if each is not hooks])
+
+    def __on_drop(self, reason):
+        for hooks in self.__hooks:
+            hooks.on_drop(self, reason)
 
-        return False
-    
     def get_texture_validity(self):
         '''Return whether a texture has ever
         completed an upload. Useful at initialisation.
         '''
         if not self.__texture_valid:
-            self.__texture_valid = self.__update_read_idx()
+            with self.__ring.lock:
+                self.__texture_valid = self.__ring.update_read_idx()
         
         return self.__texture_valid
 
+    def get_ready(self):
+        '''Return whether the textures have been set up on the
+        card. This is always True unless the instance was made
+        with deferred set, in which case it is True once the
+        clearing of the textures has finished. It doesn't wait.
+        '''
+        ready_sync = self.__ready_sync
+
+        if ready_sync is not None and ready_sync.get_fence_signalled():
+            self.__ready_sync = ready_sync = None
+
+        return ready_sync is None
+
     def bind_texture(self):
         ''' Bind the current texture to the OpenGL context 
         for rendering. You can release the texture in the
@@ -317,13 +1021,15 @@ class TextureStream2D(object):
         '''
         GL.glActiveTexture(self.__texture_unit)
 
-        if self.__n_pixel_buffers is 1:
-            texture_id = self.__textures[0]
-        else:
-            self.__update_read_idx()
-            texture_id = self.__textures[self.__read_idx]
+        with self.__ring.lock:
+            self.__ring.update_read_idx()
+            read_idx = self.__ring.read_idx
+            texture_id = self.__textures[read_idx]
 
         GL.glBindTexture(GL.GL_TEXTURE_2D, texture_id)
+
+        for hooks in self.__hooks:
+            hooks.on_bind(self, read_idx)
         
     def unbind_texture(self):
         GL.glActiveTexture(self.__texture_unit)
@@ -348,208 +1054,4442 @@ class TextureStream2D(object):
         per texel expected by gl_type.  Its up to you how
         the data is packed beyond that.
 
+        For a block compressed stream, each element of the
+        first two dimensions is a block of 4x4 texels rather
+        than a texel, so N and M are the number of rows and
+        columns of blocks, and data.itemsize*P should be
+        the bytes per block given by GL_COMPRESSED_FORMATS
+        (so an array of shape (N, M, 8) of uint8 for DXT1).
+        Partial blocks at the right and bottom edges of the
+        texture are included as whole blocks.
+
+        For a GL_HALF_FLOAT stream, the data can be float16, or
+        any other floats (such as float32), which are converted
+        to half floats as they are copied into the pixel buffer,
+        so only half floats cross the bus and there is no
+        temporary copy of the frame.
+
         This method will fill the texture from the
         beginning of the texture memory.
-        
+
         If the data is smaller than the texture then
         outside the data is left untouched.
         
         If the data is bigger than the texture, an
         exception is raised.
 
+        If a tile_size was given at instantiation, only the
+        tiles that differ from the last frame uploaded by this
+        method are uploaded. If none differ, nothing is.
+
         If an attempt is made to upload a texture whilst
         non of the previous uploads have finished and
         there are no more remaining buffers that are 
         currently unused (either for upload or for
         reading) then the data will just be ignored.
         '''
-        if not self.__set_next_write_idx():
+        # Check the data here, so that with an upload worker
+        # the exception is raised to the caller.
+        self.__check_data(data)
+
+        frame_recorder = self.__frame_recorder
+        worker = self.__ring.upload_worker
+
+        # With an upload worker, the frame is recorded when it is
+        # passed in rather than again when it is uploaded.
+        if frame_recorder is not None and (
+                worker is None or not worker.is_worker_thread()):
+            frame_recorder.write_frame(data)
+
+        if self.__ring.queue_upload(self.update_texture, 
+                (data,), True) is not None:
+            return None
+
+        regions = None
+        if self.__tile_size is not None:
+            regions = self.__changed_tiles(data)
+
+            if regions == []:
+                self.__counters['frames_skipped'] += 1
+                self.__counters['bytes_saved'] += data.nbytes
+                return None
+
+        if not self.__ring.next_write_idx():
             return None
         
         GL.glActiveTexture(self.__texture_unit)
 
         GL.glBindTexture(GL.GL_TEXTURE_2D, 
-                self.__textures[self.__write_idx])
+                self.__textures[self.__ring.write_idx])
         
-        self.__update_texture(data)
+        if regions is None:
+            self.__update_texture(data)
+        else:
+            self.__update_texture_regions(regions)
+            self.__counters['bytes_saved'] += data.nbytes - sum(
+                    [each[0].nbytes for each in regions])
+
+        if self.__tile_size is not None:
+            if (self.__last_frame is None or 
+                    self.__last_frame.shape != data.shape or
+                    self.__last_frame.dtype != data.dtype):
+                self.__last_frame = numpy.array(data)
+            else:
+                self.__last_frame[...] = data
 
         if data.shape[0:2] > self.__texture_silhouette:
             self.__texture_silhouette = data.shape[0:2]
-        
-        print self.__texture_silhouette
+
         GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
 
-    def __set_next_write_idx(self):
-        ''' Set the next write index for updating
-        the texture.
+    def update_texture_region(self, data, x, y):
+        '''Update a rectangular region of the texture with a
+        passed data array.
 
-        Return True if the write index was updated
-        ok, otherwise False. False is returned
-        if the next buffer is the one currently
-        being read from.
-        '''
-        
-        if self.__n_pixel_buffers is 1:
-            self.__write_idx = 0
-        else:
-            # Firstly update the read index to the most current one.
-            self.__update_read_idx()
+        The data is as described for update_texture(), except
+        that it is written with its first texel at column x and
+        row y of the texture rather than at the beginning of the
+        texture memory. Only the region covered by the data is
+        copied into the pixel buffer and on to the texture, so
+        updating a small part of a large texture is cheap.
 
-            self.__write_idx = (self.__write_idx+1)%self.__n_pixel_buffers
-            # The policy is that we don't overwrite the buffer that is 
-            # currently being read from.
-            if self.__write_idx == self.__read_idx:
-                self.__write_idx = (self.__write_idx-1)%self.__n_pixel_buffers
-                return False
-        
-        return True
-        
+        The rest of the texture is as it was after the previous
+        upload. Because each buffer has its own texture, any
+        buffer that missed an earlier upload has the regions it
+        missed copied into it from the most recent texture (on
+        the card if ARB_copy_image is available) before it is
+        written to, and so before it can be bound.
 
-    def __update_texture(self, data):
-        ''' Method that actually does the texture
-        updating after the self.__write_idx has 
-        been set up and the correct texture
-        has been bound.
-        '''
-        #
-        # The active texture unit should already have been set
-        #
+        For a block compressed stream, x and y should be
+        whole numbers of blocks.
+
+        If the region does not fit in the texture, an
+        exception is raised.
+
+        If an attempt is made to upload a texture whilst
+        non of the previous uploads have finished and
+        there are no more remaining buffers that are 
+        currently unused (either for upload or for
+        reading) then the data will just be ignored.
 
-        # A bit of data checking...
+        Returns whether the region was accepted. Unlike a
+        whole frame, an ignored region isn't made up for by
+        the next one, so if False is returned the region
+        should be passed again later (or the whole frame
+        uploaded) for the texture to be right. With an upload
+        worker, True means the region was queued; if the worker
+        then has to ignore it, on_drop is called with 'dropped'.
+        '''
         _data = numpy.atleast_3d(data)
-        
-        # get the bytes per texel from GL_TYPES and GL_FORMATS
-        if GL_TYPES[self.__gl_type][1]:
-            bytes_per_texel = \
-                    GL_TYPES[self.__gl_type][0] * GL_FORMATS[self.__gl_format]
-        else:
-            bytes_per_texel = GL_TYPES[self.__gl_type][0]
-        
-        if not data.itemsize*_data.shape[2] == bytes_per_texel:
-            raise ValueError('The number of bytes per texel for the '\
-                    'passed data does not agree with that expected by '\
-                    'the previously given GL type and format: ' \
-                    + repr(self.__gl_type) + ', ' + repr(self.__gl_format))
+        block = self.__block_size
 
-        # Compute the buffer size from the defaults
-        buffer_size = self.__size[0]*self.__size[1]*bytes_per_texel
-        
-        data_size_to_copy = data.shape[0]\
-                * data.shape[1] * bytes_per_texel
-        
-        if data_size_to_copy > buffer_size:
-            raise ValueError('The data array is larger than the texture.')
-        
-        # Bind the buffer
-        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER,
-                self.__pixel_buffers[self.__write_idx])
-        
-        GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, buffer_size, 
-                    None, self.__buffer_usage)
-        
-        # Map the buffer object to a pointer
-        pbo_pointer = GL.glMapBuffer(GL.GL_PIXEL_UNPACK_BUFFER, GL.GL_WRITE_ONLY)
+        if x % block or y % block:
+            raise ValueError('The offset is not a whole number of '\
+                    'compressed blocks.')
 
-        ctypes.memmove(pbo_pointer, data.ctypes.data, data_size_to_copy)
+        if (x < 0 or y < 0 or x // block + _data.shape[1] > self.__blocks[0]
+                or y // block + _data.shape[0] > self.__blocks[1]):
+            raise ValueError('The data array does not fit in the texture '\
+                    'at the given offset.')
 
-        # Unmap the buffer. This then pushes the memory
+        self.__check_data(data)
+
+        queued = self.__ring.queue_upload(self.update_texture_region, 
+                (data, x, y))
+
+        if queued is not None:
+            return queued
+
+        if not self.__ring.next_write_idx(whole_frame=False):
+            return False
+
+        GL.glActiveTexture(self.__texture_unit)
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 
+                self.__textures[self.__ring.write_idx])
+
+        self.__update_texture(data, x, y)
+
+        # Keep the last frame used for finding changed tiles 
+        # up to date.
+        if self.__last_frame is not None:
+            row, col = y // block, x // block
+            try:
+                self.__last_frame[row:row + data.shape[0],
+                        col:col + data.shape[1]] = data
+            except ValueError:
+                self.__last_frame = None
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        return True
+
+    @contextlib.contextmanager
+    def acquire_frame(self):
+        '''A context manager that gives a writable numpy array
+        over the memory of the next pixel buffer, so a frame can
+        be written straight into it rather than being copied in
+        from another array by update_texture(). For example:
+
+        with texture_stream_2d_instance.acquire_frame() as frame:
+            if frame is not None:
+                numpy.multiply(a, b, out=frame)
+
+        The array covers the whole texture, so its shape is
+        (size[1], size[0], P), where P is the number of elements
+        per texel (or (size[1], size[0]) for the packed types
+        such as GL_UNSIGNED_SHORT_5_6_5) and its dtype follows
+        from gl_type. For a block compressed stream, it is a
+        uint8 array of the blocks, laid out as described for
+        update_texture(). Its contents are undefined until
+        written.
+
+        When the context manager exits the whole frame is
+        uploaded to the texture. If it exits with an exception,
+        nothing is uploaded. The array must not be used after 
+        the context manager exits.
+
+        If an attempt is made to acquire a frame whilst
+        non of the previous uploads have finished and
+        there are no more remaining buffers that are 
+        currently unused (either for upload or for
+        reading) then None is given instead of an array and
+        nothing is uploaded.
+        '''
+        if self.__frame_acquired:
+            raise RuntimeError('A frame has already been acquired.')
+
+        if self.__ring.upload_worker is not None:
+            raise RuntimeError('Frames can\'t be acquired when there is '\
+                    'an upload worker.')
+
+        if not self.__ring.next_write_idx():
+            yield None
+            return
+
+        self.__stats.start()
+
+        # Leave the buffer unbound whilst the frame is being
+        # written, as the caller might well use GL in the meantime.
+        pbo_pointer = self.__pixel_buffers.map(self.__ring.write_idx,
+                self.__stats)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        frame = _mapped_array(pbo_pointer, self.__frame_shape, 
+                self.__frame_dtype)
+
+        self.__frame_acquired = True
+        try:
+            yield frame
+
+        except:
+            self.__pixel_buffers.unmap(self.__ring.write_idx)
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+            self.__ring.cancel_write()
+            raise
+
+        finally:
+            self.__frame_acquired = False
+
+        # A copy is only kept if it's needed to catch up other
+        # buffers, in which case we can't avoid it.
+        frame_copy = None
+        if self.__keep_copies:
+            frame_copy = numpy.array(frame)
+
+        del frame
+
+        self.__stats.lap('copy')
+
+        rect = (0, 0, self.__size[0], self.__size[1])
+
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.__textures[self.__ring.write_idx])
+
+        # The whole texture is being written, so this just
+        # forgets what has been missed.
+        self.__catch_up_regions([rect])
+        self.__stats.lap('catch_up')
+
+        pbo_offset = self.__pixel_buffers.unmap(self.__ring.write_idx)
+        self.__stats.lap('unmap')
+
+        # The frame is tightly packed
+        self.__start_gpu_timer()
+        _set_unpack_layout(alignment=1)
+        self.__tex_sub_image(rect, ctypes.c_void_p(pbo_offset))
+        _set_unpack_layout()
+        self.__stop_gpu_timer()
+        self.__stats.lap('tex_sub_image')
+
+        self.__finish_upload([rect], [frame_copy], self.__buffer_size)
+
+        # Nothing to compare the next frame's tiles with
+        self.__last_frame = None
+        self.__texture_silhouette = self.__frame_shape[0:2]
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def __changed_tiles(self, data):
+        ''' Compare data with the last frame passed to 
+        update_texture(), tile by tile, and return a list of 
+        (data, x, y) regions that cover the tiles that have
+        changed, with the changed tiles in each row of tiles
+        merged into runs, and x and y in texels. An empty list
+        means nothing has changed.
+
+        None is returned if the whole of data should be
+        uploaded, either because there's no last frame to
+        compare it with or because so much has changed.
+        '''
+        last_frame = self.__last_frame
+
+        if (last_frame is None or last_frame.shape != data.shape or
+                last_frame.dtype != data.dtype):
+            return None
+
+        tile_x, tile_y = self.__tile_size
+        rows, cols = data.shape[0:2]
+
+        # Which texels have changed, then which tiles
+        changed = data != last_frame
+        if changed.ndim > 2:
+            changed = changed.reshape(rows, cols, -1).any(axis=2)
+
+        tile_rows = numpy.arange(0, rows, tile_y)
+        tile_cols = numpy.arange(0, cols, tile_x)
+
+        changed_tiles = numpy.logical_or.reduceat(
+                numpy.logical_or.reduceat(changed, tile_rows, axis=0),
+                tile_cols, axis=1)
+
+        # If most of it has changed, just upload the lot
+        if changed_tiles.sum() * 2 > changed_tiles.size:
+            return None
+
+        regions = []
+        for row_idx, tile_row in enumerate(changed_tiles):
+            # The start and end of each run of changed tiles
+            edges = numpy.flatnonzero(
+                    numpy.diff(numpy.concatenate(([0], tile_row, [0]))))
+
+            y = tile_rows[row_idx]
+            for start, end in zip(edges[0::2], edges[1::2]):
+                x = tile_cols[start]
+                regions.append((data[y:y + tile_y,
+                    x:x + (end - start) * tile_x],
+                    int(x) * self.__block_size,
+                    int(y) * self.__block_size))
+
+        # Each region is padded out in the pixel buffer, so lots
+        # of small ones might not fit, in which case the lot is
+        # uploaded.
+        if sum([self.__region_bytes(each[0]) for each in regions]) > \
+                self.__pixel_buffer_size:
+            return None
+
+        return regions
+
+    def __region_bytes(self, data):
+        ''' Return the bytes data takes up in a pixel buffer when
+        it is tightly packed, padded out to the 8 bytes each region
+        is aligned to.
+        '''
+        return _aligned(data.shape[0] * data.shape[1] * 
+                self.__bytes_per_texel)
+
+    def __update_texture(self, data, x=0, y=0):
+        ''' Method that actually does the texture
+        updating after the self.__ring.write_idx has 
+        been set up and the correct texture
+        has been bound. The data is written with
+        its first texel at (x, y), and should already
+        have been checked by __check_data().
+        '''
+        self.__update_texture_regions([(data, x, y)])
+
+    def __check_data(self, data):
+        ''' Check the data agrees with the bytes per texel
+        expected by the GL type and format, and that it isn't
+        larger than the texture. This is done before the write
+        index is moved on, so a bad frame doesn't use up a 
+        buffer.
+        '''
+        _data = numpy.atleast_3d(data)
+        
+        bytes_per_texel = self.__bytes_per_texel
+
+        if self.__convert_dtype is not None and data.dtype.kind == 'f':
+            itemsize = self.__convert_dtype.itemsize
+        else:
+            itemsize = data.itemsize
+        
+        if not itemsize*_data.shape[2] == bytes_per_texel:
+            raise ValueError('The number of bytes per texel for the '\
+                    'passed data does not agree with that expected by '\
+                    'the previously given GL type and format: ' \
+                    + repr(self.__gl_type) + ', ' + repr(self.__gl_format))
+
+        if data.shape[0] * data.shape[1] * bytes_per_texel > \
+                self.__buffer_size:
+            raise ValueError('The data array is larger than the texture.')
+
+    def __update_texture_regions(self, regions):
+        ''' Upload each (data, x, y) in regions to the texture
+        at self.__ring.write_idx, which should already be bound. All 
+        the regions are copied into the same pixel buffer, one
+        after another, so there's just the one map and fence 
+        for them all. The data needn't be contiguous.
+
+        The data should already have been checked, and the
+        regions must fit in the pixel buffer. Strided and byte
+        swapped data is copied as described for
+        _copy_to_pixel_buffer(), so no temporary copy of it is
+        made.
+        '''
+        #
+        # The active texture unit should already have been set
+        #
+        rects = [self.__texel_rect(x, y, data.shape[1], data.shape[0])
+                for data, x, y in regions]
+
+        # The textures of a deferred stream are cleared in the
+        # rendering context, which the worker's context has to wait
+        # for (on the card).
+        if self.__worker_ready_sync is not None:
+            self.__worker_ready_sync.wait_on_server()
+            self.__worker_ready_sync = None
+
+        stats = self.__stats
+        stats.start()
+
+        if (not (self.__copy_image or self.__keep_copies) and
+                rects != [(0, 0, self.__size[0], self.__size[1])]):
+            self.__start_keeping_copies()
+
+        # Bring the texture up to date with everything it has missed
+        # that this upload won't overwrite.
+        self.__catch_up_regions(rects)
+        stats.lap('catch_up')
+
+        # GL can't unpack strided or swapped compressed blocks
+        if self.__block_size == 1:
+            component_size = GL_TYPES[self.__gl_type][0]
+        else:
+            component_size = None
+
+        convert_dtype = self.__convert_dtype
+
+        # Bind the buffer and get a pointer to its memory
+        pbo_pointer = self.__pixel_buffers.map(self.__ring.write_idx, stats)
+
+        # Each region leaves room for the regions after it to be
+        # tightly packed.
+        reserved = sum([self.__region_bytes(each[0]) for each in regions])
+
+        offsets = []
+        layouts = []
+        offset = 0
+        uploaded = 0
+        for data, x, y in regions:
+            offsets.append(offset)
+            reserved -= self.__region_bytes(data)
+
+            copied, layout = _copy_to_pixel_buffer(pbo_pointer + offset,
+                    data, self.__bytes_per_texel,
+                    self.__pixel_buffer_size - offset - reserved, 
+                    component_size, convert_dtype)
+
+            layouts.append(layout)
+
+            offset += _aligned(copied)
+            uploaded += copied
+
+        stats.lap('copy')
+
+        # Unmap the buffer. This then pushes the memory
         # block to the graphics card with a DMA transfer??
-        GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER) 
+        pbo_offset = self.__pixel_buffers.unmap(self.__ring.write_idx)
+        stats.lap('unmap')
 
         # Copy the image to the texture memory. Since
         # we have a buffer object, this copies it out
         # of that memory.
-        GL.glTexSubImage2D(
-            GL.GL_TEXTURE_2D, 0, 0, 0, 
-            data.shape[1],
-            data.shape[0], 
-            self.__gl_format,
-            self.__gl_type,
-            None)
-        
+        self.__start_gpu_timer()
+
+        for rect, offset, layout in zip(rects, offsets, layouts):
+            _set_unpack_layout(*layout)
+            self.__tex_sub_image(rect, ctypes.c_void_p(pbo_offset + offset))
+
+        _set_unpack_layout()
+        self.__stop_gpu_timer()
+        stats.lap('tex_sub_image')
+
+        self.__finish_upload(rects, [each[0] for each in regions], uploaded)
+
+    def __start_gpu_timer(self):
+        ''' If the uploads are timed on the card, report the
+        times that are ready and start timing the upload to the
+        buffer at self.__ring.write_idx.
+        '''
+        gpu_timer = self.__gpu_timer
+
+        if gpu_timer is None:
+            return
+
+        for idx, seconds in gpu_timer.poll():
+            self.__stats.add('gpu_upload', seconds)
+
+            for hooks in self.__hooks:
+                hooks.on_gpu_upload(self, idx, seconds)
+
+        gpu_timer.start(self.__ring.write_idx)
+
+    def __stop_gpu_timer(self):
+        if self.__gpu_timer is not None:
+            self.__gpu_timer.stop(self.__ring.write_idx)
+
+    def __texel_rect(self, x, y, cols, rows):
+        ''' Return the (x, y, width, height) rectangle in texels
+        covered by data of cols by rows texels (or blocks) with
+        its first texel at (x, y). Blocks at the edge of the
+        texture are clipped to it.
+        '''
+        block = self.__block_size
+        return (x, y, min(cols * block, self.__size[0] - x),
+                min(rows * block, self.__size[1] - y))
+
+    def __tex_sub_image(self, rect, pixels):
+        ''' Upload pixels, an array or an offset into the bound
+        pixel buffer, to the (x, y, width, height) rectangle rect
+        of the bound texture, compressed or not.
+        '''
+        x, y, width, height = rect
+
+        if self.__block_size == 1:
+            GL.glTexSubImage2D(
+                    GL.GL_TEXTURE_2D, 0, x, y, width, height,
+                    self.__gl_format, self.__upload_type, pixels)
+        else:
+            block = self.__block_size
+            image_size = (-(-width // block) * -(-height // block) *
+                    self.__bytes_per_texel)
+
+            if isinstance(pixels, numpy.ndarray):
+                pixels = ctypes.c_void_p(pixels.ctypes.data)
+
+            # The wrapper works out the image size from the data,
+            # which it can't do for an offset into a pixel buffer.
+            GL.glCompressedTexSubImage2D.wrappedOperation(
+                    GL.GL_TEXTURE_2D, 0, x, y, width, height,
+                    self.__gl_internal_format, image_size, pixels)
+
+    def __finish_upload(self, rects, datas, uploaded):
+        ''' Tidy up after the regions in rects have been uploaded
+        from the pixel buffer to the texture at self.__ring.write_idx,
+        from the arrays in datas, and uploaded bytes were copied.
+        The other buffers are told what they missed and the fence
+        for the upload is set.
+        '''
         # Remove the buffer binding
         GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
 
-        try:
-            self.__copy_sync[self.__write_idx] = GLSyncObject()
-        except GLExtensionNotAvailable:
-            self.__copy_sync[self.__write_idx] = GLDummySyncObject()
+        self.__counters['bytes_uploaded'] += uploaded
+
+        # Every other buffer has now missed these regions
+        for rect, data in zip(rects, datas):
+            if not self.__keep_copies:
+                region_data = None
+            elif self.__convert_dtype is not None and data.dtype.kind == 'f':
+                region_data = numpy.array(data, dtype=self.__convert_dtype)
+            else:
+                region_data = numpy.array(data,
+                        dtype=data.dtype.newbyteorder('='))
+
+            for idx in range(0, self.__ring.n_buffers):
+                if idx != self.__ring.write_idx:
+                    self.__add_stale_region(idx, rect, region_data)
+
+        buffer_idx = self.__ring.write_idx
+        self.__ring.finish_write()
+
+        upload = self.__stats.finish(uploaded)
+
+        if self.__hooks:
+            upload.update({'bytes': uploaded, 'regions': len(rects),
+                'buffer': buffer_idx})
+
+            for hooks in self.__hooks:
+                hooks.on_upload(self, upload)
+
+    def __add_stale_region(self, idx, region, region_data):
+        ''' Record that buffer idx has missed the upload of
+        region, dropping any regions it had already missed that
+        are covered by it. region_data is a copy of the data
+        uploaded, or None if the region can be copied from
+        another texture instead (or, without ARB_copy_image, if
+        no copies are being kept yet).
+        '''
+        stale_regions = [each for each in self.__stale_regions[idx] 
+                if not _region_contains(region, each[0])]
+
+        stale_regions.append((region, region_data))
+
+        # Don't let the list grow without bound if the buffer
+        # isn't written to for a long time. Texture copies can
+        # just copy the bounding box instead.
+        if self.__copy_image and len(stale_regions) > 16:
+            stale_regions = [(_region_bounds(
+                [each[0] for each in stale_regions]), None)]
+
+        self.__stale_regions[idx] = stale_regions
+
+    def __start_keeping_copies(self):
+        ''' Keep copies of the uploads from now on, to catch up the
+        other buffers with, as there is no ARB_copy_image. The
+        buffers that have missed uploads that weren't copied are
+        caught up instead with a copy of the newest texture, which
+        has everything, read back from the card. This waits for
+        the card, but only happens once. The texture at
+        self.__ring.write_idx is left bound.
+        '''
+        self.__keep_copies = True
+
+        if not [each for each in self.__stale_regions
+                if [region for region in each if region[1] is None]]:
+            return
+
+        frame = numpy.empty(self.__frame_shape, dtype=self.__frame_dtype)
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D,
+                self.__textures[self.__ring.newest_idx])
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+
+        if self.__block_size == 1:
+            GL.glGetTexImage(GL.GL_TEXTURE_2D, 0, self.__gl_format,
+                    self.__upload_type, frame.ctypes.data)
+        else:
+            GL.glGetCompressedTexImage(GL.GL_TEXTURE_2D, 0,
+                    frame.view('uint8').ravel())
+
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 4)
+        GL.glBindTexture(GL.GL_TEXTURE_2D,
+                self.__textures[self.__ring.write_idx])
+
+        rect = (0, 0, self.__size[0], self.__size[1])
+
+        for idx, stale_regions in enumerate(self.__stale_regions):
+            if [each for each in stale_regions if each[1] is None]:
+                self.__stale_regions[idx] = [(rect, frame)]
+
+    def __catch_up_regions(self, regions):
+        ''' Copy into the texture at self.__ring.write_idx (which
+        should be bound) all the regions that it has missed
+        since it was last written to, except those that are
+        entirely covered by one of regions.
+        '''
+        if self.__ring.write_idx == self.__ring.newest_idx:
+            # Nothing has been missed
+            self.__stale_regions[self.__ring.write_idx] = []
+            return
+
+        for stale_region, region_data in \
+                self.__stale_regions[self.__ring.write_idx]:
+
+            if [each for each in regions 
+                    if _region_contains(each, stale_region)]:
+                continue
+
+            x, y, width, height = stale_region
+
+            if region_data is None:
+                GL.glCopyImageSubData(
+                        self.__textures[self.__ring.newest_idx], 
+                        GL.GL_TEXTURE_2D, 0, x, y, 0,
+                        self.__textures[self.__ring.write_idx], 
+                        GL.GL_TEXTURE_2D, 0, x, y, 0,
+                        width, height, 1)
+            else:
+                # The copies are tightly packed
+                _set_unpack_layout(alignment=1)
+                self.__tex_sub_image(stale_region, region_data)
+                _set_unpack_layout()
+
+        self.__stale_regions[self.__ring.write_idx] = []
+
+    def update_texture_with_clear(self, data):
+        ''' Update the texture with a passed data array.
+
+        The data is expected to be a three-dimensional
+        array of size NxMxP (c-ordering), where N and M
+        are the dimensions of the image and P is the
+        number of array elements per texel. The type
+        should agree with that set by the gl_type argument
+        at instantiation. P only really makes a lot of
+        sense if each array element that together make up
+        a texel are the same size. For example, if the
+        type is GL_UNSIGNED_SHORT_5_5_5_1, then its 2
+        bytes per texel, but with a differing number of
+        bits per colour, in which case the array can just
+        be two-dimensional.  The crucial test is that
+        data.itemsize*P is equal to the number of bytes
+        per texel expected by gl_type.  Its up to you how
+        the data is packed beyond that.
+
+        This method will fill the texture from the
+        beginning of the texture memory.  If the shape of
+        data is different to a previous call to this
+        method, then the texture is cleared first. The
+        assumption is that the size will change rarely.
+        
+        If the data is bigger than the texture, an
+        exception is raised.
+
+        If an attempt is made to upload a texture whilst
+        non of the previous uploads have finished and
+        there are no more remaining buffers that are 
+        currently unused (either for upload or for
+        reading) then the data will just be ignored.
+        '''
+        self.__check_data(data)
+
+        if self.__ring.queue_upload(self.update_texture_with_clear, 
+                (data,)) is not None:
+            return None
+
+        if not self.__ring.next_write_idx():
+            return None
+
+        GL.glActiveTexture(self.__texture_unit)
+        
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 
+                self.__textures[self.__ring.write_idx])
+        
+        # Clear the texture if the new data is smaller than
+        # the old data in either dimension.
+        if data.shape[0:2] < self.__texture_silhouette:
+            self.__pixel_buffers.clear(self.__ring.write_idx)
+
+            self.__texture_silhouette = data.shape[0:2]
+            # Unbind the buffer
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+        
+        self.__update_texture(data)
+
+        # Nothing to compare the next frame's tiles with
+        self.__last_frame = None
+        
+        # Unbind the texture
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+class TextureStreamYUV(object):
+    ''' A texture stream for planar YUV 4:2:0 frames (I420, 
+    as produced by most cameras and video decoders), which 
+    are uploaded as they are rather than being converted to
+    RGB first. That's less than half the bytes of RGBA, and
+    the conversion is done for free when the texture is 
+    sampled.
+
+    The Y, U and V planes are uploaded to three single channel
+    textures, which are bound to three texture units. The U and
+    V planes are half the size of the Y plane in each dimension
+    (rounded up). All three planes of a frame go through the
+    same pixel buffer and sync, and otherwise the stream works
+    like a TextureStream2D.
+
+    GLSL_YUV_TO_RGB is a GLSL function, yuv_to_rgb(), that 
+    converts a YUV sample to RGB (ITU-R BT.601, with Y in 
+    [16, 235] and U and V in [16, 240], which is what most video
+    uses). It should be pasted into the fragment shader, which 
+    samples the three textures and calls it, as in 
+    FRAGMENT_SHADER_CODE. The sampler uniforms should be set
+    to the indices of the texture units given at instantiation.
+
+    The class can be used as a texture context manager, in
+    the same way as TextureStream2D.
+    '''
+    GLSL_YUV_TO_RGB = '''
+vec3 yuv_to_rgb(float y, float u, float v)
+{
+    y = 1.1643 * (y - 0.0625);
+    u = u - 0.5;
+    v = v - 0.5;
+
+    return vec3(y + 1.5958 * v,
+                y - 0.39173 * u - 0.81290 * v,
+                y + 2.017 * u);
+}
+'''
+
+    FRAGMENT_SHADER_CODE = '''
+uniform sampler2D y_plane;
+uniform sampler2D u_plane;
+uniform sampler2D v_plane;
+''' + GLSL_YUV_TO_RGB + '''
+void main(void)
+{
+    vec2 coord = gl_TexCoord[0].st;
+    gl_FragColor = vec4(yuv_to_rgb(texture2D(y_plane, coord).r,
+                                   texture2D(u_plane, coord).r,
+                                   texture2D(v_plane, coord).r), 1.0);
+}
+'''
+
+    DROP_NEWEST = DROP_NEWEST
+    REPLACE_PENDING = REPLACE_PENDING
+    BLOCK = BLOCK
+    GROW = GROW
+
+    def __init__(self, size, texture_units, gl_type=GL.GL_UNSIGNED_BYTE,
+            buffers=2, buffer_usage=GL.GL_STREAM_DRAW,
+            min_filter=GL.GL_LINEAR, mag_filter=GL.GL_LINEAR,
+            persistent_mapping=False, backpressure=DROP_NEWEST, 
+            block_timeout=0.1, upload_worker=None):
+        ''' Initialise the texture stream.
+
+        size is a tuple or similarly indexable array with
+        the first entry giving the x-dimension and the second
+        the y-dimension of the Y plane.
+
+        texture_units is a sequence of the three OpenGL texture 
+        units that the Y, U and V planes respectively are bound
+        to. Each should be one of GL.GL_TEXTUREi.
+
+        gl_type is the type of each sample, and should be one
+        of GL.GL_UNSIGNED_BYTE (the default) or, for sources with
+        more than 8 bits per sample, GL.GL_UNSIGNED_SHORT. For 
+        the latter, the samples should use the full 16 bits.
+
+        The rest of the arguments are as for TextureStream2D.
+        The ring can't grow, so GROW is the same as DROP_NEWEST.
+        '''
+        if gl_type == GL.GL_UNSIGNED_BYTE:
+            internal_format = GL.GL_R8
+            dtype = numpy.dtype('uint8')
+        elif gl_type == GL.GL_UNSIGNED_SHORT:
+            internal_format = GL.GL_R16
+            dtype = numpy.dtype('uint16')
+        else:
+            raise ValueError(repr(gl_type) + ' is not a valid type.')
+
+        if len(texture_units) != 3:
+            raise ValueError('There should be three texture units.')
+
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(repr(backpressure) + ' is not a valid '\
+                    'backpressure policy.')
+
+        self.__gl_type = gl_type
+        self.__texture_units = tuple(texture_units)
+        self.__dtype = dtype
+        self.__texture_valid = False
+
+        chroma_size = (-(-size[0]//2), -(-size[1]//2))
+        self.__plane_sizes = (tuple(size[0:2]), chroma_size, chroma_size)
+
+        # Where each plane goes in a pixel buffer
+        self.__plane_offsets = []
+        buffer_size = 0
+        for plane_size in self.__plane_sizes:
+            self.__plane_offsets.append(buffer_size)
+            buffer_size += _aligned(
+                    plane_size[0]*plane_size[1]*dtype.itemsize, 64)
+
+        # Three textures (Y, U and V) for each buffer
+        self.__textures = []
+        for n in range(0, buffers):
+            plane_textures = []
+            for texture_unit, plane_size in \
+                    zip(self.__texture_units, self.__plane_sizes):
+
+                GL.glActiveTexture(texture_unit)
+                texture = GL.glGenTextures(1)
+                GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+
+                GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, internal_format, 
+                        plane_size[0], plane_size[1], 0, 
+                        GL.GL_RED, gl_type, None)
+
+                GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                        GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+                GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                        GL.GL_TEXTURE_MIN_FILTER, min_filter)
+                GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                        GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+                GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                        GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+
+                GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+                plane_textures.append(texture)
+
+            self.__textures.append(plane_textures)
+
+        self.__pixel_buffers = _new_pixel_buffers(buffers, buffer_size,
+                buffer_usage, persistent_mapping)
+
+        self.__ring = _BufferRing(self.__pixel_buffers, buffers, 
+                backpressure, block_timeout)
+
+        self.__bytes_uploaded = 0
+
+        # Initialise every buffer to black
+        self.__clear_textures()
+
+        self.__ring.reset()
+        self.reset_upload_counters()
+
+        self.__ring.upload_worker = upload_worker
+
+    def __clear_textures(self):
+        ''' Fill the textures of every buffer with black, straight
+        from here rather than through the ring, so none can be
+        dropped. glClearTexImage is used if it is available, and
+        otherwise each texture is copied from a black plane.
+        '''
+        black = [16, 128, 128]
+        if self.__dtype.itemsize == 2:
+            black = [each << 8 for each in black]
+
+        clear_texture = bool(GL.glClearTexImage)
+
+        if not clear_texture:
+            _set_unpack_layout(alignment=1)
+
+        for plane_textures in self.__textures:
+            for texture_unit, texture, plane_size, value in zip(
+                    self.__texture_units, plane_textures, 
+                    self.__plane_sizes, black):
+
+                if clear_texture:
+                    GL.glClearTexImage(texture, 0, GL.GL_RED, 
+                            self.__gl_type, 
+                            numpy.array([value], dtype=self.__dtype))
+                else:
+                    plane = numpy.empty(plane_size[::-1], 
+                            dtype=self.__dtype)
+                    plane[...] = value
+
+                    GL.glActiveTexture(texture_unit)
+                    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+                    GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, 
+                            plane_size[0], plane_size[1], GL.GL_RED, 
+                            self.__gl_type, plane)
+                    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        if not clear_texture:
+            _set_unpack_layout()
+
+    def __enter__(self):
+        self.bind_texture()
+
+    def __exit__(self, *args):
+        self.unbind_texture()
+        return False
+
+    def get_persistent_mapping(self):
+        '''Return whether the pixel buffers are persistently
+        mapped. See TextureStream2D.get_persistent_mapping().
+        '''
+        return self.__pixel_buffers.persistent
+
+    def get_upload_counters(self):
+        '''Return a dictionary of counters describing the 
+        uploads so far. The counters are 'bytes_uploaded',
+        'frames_accepted', 'frames_dropped' and 'frames_replaced',
+        as described for TextureStream2D.get_upload_counters().
+        '''
+        counters = dict(self.__ring.counters)
+        counters['bytes_uploaded'] = self.__bytes_uploaded
+        return counters
+
+    def reset_upload_counters(self):
+        '''Set all the counters returned by
+        get_upload_counters() back to zero.
+        '''
+        self.__bytes_uploaded = 0
+        self.__ring.reset_counters()
+
+    def get_texture_validity(self):
+        '''Return whether a frame has ever
+        completed an upload. Useful at initialisation.
+        '''
+        if not self.__texture_valid:
+            with self.__ring.lock:
+                self.__texture_valid = self.__ring.update_read_idx()
+        
+        return self.__texture_valid
+
+    def bind_texture(self):
+        ''' Bind the current Y, U and V textures to their
+        texture units for rendering. Use unbind_texture() or the
+        context manager to release them.
+        '''
+        with self.__ring.lock:
+            self.__ring.update_read_idx()
+            textures = self.__textures[self.__ring.read_idx]
+
+        for texture_unit, texture in zip(self.__texture_units, textures):
+            GL.glActiveTexture(texture_unit)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+
+    def unbind_texture(self):
+        for texture_unit in self.__texture_units:
+            GL.glActiveTexture(texture_unit)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def update_texture(self, y, u, v):
+        '''Update the textures with a frame given as its three
+        planes. Each is a two-dimensional array of rows (so y 
+        has shape (size[1], size[0]), and u and v each have
+        half that, rounded up) of the dtype that corresponds to 
+        gl_type (uint8 or uint16). They needn't be contiguous,
+        so can be views into a single I420 buffer.
+
+        If an attempt is made to upload a frame whilst
+        non of the previous uploads have finished and
+        there are no more remaining buffers that are 
+        currently unused (either for upload or for
+        reading) then what happens depends on the 
+        backpressure policy, as for TextureStream2D.
+        '''
+        planes = (y, u, v)
+
+        for plane, plane_size in zip(planes, self.__plane_sizes):
+            if plane.shape != plane_size[::-1] or plane.dtype != self.__dtype:
+                raise ValueError('Each plane should be an array of %s '\
+                        'with shape (rows, columns) of %s.' % 
+                        (self.__dtype, repr(plane_size[::-1])))
+
+        if self.__ring.queue_upload(self.update_texture, 
+                planes, True) is not None:
+            return None
+
+        if not self.__ring.next_write_idx():
+            return None
+
+        write_idx = self.__ring.write_idx
+
+        pbo_pointer = self.__pixel_buffers.map(write_idx)
+
+        for plane, offset in zip(planes, self.__plane_offsets):
+            if plane.flags.c_contiguous:
+                ctypes.memmove(pbo_pointer + offset, plane.ctypes.data, 
+                        plane.nbytes)
+            else:
+                _mapped_array(pbo_pointer + offset, 
+                        plane.shape, plane.dtype)[...] = plane
+
+            self.__bytes_uploaded += plane.nbytes
+
+        pbo_offset = self.__pixel_buffers.unmap(write_idx)
+
+        # The chroma rows needn't be a multiple of 4 bytes.
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+
+        for texture_unit, texture, plane_size, offset in zip(
+                self.__texture_units, self.__textures[write_idx], 
+                self.__plane_sizes, self.__plane_offsets):
+
+            GL.glActiveTexture(texture_unit)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+            
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, 
+                    plane_size[0], plane_size[1], GL.GL_RED, 
+                    self.__gl_type, ctypes.c_void_p(pbo_offset + offset))
+
+            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        self.__ring.finish_write()
+
+class TextureStream3D(object):
+    ''' A texture stream for a volume, held in a single 3D 
+    texture (or 2D array texture; see TextureStreamArray), that
+    is updated a slice, or a slab of slices, at a time. This 
+    saves having a stream (and a texture unit) per slice, and
+    lets just the slices that have changed be uploaded.
+
+    Unlike TextureStream2D, there is just the one texture, as
+    volumes tend to be big. The updates go through a ring of
+    pixel buffers, each big enough for max_slab_depth slices,
+    with a sync for each upload, so the pixel buffers are 
+    only reused once the card is done with them and the 
+    backpressure policy applies when they are all busy. GL 
+    makes sure rendering sees the updates in the order they
+    were made, so a slab is never seen half uploaded, but the
+    rendering may have to wait for an upload to finish.
+
+    The class can be used as a texture context manager, in
+    the same way as TextureStream2D.
+    '''
+    DROP_NEWEST = DROP_NEWEST
+    BLOCK = BLOCK
+    GROW = GROW
+
+    def __init__(self, size, gl_format, gl_type, gl_internal_format,
+            texture_unit, target=GL.GL_TEXTURE_3D, max_slab_depth=1, 
+            buffers=2, buffer_usage=GL.GL_STREAM_DRAW,
+            min_filter=GL.GL_NEAREST, mag_filter=GL.GL_NEAREST,
+            persistent_mapping=False, backpressure=DROP_NEWEST, 
+            block_timeout=0.1, upload_worker=None):
+        ''' Initialise the texture stream.
+
+        size is a tuple or similarly indexable array giving the
+        x, y and z dimensions of the volume. For an array 
+        texture, z is the number of layers.
+
+        target is GL.GL_TEXTURE_3D or GL.GL_TEXTURE_2D_ARRAY.
+
+        max_slab_depth is the largest number of slices that can
+        be updated at once, which sets the size of each pixel 
+        buffer.
+
+        The rest of the arguments are as for TextureStream2D,
+        except that the ring of pixel buffers can't grow, so 
+        GROW is the same as DROP_NEWEST, and REPLACE_PENDING
+        can't be used, as each update is to a different slab,
+        so replacing one would lose data.
+        '''
+        if not GL_TYPES.has_key(gl_type):
+            raise ValueError(repr(gl_type) + ' is not a valid type.')
+        
+        if not GL_FORMATS.has_key(gl_format):
+            raise ValueError(repr(gl_format) + ' is not a valid format.')
+
+        if target not in (GL.GL_TEXTURE_3D, GL.GL_TEXTURE_2D_ARRAY):
+            raise ValueError(repr(target) + ' is not a valid target.')
+
+        if backpressure not in (DROP_NEWEST, BLOCK, GROW):
+            raise ValueError(repr(backpressure) + ' is not a valid '\
+                    'backpressure policy for a volume.')
+
+        self.__size = tuple(size[0:3])
+        self.__gl_format = gl_format
+        self.__gl_type = gl_type
+        self.__target = target
+        self.__texture_unit = texture_unit
+        self.__max_slab_depth = max_slab_depth
+        self.__texture_valid = False
+
+        self.__bytes_per_texel = _bytes_per_texel(gl_type, gl_format)
+        self.__bytes_uploaded = 0
+
+        GL.glActiveTexture(self.__texture_unit)
+        self.__texture = GL.glGenTextures(1)
+        GL.glBindTexture(self.__target, self.__texture)
+
+        GL.glTexImage3D(self.__target, 0, gl_internal_format, 
+                self.__size[0], self.__size[1], self.__size[2], 0, 
+                gl_format, gl_type, None)
+
+        GL.glTexParameterf(self.__target, \
+                GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+        GL.glTexParameterf(self.__target, \
+                GL.GL_TEXTURE_MIN_FILTER, min_filter)
+        GL.glTexParameterf(self.__target, \
+                GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameterf(self.__target, \
+                GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameterf(self.__target, \
+                GL.GL_TEXTURE_WRAP_R, GL.GL_CLAMP_TO_EDGE)
+
+        # Start with an empty volume, a slice at a time. The rows
+        # of the slice are tightly packed.
+        zero_slice = numpy.zeros(
+                self.__size[0]*self.__size[1]*self.__bytes_per_texel, 
+                dtype='uint8')
+
+        _set_unpack_layout(alignment=1)
+
+        for z in range(0, self.__size[2]):
+            GL.glTexSubImage3D(self.__target, 0, 0, 0, z, 
+                    self.__size[0], self.__size[1], 1, 
+                    gl_format, gl_type, zero_slice)
+
+        _set_unpack_layout()
+
+        GL.glBindTexture(self.__target, 0)
+
+        buffer_size = (self.__size[0]*self.__size[1]*max_slab_depth*
+                self.__bytes_per_texel)
+
+        self.__pixel_buffers = _new_pixel_buffers(buffers, buffer_size,
+                buffer_usage, persistent_mapping)
+
+        # There's only the one texture, so nothing to grow
+        if backpressure == GROW:
+            ring_backpressure = DROP_NEWEST
+        else:
+            ring_backpressure = backpressure
+
+        self.__ring = _BufferRing(self.__pixel_buffers, buffers, 
+                ring_backpressure, block_timeout)
+
+        self.__ring.reset()
+
+        self.__ring.upload_worker = upload_worker
+
+    def __enter__(self):
+        self.bind_texture()
+
+    def __exit__(self, *args):
+        self.unbind_texture()
+        return False
+
+    def get_persistent_mapping(self):
+        '''Return whether the pixel buffers are persistently
+        mapped. See TextureStream2D.get_persistent_mapping().
+        '''
+        return self.__pixel_buffers.persistent
+
+    def get_upload_counters(self):
+        '''Return a dictionary of counters describing the 
+        uploads so far. The counters are 'bytes_uploaded',
+        'frames_accepted', 'frames_dropped' and 'frames_replaced',
+        as described for TextureStream2D.get_upload_counters(),
+        with each update of a slab counting as a frame.
+        '''
+        counters = dict(self.__ring.counters)
+        counters['bytes_uploaded'] = self.__bytes_uploaded
+        return counters
+
+    def reset_upload_counters(self):
+        '''Set all the counters returned by
+        get_upload_counters() back to zero.
+        '''
+        self.__bytes_uploaded = 0
+        self.__ring.reset_counters()
+
+    def get_texture_validity(self):
+        '''Return whether an update has ever
+        completed its upload.
+        '''
+        if not self.__texture_valid:
+            with self.__ring.lock:
+                self.__texture_valid = self.__ring.update_read_idx()
+        
+        return self.__texture_valid
+
+    def bind_texture(self):
+        ''' Bind the texture to the texture unit for rendering.
+        Use unbind_texture() or the context manager to release it.
+        '''
+        # Let the ring free up the buffers that are done with
+        with self.__ring.lock:
+            if self.__ring.update_read_idx():
+                self.__texture_valid = True
+
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(self.__target, self.__texture)
+
+    def unbind_texture(self):
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(self.__target, 0)
+
+    def update_slices(self, data, z, x=0, y=0):
+        '''Update a slab of slices of the volume, starting at
+        slice (or layer) z, with a passed data array.
+
+        The data should be a four-dimensional array of shape
+        (D, N, M, P) (c-ordering), where D is the number of slices
+        (at most max_slab_depth), N and M are the dimensions of 
+        each slice and P is the number of array elements per 
+        texel, as described for TextureStream2D.update_texture().
+        A two or three-dimensional array is taken to be a single
+        slice, so a slab of single element texels should be given
+        with P as 1.
+        The slices are written with their first texel at column
+        x and row y of the volume. The data needn't be 
+        contiguous.
+
+        If the slab does not fit in the volume or is deeper
+        than max_slab_depth, an exception is raised.
+
+        If an attempt is made to upload a slab whilst all the
+        pixel buffers are busy, then what happens depends on the
+        backpressure policy.
+        '''
+        if data.ndim < 4:
+            # A single slice
+            slab = data[numpy.newaxis]
+        else:
+            slab = data
+
+        depth, rows, cols = slab.shape[0:3]
+        texel_elements = int(numpy.prod(slab.shape[3:]))
+
+        if not slab.itemsize*texel_elements == self.__bytes_per_texel:
+            raise ValueError('The number of bytes per texel for the '\
+                    'passed data does not agree with that expected by '\
+                    'the previously given GL type and format: ' \
+                    + repr(self.__gl_type) + ', ' + repr(self.__gl_format))
+
+        if depth > self.__max_slab_depth:
+            raise ValueError('The data has more slices than '\
+                    'max_slab_depth.')
+
+        if (x < 0 or y < 0 or z < 0 or x + cols > self.__size[0] or 
+                y + rows > self.__size[1] or z + depth > self.__size[2]):
+            raise ValueError('The data array does not fit in the volume '\
+                    'at the given offset.')
+
+        if self.__ring.queue_upload(self.update_slices, 
+                (data, z, x, y)) is not None:
+            return None
+
+        if not self.__ring.next_write_idx():
+            return None
+
+        write_idx = self.__ring.write_idx
+
+        pbo_pointer = self.__pixel_buffers.map(write_idx)
+
+        # As with _copy_to_pixel_buffer(), byte swapped data is 
+        # swapped back by GL if each element is a component, and
+        # otherwise by numpy as it is copied.
+        swapped = not slab.dtype.isnative and slab.itemsize > 1
+        swap_bytes = swapped and (
+                slab.itemsize == GL_TYPES[self.__gl_type][0])
+
+        if slab.flags.c_contiguous and (swap_bytes or not swapped):
+            ctypes.memmove(pbo_pointer, slab.ctypes.data, slab.nbytes)
+        else:
+            swap_bytes = False
+            _mapped_array(pbo_pointer, slab.shape, 
+                    slab.dtype.newbyteorder('='))[...] = slab
+
+        pbo_offset = self.__pixel_buffers.unmap(write_idx)
+
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(self.__target, self.__texture)
+
+        # The rows are tightly packed
+        _set_unpack_layout(0, 1, swap_bytes)
+
+        GL.glTexSubImage3D(self.__target, 0, x, y, z, 
+                cols, rows, depth, self.__gl_format, self.__gl_type, 
+                ctypes.c_void_p(pbo_offset))
+
+        _set_unpack_layout()
+
+        GL.glBindTexture(self.__target, 0)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        self.__bytes_uploaded += slab.nbytes
+
+        self.__ring.finish_write()
+
+class TextureStreamArray(TextureStream3D):
+    ''' A TextureStream3D that uses a 2D array texture 
+    (GL_TEXTURE_2D_ARRAY), so each slice is a separate layer
+    that is sampled with sampler2DArray, without any filtering
+    between layers. Useful for stacks of frames.
+    '''
+    def __init__(self, size, gl_format, gl_type, gl_internal_format,
+            texture_unit, **kwargs):
+        ''' As for TextureStream3D, with size giving the x and y
+        dimensions of each layer and the number of layers.
+        '''
+        kwargs['target'] = GL.GL_TEXTURE_2D_ARRAY
+        super(TextureStreamArray, self).__init__(size, gl_format, gl_type,
+                gl_internal_format, texture_unit, **kwargs)
+
+class TextureAtlasStream(object):
+    ''' A texture stream that packs lots of small images into
+    one big texture, so they share a texture unit and can all be
+    drawn with a single bind. Each image is given its own
+    rectangle in the atlas, and its texture coordinates within
+    the atlas are returned by get_uv_rect().
+
+    Images are added, updated and removed by key. Nothing is
+    uploaded until upload_pending() is called (which
+    bind_texture() does), when all the images that have been
+    added or updated since the last upload are copied into one
+    mapped pixel buffer and uploaded in one batch, with a single
+    sync. As with TextureStream3D, there is just the one texture,
+    with a ring of pixel buffers that are reused once the card is
+    done with them. If they are all busy, the images stay pending
+    until the next upload.
+
+    Removed images give their rectangles back to the atlas, to be
+    reused by later images.
+
+    The class can be used as a texture context manager, in the
+    same way as TextureStream2D.
+    '''
+    def __init__(self, size, gl_format, gl_type, gl_internal_format,
+            texture_unit, padding=1, buffers=2,
+            buffer_usage=GL.GL_STREAM_DRAW, min_filter=GL.GL_NEAREST,
+            mag_filter=GL.GL_NEAREST, persistent_mapping=False,
+            backpressure=DROP_NEWEST, block_timeout=0.1):
+        ''' Initialise the atlas.
+
+        size is a tuple or similarly indexable array giving the
+        x and y dimensions of the atlas texture.
+
+        padding is the number of empty texels left around each
+        image, so that linear filtering at the edge of an image
+        doesn't pick up its neighbours. The padding is cleared
+        when an image is placed, so it doesn't pick up an image
+        that was removed from there either.
+
+        backpressure says what upload_pending() does when all the
+        pixel buffers are busy, either DROP_NEWEST, in which case
+        the images are left pending for the next upload, or BLOCK,
+        in which case it waits up to block_timeout seconds for the
+        oldest buffer to be free before leaving them pending.
+
+        The rest of the arguments are as for TextureStream2D.
+        '''
+        if not GL_TYPES.has_key(gl_type):
+            raise ValueError(repr(gl_type) + ' is not a valid type.')
+
+        if not GL_FORMATS.has_key(gl_format):
+            raise ValueError(repr(gl_format) + ' is not a valid format.')
+
+        if backpressure not in (DROP_NEWEST, BLOCK):
+            raise ValueError(repr(backpressure) + ' is not a valid '\
+                    'backpressure policy for an atlas.')
+
+        self.__size = tuple(size[0:2])
+        self.__gl_format = gl_format
+        self.__gl_type = gl_type
+        self.__texture_unit = texture_unit
+        self.__padding = padding
+        self.__texture_valid = False
+
+        self.__bytes_per_texel = _bytes_per_texel(gl_type, gl_format)
+        self.__bytes_uploaded = 0
+
+        # key: (x, y, width, height) of the image in the atlas
+        self.__regions = {}
+        # key: data waiting to be uploaded, in the order added
+        self.__pending = {}
+        self.__pending_order = []
+        # The keys of the images whose padding hasn't been cleared
+        self.__unpadded = set()
+
+        self.__packer = _RectanglePacker(self.__size[0], self.__size[1])
+
+        GL.glActiveTexture(self.__texture_unit)
+        self.__texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.__texture)
+
+        zeros = numpy.zeros(
+                self.__size[0]*self.__size[1]*self.__bytes_per_texel,
+                dtype='uint8')
+
+        # The rows of zeros are tightly packed
+        _set_unpack_layout(alignment=1)
+
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, gl_internal_format,
+                self.__size[0], self.__size[1], 0, gl_format,
+                gl_type, zeros)
+
+        _set_unpack_layout()
+
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MIN_FILTER, min_filter)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        # Each pixel buffer can hold the whole atlas, so a batch
+        # of images only needs splitting if the alignment
+        # between them pushes it over.
+        self.__buffer_size = zeros.nbytes
+
+        self.__pixel_buffers = _new_pixel_buffers(buffers,
+                self.__buffer_size, buffer_usage, persistent_mapping)
+
+        self.__ring = _BufferRing(self.__pixel_buffers, buffers,
+                backpressure, block_timeout)
+
+        self.__ring.reset()
+
+    def __enter__(self):
+        self.bind_texture()
+
+    def __exit__(self, *args):
+        self.unbind_texture()
+        return False
+
+    def __contains__(self, key):
+        return key in self.__regions
+
+    def __len__(self):
+        return len(self.__regions)
+
+    def keys(self):
+        '''Return a list of the keys of the images in the atlas.
+        '''
+        return self.__regions.keys()
+
+    def add_image(self, key, data):
+        '''Add the image in data to the atlas under key, and
+        return its UV rectangle, as given by get_uv_rect().
+
+        data is an array as described for
+        TextureStream2D.update_texture(), and needn't be
+        contiguous. It is uploaded by the next upload_pending(),
+        and is held by reference rather than copied until then,
+        so it shouldn't be changed in the meantime.
+
+        If key is already in the atlas, the image it refers to
+        is replaced. If there is no room for the image,
+        TextureAtlasFull is raised.
+        '''
+        self.__check_data(data)
+
+        height, width = data.shape[0:2]
+
+        if key in self.__regions:
+            if self.__regions[key][2:4] == (width, height):
+                return self.update_image(key, data)
+
+            self.remove_image(key)
+
+        padding = self.__padding
+        position = self.__packer.allocate(
+                width + 2*padding, height + 2*padding)
+
+        if position is None:
+            raise TextureAtlasFull('There is no room in the atlas for '\
+                    'an image of size ' + repr((width, height)) + '.')
+
+        self.__regions[key] = (position[0] + padding,
+                position[1] + padding, width, height)
+
+        if padding:
+            self.__unpadded.add(key)
+
+        self.__set_pending(key, data)
+
+        return self.get_uv_rect(key)
+
+    def update_image(self, key, data):
+        '''Replace the image under key with the image in data,
+        which must be the same size. The UV rectangle of the image
+        is returned, and is unchanged. As with add_image(), data
+        is held by reference until the next upload_pending().
+
+        A KeyError is raised if key is not in the atlas.
+        '''
+        self.__check_data(data)
+
+        x, y, width, height = self.__regions[key]
+
+        if not data.shape[0:2] == (height, width):
+            raise ValueError('The data array is not the same size as '\
+                    'the image it replaces.')
+
+        self.__set_pending(key, data)
+
+        return self.get_uv_rect(key)
+
+    def remove_image(self, key):
+        '''Remove the image under key from the atlas, so its
+        rectangle can be reused. A KeyError is raised if key is
+        not in the atlas.
+        '''
+        x, y, width, height = self.__regions.pop(key)
+
+        if key in self.__pending:
+            del self.__pending[key]
+            self.__pending_order.remove(key)
+
+        self.__unpadded.discard(key)
+
+        padding = self.__padding
+        self.__packer.free((x - padding, y - padding,
+            width + 2*padding, height + 2*padding))
+
+    def get_region(self, key):
+        '''Return the rectangle of the image under key in the
+        atlas as a tuple of (x, y, width, height) in texels.
+        '''
+        return self.__regions[key]
+
+    def get_uv_rect(self, key):
+        '''Return the rectangle of the image under key in
+        texture coordinates, as a tuple of (u0, v0, u1, v1).
+        (u0, v0) is the texture coordinate of the corner of the
+        first texel of the first row of the image, and (u1, v1)
+        that of the opposite corner.
+        '''
+        x, y, width, height = self.__regions[key]
+        atlas_width = float(self.__size[0])
+        atlas_height = float(self.__size[1])
+
+        return (x/atlas_width, y/atlas_height,
+                (x + width)/atlas_width, (y + height)/atlas_height)
+
+    def get_pending_count(self):
+        '''Return the number of images waiting to be uploaded.
+        '''
+        return len(self.__pending_order)
+
+    def get_upload_counters(self):
+        '''Return a dictionary of counters describing the
+        uploads so far. The counters are 'bytes_uploaded',
+        'frames_accepted' and 'frames_dropped' as described for
+        TextureStream2D.get_upload_counters(), with each batch
+        counting as a frame. A dropped batch is left pending.
+        '''
+        counters = dict(self.__ring.counters)
+        del counters['frames_replaced']
+        counters['bytes_uploaded'] = self.__bytes_uploaded
+        return counters
+
+    def reset_upload_counters(self):
+        '''Set all the counters returned by
+        get_upload_counters() back to zero.
+        '''
+        self.__bytes_uploaded = 0
+        self.__ring.reset_counters()
+
+    def get_texture_validity(self):
+        '''Return whether a batch has ever
+        completed its upload.
+        '''
+        if not self.__texture_valid:
+            with self.__ring.lock:
+                self.__texture_valid = self.__ring.update_read_idx()
+
+        return self.__texture_valid
+
+    def bind_texture(self):
+        ''' Upload any pending images and bind the atlas to
+        the texture unit for rendering. Use unbind_texture() or
+        the context manager to release it.
+        '''
+        self.upload_pending()
+
+        with self.__ring.lock:
+            if self.__ring.update_read_idx():
+                self.__texture_valid = True
+
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.__texture)
+
+    def unbind_texture(self):
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def upload_pending(self):
+        '''Upload all the images that have been added or updated
+        since the last upload, through a single pixel buffer.
+
+        Return True if everything pending was uploaded, or False
+        if some images are still pending because the pixel
+        buffers were busy.
+        '''
+        while self.__pending_order:
+            if not self.__ring.next_write_idx():
+                return False
+
+            self.__upload_batch()
+
+        return True
+
+    def __set_pending(self, key, data):
+        ''' Make data the data waiting to be uploaded for key.
+        '''
+        if key not in self.__pending:
+            self.__pending_order.append(key)
+
+        self.__pending[key] = data
+
+    def __check_data(self, data):
+        ''' Check data has the bytes per texel of the atlas.
+        '''
+        if data.ndim > 2:
+            texel_elements = int(numpy.prod(data.shape[2:]))
+        else:
+            texel_elements = 1
+
+        if not data.itemsize*texel_elements == self.__bytes_per_texel:
+            raise ValueError('The number of bytes per texel for the '\
+                    'passed data does not agree with that expected by '\
+                    'the previously given GL type and format: ' \
+                    + repr(self.__gl_type) + ', ' + repr(self.__gl_format))
+
+    def __padding_strips(self, region):
+        ''' Return the rectangles of the padding around the
+        image at region, as (x, y, width, height) tuples.
+        '''
+        x, y, width, height = region
+        padding = self.__padding
+
+        return [(x - padding, y - padding, width + 2*padding, padding),
+                (x - padding, y + height, width + 2*padding, padding),
+                (x - padding, y, padding, height),
+                (x + width, y, padding, height)]
+
+    def __upload_batch(self):
+        ''' Copy as many pending images as fit into the pixel
+        buffer at the ring's write index and upload them.
+        '''
+        write_idx = self.__ring.write_idx
+
+        pbo_pointer = self.__pixel_buffers.map(write_idx)
+
+        batch = []
+        offset = 0
+        uploaded = 0
+        while self.__pending_order:
+            key = self.__pending_order[0]
+            data = self.__pending[key]
+
+            # The padding of a newly placed image might still hold
+            # an image that was removed from there, so it's cleared 
+            # from a run of zeros after the image, long enough for 
+            # the longest strip.
+            strips = []
+            if key in self.__unpadded:
+                strips = self.__padding_strips(self.__regions[key])
+
+            clear_bytes = max([0] + [width*height 
+                for x, y, width, height in strips])*self.__bytes_per_texel
+
+            if (offset + _aligned(data.nbytes) + clear_bytes > 
+                    self.__buffer_size):
+                break
+
+            copied, layout = _copy_to_pixel_buffer(pbo_pointer + offset,
+                    data, self.__bytes_per_texel,
+                    self.__buffer_size - offset, GL_TYPES[self.__gl_type][0])
+
+            batch.append((self.__regions[key], offset, layout))
+
+            offset += _aligned(copied)
+            uploaded += copied
+
+            if strips:
+                ctypes.memset(pbo_pointer + offset, 0, clear_bytes)
+
+                for strip in strips:
+                    batch.append((strip, offset, (0, 1, False)))
+
+                offset += _aligned(clear_bytes)
+                uploaded += clear_bytes
+                self.__unpadded.discard(key)
+
+            del self.__pending[key]
+            self.__pending_order.pop(0)
+
+        pbo_offset = self.__pixel_buffers.unmap(write_idx)
+
+        GL.glActiveTexture(self.__texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.__texture)
+
+        for (x, y, width, height), offset, layout in batch:
+            _set_unpack_layout(*layout)
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, x, y, width, height,
+                    self.__gl_format, self.__gl_type,
+                    ctypes.c_void_p(pbo_offset + offset))
+
+        _set_unpack_layout()
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        self.__bytes_uploaded += uploaded
+
+        self.__ring.finish_write()
+
+# The fragment shader that draws a ColormapStream. The image is
+# sampled with gl_TexCoord[0], as in demo.py.
+COLORMAP_FRAGMENT_SHADER = '''
+uniform sampler2D image;
+uniform sampler1D colormap;
+
+// The value at the middle of the colormap, and the range of
+// values it covers, as sampled from the image.
+uniform float level;
+uniform float window;
+
+// Maps 0 to 1 on to the centres of the first and last entries
+// of the colormap.
+uniform float colormap_scale;
+uniform float colormap_offset;
+
+void main(void)
+{
+    float value = texture2D(image, gl_TexCoord[0].st).r;
+    float position = clamp((value - level)/window + 0.5, 0.0, 1.0);
+
+    gl_FragColor = texture1D(colormap, 
+            position*colormap_scale + colormap_offset);
+}
+'''
+
+# The internal formats used by ColormapStream for its formats and
+# types, and the largest value of each type, which is what the
+# shader sees as 1.0. The floats use those of GL_INTERNAL_FORMATS.
+COLORMAP_INTERNAL_FORMATS = {
+        (GL.GL_RED, GL.GL_UNSIGNED_BYTE):        GL.GL_R8,
+        (GL.GL_RED, GL.GL_UNSIGNED_SHORT):       GL.GL_R16,
+        (GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE):  GL.GL_LUMINANCE8,
+        (GL.GL_LUMINANCE, GL.GL_UNSIGNED_SHORT): GL.GL_LUMINANCE16}
+
+COLORMAP_INTERNAL_FORMATS.update((key, GL_INTERNAL_FORMATS[key]) 
+        for key in ((GL.GL_RED, GL.GL_FLOAT), (GL.GL_RED, GL.GL_HALF_FLOAT)))
+
+COLORMAP_TYPE_RANGES = {GL.GL_UNSIGNED_BYTE: 255.0,
+        GL.GL_UNSIGNED_SHORT: 65535.0,
+        GL.GL_FLOAT: 1.0,
+        GL.GL_HALF_FLOAT: 1.0}
+
+class ColormapStream(object):
+    ''' A texture stream for single channel data, such as from
+    a sensor, that is drawn through a colormap. The data is
+    uploaded as it is, at 8 or 16 bits or as floats, by a
+    TextureStream2D, and the colormap is kept in a 1D texture
+    that is looked up by a fragment shader (FRAGMENT_SHADER), with
+    the data scaled by a level and window first. Changing the
+    colormap only uploads the colormap, and changing the level
+    or window just changes the uniforms, so the data is never
+    uploaded again, and it never has to be expanded to RGBA.
+
+    To draw, compile FRAGMENT_SHADER into the program, bind the
+    textures (or use the instance as a context manager, as with
+    TextureStream2D), and with the program in use, call
+    set_uniforms() with it. Or, set the uniforms given by
+    get_uniform_values() in some other way, such as with
+    QGLShaderProgram.setUniformValue().
+    '''
+    FRAGMENT_SHADER = COLORMAP_FRAGMENT_SHADER
+
+    def __init__(self, size, gl_type, texture_unit, colormap_texture_unit,
+            gl_format=GL.GL_RED, colormap=None, level=None, window=None,
+            **kwargs):
+        ''' Initialise the stream.
+
+        size is the x and y dimensions of the data, as for
+        TextureStream2D.
+
+        gl_type is the type of the data: GL.GL_UNSIGNED_BYTE,
+        GL.GL_UNSIGNED_SHORT, GL.GL_FLOAT or GL.GL_HALF_FLOAT. The
+        data is stored at that width, with the internal format from
+        COLORMAP_INTERNAL_FORMATS. Float data can be passed to a
+        GL.GL_HALF_FLOAT stream, and is converted as it is copied
+        (see TextureStream2D.update_texture()).
+
+        texture_unit is the texture unit for the data and
+        colormap_texture_unit that for the colormap.
+
+        gl_format is GL.GL_RED, or GL.GL_LUMINANCE for GL versions
+        without GL_RED textures (in which case floats can't be
+        used).
+
+        colormap is as passed to set_colormap(), and defaults to
+        a grey scale.
+
+        level and window are as passed to set_level_window(), and
+        default to covering the whole range of the type (0 to 1
+        for floats).
+
+        Any other keyword arguments are passed on to the
+        TextureStream2D that uploads the data.
+        '''
+        if (gl_format, gl_type) not in COLORMAP_INTERNAL_FORMATS:
+            raise ValueError(repr(gl_format) + ' and ' + repr(gl_type) + 
+                    ' are not a valid format and type for a colormap '\
+                    'stream.')
+
+        self.__texture_unit = texture_unit
+        self.__colormap_texture_unit = colormap_texture_unit
+        self.__type_range = COLORMAP_TYPE_RANGES[gl_type]
+
+        self.__texture_stream = TextureStream2D(size, gl_format, gl_type,
+                COLORMAP_INTERNAL_FORMATS[(gl_format, gl_type)], 
+                texture_unit, **kwargs)
+
+        GL.glActiveTexture(colormap_texture_unit)
+        self.__colormap_texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, self.__colormap_texture)
+
+        GL.glTexParameterf(GL.GL_TEXTURE_1D, \
+                GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameterf(GL.GL_TEXTURE_1D, \
+                GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexParameterf(GL.GL_TEXTURE_1D, \
+                GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+
+        self.__colormap_length = 0
+        self.__uniform_locations = {}
+
+        if colormap is None:
+            colormap = numpy.repeat(numpy.arange(256, dtype='uint8'), 
+                    3).reshape(256, 3)
+
+        self.set_colormap(colormap)
+
+        if level is None:
+            level = self.__type_range/2
+
+        if window is None:
+            window = self.__type_range
+
+        self.set_level_window(level, window)
+
+    def __enter__(self):
+        self.bind_texture()
+
+    def __exit__(self, *args):
+        self.unbind_texture()
+        return False
+
+    def get_texture_stream(self):
+        '''Return the TextureStream2D that uploads the data, for
+        its counters, stats and so on.
+        '''
+        return self.__texture_stream
+
+    def get_texture_validity(self):
+        '''Return whether the data has ever completed an upload.
+        '''
+        return self.__texture_stream.get_texture_validity()
+
+    def update_texture(self, data):
+        '''Upload a frame of data, which should be a (y, x)
+        array of the type given at instantiation (or (y, x, 1)).
+        See TextureStream2D.update_texture().
+        '''
+        return self.__texture_stream.update_texture(data)
+
+    def bind_texture(self):
+        '''Bind the data and the colormap to their texture units
+        for rendering.
+        '''
+        self.__texture_stream.bind_texture()
+
+        GL.glActiveTexture(self.__colormap_texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, self.__colormap_texture)
+
+    def unbind_texture(self):
+        self.__texture_stream.unbind_texture()
+
+        GL.glActiveTexture(self.__colormap_texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+
+    def set_colormap(self, colormap):
+        '''Set the colormap, from an array of shape (N, 3) or
+        (N, 4) of RGB or RGBA colours, either as unsigned bytes or
+        as floats from 0 to 1. The first colour is for the bottom
+        of the window and the last for the top, with the colours
+        in between interpolated. Only the colormap is uploaded.
+        '''
+        colormap = numpy.asarray(colormap)
+
+        if colormap.ndim != 2 or colormap.shape[1] not in (3, 4):
+            raise ValueError('The colormap should be an array of shape '\
+                    '(N, 3) or (N, 4).')
+
+        if colormap.dtype.kind == 'f':
+            colormap = numpy.clip(colormap*255 + 0.5, 0, 255)
+
+        colors = numpy.empty((len(colormap), 4), dtype='uint8')
+        colors[:, 3] = 255
+        colors[:, 0:colormap.shape[1]] = colormap
+
+        GL.glActiveTexture(self.__colormap_texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, self.__colormap_texture)
+
+        if len(colors) == self.__colormap_length:
+            GL.glTexSubImage1D(GL.GL_TEXTURE_1D, 0, 0, len(colors),
+                    GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, colors)
+        else:
+            GL.glTexImage1D(GL.GL_TEXTURE_1D, 0, GL.GL_RGBA8, len(colors),
+                    0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, colors)
+
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+
+        self.__colormap_length = len(colors)
+
+    def set_level_window(self, level, window):
+        '''Set the data value at the middle of the colormap
+        (level) and the range of values the colormap covers
+        (window), in the units of the data: 0 to 255 for unsigned
+        bytes, 0 to 65535 for unsigned shorts and as they are for
+        floats. Values outside the window get the end colours.
+        This just changes the uniforms.
+        '''
+        if not window > 0:
+            raise ValueError('The window must be positive.')
+
+        self.__level = level
+        self.__window = window
+
+    def get_level_window(self):
+        '''Return the level and window as a tuple.
+        '''
+        return (self.__level, self.__window)
+
+    def get_uniform_values(self):
+        '''Return a dictionary of the values of the uniforms of
+        FRAGMENT_SHADER, by name.
+        '''
+        return {'image': self.__texture_unit - GL.GL_TEXTURE0,
+                'colormap': self.__colormap_texture_unit - GL.GL_TEXTURE0,
+                'level': self.__level/self.__type_range,
+                'window': self.__window/self.__type_range,
+                'colormap_scale': 
+                    (self.__colormap_length - 1.0)/self.__colormap_length,
+                'colormap_offset': 0.5/self.__colormap_length}
+
+    def set_uniforms(self, program):
+        '''Set the uniforms of FRAGMENT_SHADER in program (the GL
+        name of the program, such as from
+        QGLShaderProgram.programId()), which should be in use.
+        '''
+        for name, value in self.get_uniform_values().items():
+            key = (program, name)
+
+            if key not in self.__uniform_locations:
+                self.__uniform_locations[key] = \
+                        GL.glGetUniformLocation(program, name)
+
+            location = self.__uniform_locations[key]
+
+            if name in ('image', 'colormap'):
+                GL.glUniform1i(location, value)
+            else:
+                GL.glUniform1f(location, value)
+
+class TextureReadStream2D(object):
+    ''' The reverse of TextureStream2D: a stream of frames read
+    back from the GL into numpy arrays, for recording or analysis,
+    without stalling the pipeline as a plain glReadPixels does.
+
+    read_frame() starts reading the current read framebuffer (such
+    as what has just been rendered) into the next of a ring of
+    pixel pack buffers, with a fence after it, and returns straight
+    away. A frame or two later, once its fence has been signalled,
+    the frame can be had from get_frame(), as a new numpy array, or
+    from mapped_frame(), as a view of the mapped buffer with nothing
+    copied. The frames come out in the order they were read.
+
+    Nothing ever waits for the card. If no frame has finished
+    being read, get_frame() returns None, and if every buffer is in
+    use, what read_frame() does depends on the backpressure policy.
+
+    The frames have their first row at the bottom, as GL has them.
+    Everything must be done on the rendering thread, with the
+    rendering context current.
+    '''
+    DROP_NEWEST = DROP_NEWEST
+    REPLACE_PENDING = REPLACE_PENDING
+
+    def __init__(self, size, gl_format, gl_type, buffers=3,
+            buffer_usage=GL.GL_STREAM_READ, backpressure=DROP_NEWEST):
+        ''' Initialise the read stream.
+
+        size is a tuple or similarly indexable array giving the
+        x and y dimensions of the frames that are read.
+
+        gl_format and gl_type are the format and type the frames
+        are read as, as passed to glReadPixels. They are checked
+        against GL_FORMATS and GL_TYPES in the same way as for
+        TextureStream2D. The frames are given as arrays of shape
+        (y, x, P), where P is the number of components of
+        gl_format, with the dtype in GL_DTYPES, or of shape (y, x)
+        of unsigned integers if gl_type packs a whole texel.
+
+        buffers is the number of pixel pack buffers, so the most
+        frames that can be in hand at once, either being read or
+        waiting to be fetched.
+
+        buffer_usage is the usage hint for the pixel buffers.
+
+        backpressure says what read_frame() does when every
+        buffer is in use: with DROP_NEWEST, the new frame isn't
+        read, and with REPLACE_PENDING, the oldest frame that has
+        been read but not fetched is thrown away to make room,
+        unless they are all still being read, in which case the
+        new frame isn't read either.
+        '''
+        if not GL_TYPES.has_key(gl_type):
+            raise ValueError(repr(gl_type) + ' is not a valid type.')
+
+        if not GL_FORMATS.has_key(gl_format):
+            raise ValueError(repr(gl_format) + ' is not a valid format.')
+
+        if backpressure not in (DROP_NEWEST, REPLACE_PENDING):
+            raise ValueError(repr(backpressure) + ' is not a valid '\
+                    'backpressure policy for a read stream.')
+
+        if buffers < 1:
+            raise ValueError('There must be at least one buffer.')
+
+        self.__size = tuple(size[0:2])
+        self.__gl_format = gl_format
+        self.__gl_type = gl_type
+        self.__backpressure = backpressure
+
+        bytes_per_texel = _bytes_per_texel(gl_type, gl_format)
+        self.__buffer_size = self.__size[0]*self.__size[1]*bytes_per_texel
+
+        if GL_TYPES[gl_type][1]:
+            self.__dtype = numpy.dtype(GL_DTYPES[gl_type])
+            self.__shape = (self.__size[1], self.__size[0],
+                    GL_FORMATS[gl_format])
+        else:
+            self.__dtype = numpy.dtype('uint%d' % (8*bytes_per_texel))
+            self.__shape = (self.__size[1], self.__size[0])
+
+        self.__pixel_buffers = GL.glGenBuffers(buffers)
+        if buffers == 1:
+            self.__pixel_buffers = [self.__pixel_buffers]
+        else:
+            self.__pixel_buffers = list(self.__pixel_buffers)
+
+        for pixel_buffer in self.__pixel_buffers:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pixel_buffer)
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, self.__buffer_size,
+                    None, buffer_usage)
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        # Each buffer is in one of these. The frames being read
+        # are kept with their syncs, in the order they were read.
+        self.__free = collections.deque(range(buffers))
+        self.__reading = collections.deque()
+        self.__finished = collections.deque()
+
+        self.__counters = {}
+        self.reset_read_counters()
+
+    def get_read_counters(self):
+        '''Return a dictionary of counters describing the reads
+        so far:
+
+        'frames_read': The number of frames read_frame() started
+        reading.
+        'frames_dropped': The number of frames read_frame() didn't
+        read because every buffer was in use.
+        'frames_replaced': The number of frames that were read but
+        thrown away before being fetched, under REPLACE_PENDING.
+        'frames_fetched': The number of frames given out by
+        get_frame() or mapped_frame().
+        'bytes_read': The bytes read back in the frames read.
+        '''
+        return dict(self.__counters)
+
+    def reset_read_counters(self):
+        '''Set all the counters returned by get_read_counters()
+        back to zero.
+        '''
+        self.__counters.update({'frames_read': 0,
+                'frames_dropped': 0,
+                'frames_replaced': 0,
+                'frames_fetched': 0,
+                'bytes_read': 0})
+
+    def get_ready_count(self):
+        '''Return the number of frames that have finished being
+        read and are waiting to be fetched.
+        '''
+        self.__update_finished()
+        return len(self.__finished)
+
+    def get_pending_count(self):
+        '''Return the number of frames that are still being read.
+        '''
+        self.__update_finished()
+        return len(self.__reading)
+
+    def read_frame(self, x=0, y=0):
+        '''Start reading a frame from the current read framebuffer,
+        with its bottom left corner at (x, y), and return whether
+        it is being read. If every buffer is in use, the
+        backpressure policy decides what happens, and False is
+        returned if the frame is dropped.
+        '''
+        self.__update_finished()
+
+        if not self.__free:
+            if self.__backpressure == REPLACE_PENDING and self.__finished:
+                self.__free.append(self.__finished.popleft())
+                self.__counters['frames_replaced'] += 1
+            else:
+                self.__counters['frames_dropped'] += 1
+                return False
+
+        idx = self.__free.popleft()
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.__pixel_buffers[idx])
+
+        # The frames are tightly packed, and with a pack buffer
+        # bound the last argument is the offset into it.
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(x, y, self.__size[0], self.__size[1],
+                self.__gl_format, self.__gl_type, 0)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 4)
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.__reading.append((idx, _new_sync()))
+
+        self.__counters['frames_read'] += 1
+        self.__counters['bytes_read'] += self.__buffer_size
+
+        return True
+
+    def get_frame(self):
+        '''Return the oldest frame that has finished being read
+        as a new numpy array, or None if there isn't one. The
+        frame is then done with, so its buffer can be read into
+        again.
+        '''
+        with self.mapped_frame() as frame:
+            if frame is None:
+                return None
+            else:
+                return frame.copy()
+
+    @contextlib.contextmanager
+    def mapped_frame(self):
+        '''A context manager that gives the oldest frame that has
+        finished being read as a numpy array that is a view of
+        the mapped pixel buffer, so nothing is copied, or None if
+        there isn't one. For example:
+
+        with texture_read_stream_2d_instance.mapped_frame() as frame:
+            if frame is not None:
+                analyse(frame)
+
+        The buffer is unmapped on exit, so the array must not be
+        used after that. Mapped memory can be slow to read more
+        than once, so use get_frame() if the frame is to be gone
+        over repeatedly.
+        '''
+        self.__update_finished()
+
+        if not self.__finished:
+            yield None
+            return
+
+        idx = self.__finished.popleft()
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.__pixel_buffers[idx])
+        pointer = GL.glMapBuffer(GL.GL_PIXEL_PACK_BUFFER, GL.GL_READ_ONLY)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.__counters['frames_fetched'] += 1
+
+        frame = _mapped_array(pointer, self.__shape, self.__dtype)
+        frame.setflags(write=False)
+
+        try:
+            yield frame
+
+        finally:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER,
+                    self.__pixel_buffers[idx])
+            GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+            self.__free.append(idx)
+
+    def __update_finished(self):
+        ''' Move the frames that have finished being read on to
+        self.__finished. The fences are signalled in order, so
+        only the oldest needs checking each time.
+        '''
+        while self.__reading:
+            idx, sync = self.__reading[0]
+
+            if not sync.get_fence_signalled_and_delete():
+                break
+
+            self.__reading.popleft()
+            self.__finished.append(idx)
+
+# The shaders of TextureReduction. The vertices are made up from
+# gl_VertexID, so nothing needs to be passed in to draw them.
+REDUCTION_VERTEX_SHADER = '''
+#version 130
+
+void main(void)
+{
+    vec2 corner = vec2(gl_VertexID % 2, gl_VertexID / 2);
+    gl_Position = vec4(corner*2.0 - 1.0, 0.0, 1.0);
+}
+'''
+
+REDUCTION_FACTOR = 4
+
+# Each fragment reduces a REDUCTION_FACTOR x REDUCTION_FACTOR block
+# of the source to its minimum (in r) and maximum (in g). In the
+# first pass the source is the image, and just r is used.
+REDUCTION_FRAGMENT_SHADER = '''
+#version 130
+
+uniform sampler2D source;
+uniform ivec2 source_size;
+uniform bool first_pass;
+
+void main(void)
+{
+    ivec2 origin = ivec2(gl_FragCoord.xy) * %(factor)d;
+    vec2 result = vec2(3.0e38, -3.0e38);
+
+    for (int y = 0; y < %(factor)d; ++y) {
+        for (int x = 0; x < %(factor)d; ++x) {
+            ivec2 texel = min(origin + ivec2(x, y), source_size - 1);
+            vec4 value = texelFetch(source, texel, 0);
+            vec2 pair = first_pass ? value.rr : value.rg;
+
+            result = vec2(min(result.x, pair.x), max(result.y, pair.y));
+        }
+    }
+
+    gl_FragColor = vec4(result, 0.0, 1.0);
+}
+''' % {'factor': REDUCTION_FACTOR}
+
+# A point is drawn for each of grid texels spread over the image,
+# into the pixel of its bin, and the points are added up.
+HISTOGRAM_VERTEX_SHADER = '''
+#version 130
+
+uniform sampler2D source;
+uniform ivec2 source_size;
+uniform ivec2 grid;
+uniform vec2 histogram_range;
+uniform int bins;
+
+void main(void)
+{
+    ivec2 point = ivec2(gl_VertexID % grid.x, gl_VertexID / grid.x);
+    ivec2 texel = (point * source_size) / grid;
+    float value = texelFetch(source, texel, 0).r;
+
+    float position = (value - histogram_range.x) / 
+            (histogram_range.y - histogram_range.x);
+    float bin = clamp(floor(position * bins), 0.0, bins - 1.0);
+
+    gl_Position = vec4((bin + 0.5) / bins * 2.0 - 1.0, 0.0, 0.0, 1.0);
+}
+'''
+
+HISTOGRAM_FRAGMENT_SHADER = '''
+#version 130
+
+void main(void)
+{
+    gl_FragColor = vec4(1.0, 0.0, 0.0, 0.0);
+}
+'''
+
+class TextureReduction(object):
+    ''' Finds the minimum and maximum of the image in a texture
+    stream, and optionally a coarse histogram of it, on the card,
+    so that display scaling (such as the level and window of a
+    ColormapStream) can follow the data without going over each
+    frame on the CPU.
+
+    The image is reduced by a chain of passes, each rendering a
+    REDUCTION_FACTOR times smaller float texture, down to a
+    single texel. The histogram is made by drawing a point for
+    each of a grid of texels into the pixel of its bin, with the
+    points added up by blending. The results are then read back
+    through a TextureReadStream2D, so nothing waits for the card,
+    and they come out of get_result() a frame or two later.
+
+    Only the first component of the image (red, or luminance) is
+    used, as it is sampled, so unsigned integer data is from 0 to
+    1 unless a scale is given. This needs GLSL 1.30 and float
+    render targets (GL 3.0).
+    '''
+    def __init__(self, size, bins=0, histogram_range=(0.0, 1.0),
+            histogram_samples=(256, 256), scale=1.0, buffers=3):
+        ''' Initialise the reduction for images of size (x, y).
+
+        bins is the number of bins of the histogram, or 0 for no
+        histogram. The bins are spread evenly over histogram_range,
+        in the units of the results, with values outside it counted
+        in the end bins.
+
+        histogram_samples is the most texels that are counted in
+        the x and y directions, spread evenly over the image, to
+        keep the histogram cheap for big images.
+
+        scale is what the values are multiplied by to give the
+        results, such as 65535 to give the values of unsigned short
+        data as they were uploaded.
+
+        buffers is the number of results that can be in hand at
+        once, as for TextureReadStream2D.
+        '''
+        if bins < 0:
+            raise ValueError('bins can\'t be negative.')
+
+        if not histogram_range[1] > histogram_range[0]:
+            raise ValueError('The histogram range is empty.')
+
+        self.__size = tuple(size[0:2])
+        self.__bins = bins
+        self.__scale = float(scale)
+        self.__histogram_range = (histogram_range[0]/self.__scale,
+                histogram_range[1]/self.__scale)
+        self.__grid = (min(histogram_samples[0], self.__size[0]),
+                min(histogram_samples[1], self.__size[1]))
+
+        self.__reduce_program = _compile_program(REDUCTION_VERTEX_SHADER,
+                REDUCTION_FRAGMENT_SHADER)
+
+        if bins:
+            self.__histogram_program = _compile_program(
+                    HISTOGRAM_VERTEX_SHADER, HISTOGRAM_FRAGMENT_SHADER)
+
+        # The size of each pass in turn
+        self.__pass_sizes = []
+        pass_size = self.__size
+        while True:
+            pass_size = (-(-pass_size[0]//REDUCTION_FACTOR),
+                    -(-pass_size[1]//REDUCTION_FACTOR))
+            self.__pass_sizes.append(pass_size)
+
+            if pass_size == (1, 1):
+                break
+
+        # Every pass but the last renders into its own texture.
+        # The last renders into the first texel of the results,
+        # which are followed by the histogram.
+        self.__pass_textures = []
+        self.__pass_framebuffers = []
+
+        for pass_size in self.__pass_sizes[:-1]:
+            texture, framebuffer = self.__new_target(pass_size)
+            self.__pass_textures.append(texture)
+            self.__pass_framebuffers.append(framebuffer)
+
+        self.__results_texture, self.__results_framebuffer = \
+                self.__new_target((1 + bins, 1))
+
+        self.__read_stream = TextureReadStream2D((1 + bins, 1), GL.GL_RG,
+                GL.GL_FLOAT, buffers=buffers)
+
+    def __new_target(self, size):
+        ''' Return a new float texture of size and a framebuffer
+        to render into it with.
+        '''
+        texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RG32F, size[0], size[1],
+                0, GL.GL_RG, GL.GL_FLOAT, None)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, \
+                GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        framebuffer = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+        GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, 
+                GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, texture, 0)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
+
+        return texture, framebuffer
+
+    def get_read_stream(self):
+        '''Return the TextureReadStream2D the results are read
+        back through, for its counters.
+        '''
+        return self.__read_stream
+
+    def reduce(self, texture_stream):
+        '''Start finding the minimum, maximum and histogram of the
+        texture that texture_stream (a TextureStream2D, or anything
+        with bind_texture(), unbind_texture() and
+        get_texture_unit()) would bind now. Return whether the
+        results will be read back, which they aren't if every
+        buffer of the read stream is in use.
+
+        The framebuffer bindings, viewport, program, clear colour
+        and blending state are put back afterwards.
+        '''
+        draw_framebuffer = _gl_integer(GL.GL_DRAW_FRAMEBUFFER_BINDING)
+        read_framebuffer = _gl_integer(GL.GL_READ_FRAMEBUFFER_BINDING)
+        program = _gl_integer(GL.GL_CURRENT_PROGRAM)
+        viewport = [int(each) for each in 
+                numpy.ravel(GL.glGetIntegerv(GL.GL_VIEWPORT))[0:4]]
+        clear_color = [float(each) for each in 
+                numpy.ravel(GL.glGetFloatv(GL.GL_COLOR_CLEAR_VALUE))[0:4]]
+        blend = GL.glIsEnabled(GL.GL_BLEND)
+        blend_function = [_gl_integer(pname) for pname in 
+                (GL.GL_BLEND_SRC_RGB, GL.GL_BLEND_DST_RGB,
+                    GL.GL_BLEND_SRC_ALPHA, GL.GL_BLEND_DST_ALPHA)]
+        blend_equation = [_gl_integer(pname) for pname in
+                (GL.GL_BLEND_EQUATION_RGB, GL.GL_BLEND_EQUATION_ALPHA)]
+
+        texture_unit = texture_stream.get_texture_unit()
+        texture_stream.bind_texture()
+
+        GL.glDisable(GL.GL_BLEND)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.__results_framebuffer)
+        GL.glViewport(0, 0, 1 + self.__bins, 1)
+        GL.glClearColor(0.0, 0.0, 0.0, 0.0)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+
+        if self.__bins:
+            self.__draw_histogram(texture_unit)
+
+        self.__draw_reduction(texture_unit)
+
+        texture_stream.unbind_texture()
+
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER,
+                self.__results_framebuffer)
+        reading = self.__read_stream.read_frame()
+
+        GL.glUseProgram(program)
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, draw_framebuffer)
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, read_framebuffer)
+        GL.glViewport(*viewport)
+        GL.glClearColor(*clear_color)
+        GL.glBlendFuncSeparate(*blend_function)
+        GL.glBlendEquationSeparate(*blend_equation)
+
+        if blend:
+            GL.glEnable(GL.GL_BLEND)
+
+        return reading
+
+    def __draw_histogram(self, texture_unit):
+        program = self.__histogram_program
+
+        GL.glUseProgram(program)
+        GL.glUniform1i(GL.glGetUniformLocation(program, 'source'),
+                texture_unit - GL.GL_TEXTURE0)
+        GL.glUniform2i(GL.glGetUniformLocation(program, 'source_size'),
+                self.__size[0], self.__size[1])
+        GL.glUniform2i(GL.glGetUniformLocation(program, 'grid'),
+                self.__grid[0], self.__grid[1])
+        GL.glUniform2f(GL.glGetUniformLocation(program, 'histogram_range'),
+                self.__histogram_range[0], self.__histogram_range[1])
+        GL.glUniform1i(GL.glGetUniformLocation(program, 'bins'),
+                self.__bins)
+
+        # The bins come after the minimum and maximum
+        GL.glViewport(1, 0, self.__bins, 1)
+
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendEquation(GL.GL_FUNC_ADD)
+        GL.glBlendFunc(GL.GL_ONE, GL.GL_ONE)
+        GL.glDrawArrays(GL.GL_POINTS, 0, self.__grid[0]*self.__grid[1])
+        GL.glDisable(GL.GL_BLEND)
+
+    def __draw_reduction(self, texture_unit):
+        program = self.__reduce_program
+
+        GL.glUseProgram(program)
+        source_location = GL.glGetUniformLocation(program, 'source')
+        size_location = GL.glGetUniformLocation(program, 'source_size')
+        first_pass_location = GL.glGetUniformLocation(program, 'first_pass')
+
+        GL.glUniform1i(source_location, texture_unit - GL.GL_TEXTURE0)
+        GL.glUniform1i(first_pass_location, 1)
+
+        source_size = self.__size
+        framebuffers = self.__pass_framebuffers + [self.__results_framebuffer]
+        textures = [None] + self.__pass_textures
+
+        for pass_size, framebuffer, texture in zip(self.__pass_sizes,
+                framebuffers, textures):
+
+            if texture is not None:
+                # After the first pass, the source is the last pass,
+                # bound to the same unit as the image was.
+                GL.glActiveTexture(texture_unit)
+                GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+                GL.glUniform1i(first_pass_location, 0)
+
+            GL.glUniform2i(size_location, source_size[0], source_size[1])
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+            GL.glViewport(0, 0, pass_size[0], pass_size[1])
+            GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
+
+            source_size = pass_size
+
+        GL.glActiveTexture(texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def get_result(self):
+        '''Return the newest results that have been read back, as
+        a tuple of (minimum, maximum, histogram), or None if no
+        more have been read back since the last call. histogram
+        is an array of the counts in each bin, or None if there
+        are no bins. Older results that are waiting are thrown
+        away, so the display follows the data as closely as it
+        can.
+        '''
+        result = None
+
+        while True:
+            frame = self.__read_stream.get_frame()
+
+            if frame is None:
+                break
+
+            result = frame
+
+        if result is None:
+            return None
+
+        minimum, maximum = result[0, 0] * self.__scale
+
+        if self.__bins:
+            histogram = numpy.rint(result[0, 1:, 0]).astype('int64')
+        else:
+            histogram = None
+
+        return (float(minimum), float(maximum), histogram)
+
+# The layout of the files written by FrameRecorder. The header is
+# followed by the frames, each starting on a FRAME_FILE_ALIGNMENT
+# byte boundary, and then the index, with an entry per frame.
+FRAME_FILE_MAGIC = 'GLFRAMES'
+FRAME_FILE_VERSION = 1
+FRAME_FILE_ALIGNMENT = 64
+
+FRAME_FILE_HEADER = numpy.dtype([('magic', 'S8'),
+        ('version', '<u4'),
+        ('width', '<u4'),
+        ('height', '<u4'),
+        ('gl_format', '<u4'),
+        ('gl_type', '<u4'),
+        ('frames', '<u8'),
+        ('index_offset', '<u8')])
+
+# elements is 0 for two-dimensional frames
+FRAME_FILE_INDEX = numpy.dtype([('offset', '<u8'),
+        ('timestamp', '<f8'),
+        ('rows', '<u4'),
+        ('cols', '<u4'),
+        ('elements', '<u4'),
+        ('dtype', 'S4')])
+
+class FrameRecorder(object):
+    ''' Writes the frames fed to a texture stream to a raw frame
+    file, so they can be replayed with FrameReader. Each frame is
+    written as it is in memory (in native byte order), with the
+    time it was written. Use it with
+    TextureStream2D.set_frame_recorder(), or call write_frame()
+    directly.
+
+    The index of the frames is written by close(), and the file
+    can't be read until it has been. The class can be used as a
+    context manager, which closes it on exit.
+    '''
+    def __init__(self, filename, size, gl_format, gl_type):
+        ''' Create (or overwrite) the file called filename, to
+        hold frames for a stream of the given size, gl_format and
+        gl_type, as passed to TextureStream2D.
+        '''
+        self.__file = open(filename, 'wb')
+        self.__lock = threading.Lock()
+
+        self.__header = numpy.zeros(1, dtype=FRAME_FILE_HEADER)
+        self.__header['magic'] = FRAME_FILE_MAGIC
+        self.__header['version'] = FRAME_FILE_VERSION
+        self.__header['width'] = size[0]
+        self.__header['height'] = size[1]
+        self.__header['gl_format'] = gl_format
+        self.__header['gl_type'] = gl_type
+
+        self.__index = []
+
+        self.__header.tofile(self.__file)
+        self.__offset = self.__header.nbytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def write_frame(self, data, timestamp=None):
+        '''Append the frame in data to the file, with timestamp,
+        which defaults to time.time().
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+
+        # Only copy if need be
+        data = numpy.ascontiguousarray(data,
+                dtype=data.dtype.newbyteorder('='))
+
+        rows, cols = data.shape[0:2]
+
+        if data.ndim > 2:
+            elements = int(numpy.prod(data.shape[2:]))
+        else:
+            elements = 0
+
+        with self.__lock:
+            offset = _aligned(self.__offset, FRAME_FILE_ALIGNMENT)
+            self.__file.write('\0' * (offset - self.__offset))
+
+            data.tofile(self.__file)
+
+            self.__offset = offset + data.nbytes
+            self.__index.append((offset, timestamp, rows, cols, elements,
+                    data.dtype.str))
+
+    def close(self):
+        '''Write the index and close the file. Nothing more can
+        be written after this.
+        '''
+        with self.__lock:
+            if self.__file.closed:
+                return
+
+            index = numpy.array(self.__index, dtype=FRAME_FILE_INDEX)
+
+            self.__header['frames'] = len(index)
+            self.__header['index_offset'] = self.__offset
+
+            index.tofile(self.__file)
+
+            self.__file.seek(0)
+            self.__header.tofile(self.__file)
+
+            self.__file.close()
+
+class FrameReader(object):
+    ''' Reads a raw frame file written by FrameRecorder. The
+    file is memory mapped, and each frame is given as a
+    numpy.memmap over its part of the file, so the frames go
+    straight from the page cache to the pixel buffers when they
+    are passed to TextureStream2D.update_texture(), with nothing
+    decoded or copied on the way. Reading the frames in order
+    lets the OS read ahead.
+
+    The frames are indexed like a list, so len(reader) is the
+    number of frames and reader[n] is frame n. Iterating over the
+    reader gives the frames in order.
+    '''
+    def __init__(self, filename):
+        ''' Open the file called filename.
+        '''
+        self.__data = numpy.memmap(filename, dtype='uint8', mode='r')
+
+        header = self.__data[:FRAME_FILE_HEADER.itemsize].view(
+                FRAME_FILE_HEADER)[0]
+
+        if header['magic'] != FRAME_FILE_MAGIC:
+            raise ValueError(repr(filename) + ' is not a raw frame file.')
+
+        if header['version'] != FRAME_FILE_VERSION:
+            raise ValueError(repr(filename) + ' is an unsupported '\
+                    'version of the raw frame file.')
+
+        if header['index_offset'] == 0:
+            raise ValueError(repr(filename) + ' has no index. It might '\
+                    'not have been closed.')
+
+        self.size = (int(header['width']), int(header['height']))
+        self.gl_format = _gl_constant(header['gl_format'], GL_FORMATS)
+        self.gl_type = _gl_constant(header['gl_type'], GL_TYPES)
+
+        index_offset = int(header['index_offset'])
+        self.__index = self.__data[index_offset:index_offset +
+                int(header['frames']) * FRAME_FILE_INDEX.itemsize].view(
+                        FRAME_FILE_INDEX)
+
+        self.timestamps = numpy.array(self.__index['timestamp'])
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __getitem__(self, n):
+        offset, timestamp, rows, cols, elements, dtype = self.__index[n]
+
+        shape = (int(rows), int(cols))
+        if elements:
+            shape += (int(elements),)
+
+        dtype = numpy.dtype(dtype)
+        offset = int(offset)
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+
+        return self.__data[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def replay(self, texture_stream, rate=None, start=0, stop=None):
+        '''A generator that passes the frames from start to stop
+        to texture_stream.update_texture() in turn, yielding the
+        index of each frame after it has been passed, so the
+        caller can render it. For example:
+
+        for n in frame_reader.replay(texture_stream_2d_instance):
+            render()
+
+        The frames are passed at their recorded times, relative
+        to the first, or at rate frames per second if rate is
+        given, by sleeping until each is due. Frames are never
+        skipped, so if rendering is slower than the frames were
+        recorded, the replay falls behind.
+        '''
+        if stop is None:
+            stop = len(self)
+
+        start_time = time.time()
+
+        for n in range(start, stop):
+            if rate is None:
+                due = self.timestamps[n] - self.timestamps[start]
+            else:
+                due = (n - start) / float(rate)
+
+            delay = start_time + due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            texture_stream.update_texture(self[n])
+
+            yield n
+
+class TextureUploadWorker(object):
+    ''' A thread that does the uploads for any number of 
+    texture streams, so the thread that renders (usually the
+    GUI thread) doesn't have to. Pass the instance to the 
+    texture streams as their upload_worker.
+
+    The thread needs its own GL context, which must share its
+    objects with the rendering context. How such a context is 
+    made depends on the toolkit. For example, with Qt a hidden
+    QGLWidget can be created with the rendering widget as its
+    shareWidget argument, and its makeCurrent and doneCurrent 
+    methods passed to this class (its context having been moved
+    to the worker thread if need be).
+
+    The uploads are queued up in a bounded queue and done in
+    order. After each upload the worker's context is flushed, 
+    so the sync for the upload can be seen from the rendering
+    context, which binds the texture as usual once it has 
+    been signalled.
+    '''
+
+    def __init__(self, make_current, done_current=None, max_queued=2):
+        ''' Initialise and start the worker thread.
+
+        make_current is called (with no arguments) on the worker 
+        thread before anything else, and should make the worker's
+        GL context current. done_current, if given, is called on 
+        the worker thread when the worker is stopped.
+
+        max_queued is the maximum number of uploads that can be
+        waiting to be done, across all the streams that use the
+        worker.
+        '''
+        self.__make_current = make_current
+        self.__done_current = done_current
+        self.__queue = Queue.Queue(max_queued)
+
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def is_worker_thread(self):
+        ''' Return whether this is being called from the worker
+        thread.
+        '''
+        return threading.current_thread() is self.__thread
+
+    def submit(self, function, args=(), block=False, timeout=None):
+        ''' Queue function(*args) to be called on the worker
+        thread. If the queue is full, wait for up to timeout 
+        seconds for room if block is True. Return whether the
+        function was queued.
+        '''
+        try:
+            self.__queue.put((function, args), block, timeout)
+        except Queue.Full:
+            return False
+
+        return True
+
+    def stop(self):
+        ''' Stop the worker once everything that is queued has
+        been done, and wait for it to finish.
+        '''
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+
+        self.__make_current()
+
+        try:
+            while True:
+                job = self.__queue.get()
+
+                if job is None:
+                    break
+
+                function, args = job
+
+                try:
+                    function(*args)
+                except Exception:
+                    traceback.print_exc()
+
+                # Get the commands, and so the sync, to the card
+                GL.glFlush()
+
+        finally:
+            if self.__done_current is not None:
+                self.__done_current()
+
+class UploadAutotuner(object):
+    ''' Finds the fastest way for a TextureStream2D to upload
+    frames of a given size and format with the GL driver in use,
+    by timing a stream with each combination of upload method,
+    number of buffers, buffer usage and upload type (see
+    TextureStream2D.__init__). The timings are kept in a JSON file,
+    under the GL renderer and version strings, so each size and
+    format is only timed once for each driver (and again when the
+    driver is updated).
+
+    Streams made with autotune set use get_settings(), which does
+    the timing the first time it is needed. This needs the context
+    the streams will be used in to be current, and takes a few
+    seconds (more for bigger frames), so it can be done up front
+    with benchmark() if that's better.
+
+    The frames are uploaded back to back with BLOCK backpressure,
+    so every frame is uploaded, and each texture is bound after
+    its upload as it would be for rendering. The time of a run is
+    that of the whole run, including the glFinish() at the end,
+    divided by the frames. Each combination is run a number of
+    times, taking turns with the others so that they all see the
+    same changes in the load on the machine, and its time is the
+    median of its runs.
+
+    Timings of uploads are noisy, so a stream's own settings are
+    only replaced by faster ones if they are faster by a clear
+    margin.
+    '''
+    def __init__(self, filename=AUTOTUNE_FILENAME, frames=10, warmup=3,
+            repeats=5, margin=0.1, upload_methods=UPLOAD_METHODS,
+            buffer_counts=(2, 3),
+            buffer_usages=(GL.GL_STREAM_DRAW, GL.GL_DYNAMIC_DRAW)):
+        ''' filename is the JSON file the timings are kept in, or
+        None for them to only be kept in memory. The file is read
+        the first time it is needed, and rewritten (with any other
+        changes made to it in the meantime) after each benchmark.
+
+        frames is the number of frames timed in each run of a
+        combination, after warmup frames that aren't timed, and
+        repeats is the number of runs of each combination.
+
+        margin is the fraction of the time of the default settings
+        passed to get_settings() by which other settings must be
+        faster to be used instead.
+
+        upload_methods, buffer_counts and buffer_usages are the
+        values tried for the upload method, buffers and
+        buffer_usage. The buffer usage is only varied for the
+        methods that use it.
+        '''
+        for upload_method in upload_methods:
+            if upload_method not in UPLOAD_METHODS:
+                raise ValueError(repr(upload_method) + ' is not a valid '\
+                        'upload method.')
+
+        self.__filename = filename
+        self.__frames = frames
+        self.__warmup = warmup
+        self.__repeats = repeats
+        self.__margin = margin
+        self.__upload_methods = tuple(upload_methods)
+        self.__buffer_counts = tuple(buffer_counts)
+        self.__buffer_usages = tuple(buffer_usages)
+
+        # The timings read from the file, by renderer and then by
+        # size and format.
+        self.__timings = None
+
+        self.__lock = threading.Lock()
+
+    def get_settings(self, size, gl_format, gl_type, gl_internal_format,
+            upload_methods=UPLOAD_METHODS, default=None):
+        ''' Return the fastest settings for a TextureStream2D of
+        size, gl_format, gl_type and gl_internal_format with the
+        current renderer, as a dictionary of the TextureStream2D
+        arguments 'upload_method', 'upload_type', 'buffers' and
+        'buffer_usage'. Only settings with one of upload_methods
+        are returned.
+
+        default, if given, is the settings to use unless others
+        are faster by the margin given at instantiation. It
+        should have one of upload_methods.
+
+        If they haven't been timed (or default hasn't), they are
+        timed with benchmark() first.
+        '''
+        timings = self.get_timings(size, gl_format, gl_type,
+                gl_internal_format)
+
+        if timings is None or (default is not None and 
+                default not in [each[1] for each in timings]):
+            timings = self.benchmark(size, gl_format, gl_type,
+                    gl_internal_format, default)
+
+        default_seconds = None
+        for seconds, settings in timings:
+            if settings == default:
+                default_seconds = seconds
+
+        for seconds, settings in timings:
+            if settings['upload_method'] in upload_methods:
+                if (default_seconds is not None and 
+                        seconds > default_seconds * (1 - self.__margin)):
+                    return default
+
+                return settings
+
+        raise ValueError('None of ' + repr(upload_methods) + ' has been '\
+                'timed.')
+
+    def get_timings(self, size, gl_format, gl_type, gl_internal_format):
+        ''' Return the timings kept for size, gl_format, gl_type
+        and gl_internal_format with the current renderer, as
+        described for benchmark(), or None if there are none.
+        '''
+        with self.__lock:
+            if self.__timings is None:
+                self.__timings = self.__read_timings()
+
+            renderer_timings = self.__timings.get(self.__renderer(), {})
+            timings = renderer_timings.get(self.__key(size, gl_format,
+                gl_type, gl_internal_format))
+
+        if timings is None:
+            return None
+
+        return [(seconds, self.__settings(entry))
+                for seconds, entry in timings]
+
+    def benchmark(self, size, gl_format, gl_type, gl_internal_format,
+            default=None):
+        ''' Time the uploads of a stream of size, gl_format,
+        gl_type and gl_internal_format with each combination of
+        settings, and keep the timings. Return them as a list of
+        (seconds per frame, settings) tuples, fastest first, with
+        settings as described for get_settings(). default, if
+        given, is settings to time as well as the combinations.
+
+        Combinations that the driver doesn't support (so the
+        stream would fall back to another method) aren't
+        included. The current texture unit and the texture bound
+        to it are changed.
+        '''
+        candidates = self.__candidates(gl_format, gl_type,
+                gl_internal_format)
+
+        if default is not None and default not in candidates:
+            candidates.append(default)
+
+        # The runs of each candidate, with the candidates taking
+        # turns, starting with a different one each time round.
+        runs = [[] for each in candidates]
+        for repeat in range(self.__repeats):
+            for n in range(len(candidates)):
+                idx = (n + repeat) % len(candidates)
+
+                if runs[idx] is None:
+                    continue
+
+                seconds = self.__time(size, gl_format, gl_type,
+                        gl_internal_format, candidates[idx])
+
+                if seconds is None:
+                    runs[idx] = None
+                else:
+                    runs[idx].append(seconds)
+
+        timings = [(float(numpy.median(each)), settings)
+                for each, settings in zip(runs, candidates)
+                if each is not None]
+
+        timings.sort(key=lambda each: each[0])
+
+        entries = [(seconds, dict(settings,
+            buffer_usage=int(settings['buffer_usage']),
+            upload_type=int(settings['upload_type'])))
+            for seconds, settings in timings]
+
+        with self.__lock:
+            if self.__timings is None:
+                self.__timings = self.__read_timings()
+
+            self.__timings.setdefault(self.__renderer(), {})[self.__key(
+                size, gl_format, gl_type, gl_internal_format)] = entries
+
+            self.__write_timings()
+
+        return timings
+
+    def clear(self):
+        ''' Forget all the timings, for every renderer, and
+        delete the file.
+        '''
+        with self.__lock:
+            self.__timings = {}
+
+            if self.__filename is not None and \
+                    os.path.exists(self.__filename):
+                os.remove(self.__filename)
+
+    def __candidates(self, gl_format, gl_type, gl_internal_format):
+        ''' Return a list of the settings to time.
+        '''
+        upload_types = [gl_type]
+
+        if (sys.byteorder == 'little' and
+                not GL_COMPRESSED_FORMATS.has_key(gl_internal_format) and
+                GL_FORMATS.get(gl_format) == 4):
+            upload_types.extend(EQUIVALENT_UPLOAD_TYPES.get(gl_type, ()))
+
+        candidates = []
+        for upload_method in self.__upload_methods:
+            # The others don't use the buffer usage
+            if upload_method in (ORPHAN, INVALIDATE, BUFFER_SUB_DATA):
+                buffer_usages = self.__buffer_usages
+            else:
+                buffer_usages = self.__buffer_usages[:1]
+
+            for upload_type in upload_types:
+                for buffers in self.__buffer_counts:
+                    for buffer_usage in buffer_usages:
+                        candidates.append({'upload_method': upload_method,
+                            'upload_type': upload_type,
+                            'buffers': buffers,
+                            'buffer_usage': buffer_usage})
+
+        return candidates
+
+    def __time(self, size, gl_format, gl_type, gl_internal_format,
+            settings):
+        ''' Return the seconds per frame of uploads with settings,
+        or None if the upload method isn't supported.
+        '''
+        stream = TextureStream2D(size, gl_format, gl_type,
+                gl_internal_format, GL.GL_TEXTURE0, backpressure=BLOCK,
+                block_timeout=1.0, **settings)
+
+        try:
+            if stream.get_upload_method() != settings['upload_method']:
+                return None
+
+            # Frames of bytes do for any type, and two different
+            # ones are alternated so nothing could be skipped.
+            if GL_COMPRESSED_FORMATS.has_key(gl_internal_format):
+                block = COMPRESSED_BLOCK_SIZE
+                bytes_per_texel = GL_COMPRESSED_FORMATS[gl_internal_format]
+            else:
+                block = 1
+                bytes_per_texel = _bytes_per_texel(gl_type, gl_format)
+
+            shape = (-(-size[1] // block), -(-size[0] // block),
+                    bytes_per_texel)
+
+            frames = [numpy.random.randint(0, 256, shape).astype('uint8')
+                    for n in range(2)]
+
+            for n in range(self.__warmup):
+                stream.update_texture(frames[n % 2])
+                stream.bind_texture()
+
+            GL.glFinish()
+            stream.reset_upload_counters()
+
+            start = time.time()
+
+            for n in range(self.__frames):
+                stream.update_texture(frames[n % 2])
+                stream.bind_texture()
+
+            GL.glFinish()
+
+            seconds = time.time() - start
+
+            stream.unbind_texture()
+
+            accepted = stream.get_upload_counters()['frames_accepted']
+
+        finally:
+            stream.delete()
+
+        return seconds / max(accepted, 1)
+
+    def __renderer(self):
+        return '%s %s' % (GL.glGetString(GL.GL_RENDERER),
+                GL.glGetString(GL.GL_VERSION))
+
+    def __key(self, size, gl_format, gl_type, gl_internal_format):
+        return '%dx%d/%d/%d/%d' % (size[0], size[1], gl_format, gl_type,
+                gl_internal_format)
+
+    def __settings(self, entry):
+        ''' Return the settings of an entry of the file, with the
+        GL constants put back.
+        '''
+        settings = dict([(str(key), value) for key, value in entry.items()])
+        settings['upload_method'] = str(settings['upload_method'])
+        settings['upload_type'] = _gl_constant(settings['upload_type'],
+                GL_TYPES)
+        settings['buffer_usage'] = _gl_constant(settings['buffer_usage'],
+                self.__buffer_usages)
+
+        return settings
+
+    def __read_timings(self):
+        ''' Return the timings in the file, or nothing if it
+        doesn't exist or can't be read.
+        '''
+        if self.__filename is None:
+            return {}
+
+        try:
+            with open(self.__filename) as timings_file:
+                return json.load(timings_file)
+
+        except (IOError, ValueError):
+            return {}
+
+    def __write_timings(self):
+        ''' Write the timings to the file, along with anything
+        else that has been written to it since it was read. The
+        file is written in full and then renamed, so it is never
+        seen half written. If it can't be written, the timings
+        are just kept in memory.
+        '''
+        if self.__filename is None:
+            return
+
+        timings = self.__read_timings()
+
+        for renderer, renderer_timings in self.__timings.items():
+            timings.setdefault(renderer, {}).update(renderer_timings)
+
+        self.__timings = timings
+
+        temp_filename = '%s.%d' % (self.__filename, os.getpid())
+
+        try:
+            with open(temp_filename, 'w') as timings_file:
+                json.dump(timings, timings_file, indent=2, sort_keys=True)
+
+            os.rename(temp_filename, self.__filename)
+
+        except (IOError, OSError):
+            pass
+
+_default_upload_autotuner = None
+
+def get_upload_autotuner():
+    ''' Return the module's UploadAutotuner, which is used by
+    streams made with autotune=True, creating it the first time.
+    It keeps its timings in AUTOTUNE_FILENAME.
+    '''
+    global _default_upload_autotuner
+
+    if _default_upload_autotuner is None:
+        _default_upload_autotuner = UploadAutotuner()
+
+    return _default_upload_autotuner
+
+class _BufferRing(object):
+    ''' The ring of buffers behind a texture stream. Each buffer
+    is one of a set of pixel buffers along with whatever textures
+    the stream uploads to from it. This keeps track of which 
+    buffer should be read from (the one with the most recent 
+    upload to have finished, according to its sync) and which
+    should be written to next, applying the backpressure policy
+    when they are all busy, and of the syncs for each upload.
+
+    The stream calls next_write_idx() before an upload, to 
+    uploads to buffer write_idx, then calls finish_write(). To
+    render, it calls update_read_idx() and uses buffer read_idx.
+    newest_idx is the buffer with the most recent upload, whether
+    it has finished or not.
+
+    Each upload is given a sequence number when its sync is set,
+    so the uploads form a timeline: submitted is the sequence
+    number of the last upload made and completed that of the last
+    one known to have finished. As the uploads finish in the order
+    they were made, only the sync of the oldest unfinished upload
+    needs checking, rather than one for every buffer, and the
+    syncs are reused rather than a new one being made for each
+    upload.
+
+    If frame_fences is set to a FrameFences, no syncs are set, and
+    each upload is taken to have finished once the frame it was
+    made in has. It must only be set once the ring has been reset.
+
+    If there is an upload worker, the indices and syncs are
+    changed by its thread whilst the rendering thread is reading
+    them, so they should only be used with lock held.
+    '''
+    def __init__(self, pixel_buffers, n_buffers, backpressure=DROP_NEWEST,
+            block_timeout=0.1, max_buffers=None, insert_buffer=None,
+            wait=True):
+        ''' pixel_buffers is the set of pixel buffers, with 
+        n_buffers buffers. backpressure, block_timeout and 
+        max_buffers are as described for TextureStream2D.
+
+        insert_buffer, if given, is called with an index when the
+        ring grows, so the stream can insert its textures for the
+        new buffer at that index. It should return False if it
+        can't, in which case the ring doesn't grow.
+
+        If wait is True, this waits for the card to finish
+        everything that has been queued up so far.
+        '''
+        self.pixel_buffers = pixel_buffers
+        self.n_buffers = n_buffers
+        self.upload_worker = None
+        self.frame_fences = None
+        self.lock = threading.Lock()
+
+        # If set, the _UploadStats the fence times are added to
+        self.stats = None
+        # If set, called with 'dropped' or 'replaced' for each lost
+        # frame, without the lock held.
+        self.on_drop = None
+
+        self.counters = {'frames_accepted': 0,
+                'frames_dropped': 0,
+                'frames_replaced': 0}
+
+        self.__backpressure = backpressure
+        self.__block_timeout = block_timeout
+        self.__max_buffers = max_buffers
+        self.__insert_buffer = insert_buffer
+        self.__mailbox = None
+        self.__last_write_idx = 0
+        self.__lost = None
+        # What the last call to next_write_idx() changed, for
+        # cancel_write() to put back: the (index, sequence number)
+        # of the buffer it forgot the upload of, if any, and
+        # whether it replaced the pending upload.
+        self.__last_sequence = None
+        self.__last_replaced = False
+
+        # The unfinished uploads, oldest first, as tuples of
+        # (sequence number, buffer index, fence, time the fence
+        # was set), and the sequence number of the upload in each
+        # buffer, which is None whilst the buffer is being written.
+        # The fence is a sync, or the number of the frame the
+        # upload was made in if there are frame fences.
+        self.__pending = collections.deque()
+        self.__buffer_sequences = [0] * self.n_buffers
+        self.__spare_syncs = []
+
+        self.submitted = 0
+        self.completed = 0
+
+        self.read_idx = 0
+        self.write_idx = 0
+        self.newest_idx = 0
+
+        if not wait:
+            return
+        
+        sync = _new_sync()
+        status = sync.block_until_signalled()
+        if status is type(sync).GL_TIMEOUT_EXPIRED:
+            raise RuntimeError('Problem clearing the OpenGL pipeline in a '\
+                'reasonable time frame.')
+
+    def reset(self, wait=True):
+        ''' Wait for everything uploaded so far to finish, and
+        start again from the first buffer. This is used at the 
+        end of the initialisation of a stream.
+
+        If wait is False, this doesn't wait, but returns a sync
+        that is signalled once everything so far has finished.
+        '''
+        # Forget the uploads made by the init.
+        for sequence, idx, sync, sync_time in self.__pending:
+            sync.delete_sync()
+            self.__spare_syncs.append(sync)
+
+        self.__pending.clear()
+        
+        init_sync = _new_sync()
+
+        if wait:
+            status = init_sync.block_until_signalled(timeout=2.0)
+            if status is type(init_sync).GL_TIMEOUT_EXPIRED:
+                raise RuntimeError('Problem initialising the textures in a '\
+                        'reasonable time frame.')
+        
+        # Reinitialise the indices
+        self.read_idx = 0
+        self.write_idx = 0
+        self.newest_idx = 0
+
+        self.completed = self.submitted
+        self.__buffer_sequences = [self.submitted] * self.n_buffers
+
+        if not wait:
+            return init_sync
+
+    def reset_counters(self):
+        for key in self.counters:
+            self.counters[key] = 0
+
+    def update_read_idx(self):
+        '''Update the read index to the most 
+        recently filled buffer. Return True
+        if the read index is changed, otherwise
+        return False.
+        '''
+        pending = self.__pending
+        frame_fences = self.frame_fences
+        newest_idx = None
+
+        if frame_fences is not None and pending:
+            completed_frame = frame_fences.get_completed_frame()
+
+        # Move along the timeline until an upload that hasn't
+        # finished is found.
+        while pending:
+            sequence, idx, fence, sync_time = pending[0]
+
+            if frame_fences is not None:
+                if fence > completed_frame:
+                    break
+
+            elif fence.get_fence_signalled_and_delete():
+                self.__spare_syncs.append(fence)
+
+            else:
+                break
+
+            pending.popleft()
+            self.completed = sequence
+
+            if self.stats is not None:
+                self.stats.add('fence', time.time() - sync_time)
+
+            # Unless it has been written over since
+            if self.__buffer_sequences[idx] == sequence:
+                newest_idx = idx
+
+        if newest_idx is None:
+            return False
+
+        self.read_idx = newest_idx
+        return True
+
+    def next_write_idx(self, whole_frame=True):
+        ''' Set the next write index for updating
+        the texture.
+
+        Return True if the write index was updated
+        ok, otherwise False. False is returned
+        if the next buffer is the one currently
+        being read from and the backpressure policy
+        couldn't do anything about it.
+
+        whole_frame is False for an upload of part of the
+        texture, which with REPLACE_PENDING is written on top of
+        the pending upload rather than replacing it, so isn't
+        counted as a replaced frame.
+        '''
+        with self.lock:
+            self.__last_write_idx = self.write_idx
+            self.__last_sequence = None
+            self.__last_replaced = False
+            self.__lost = None
+            accepted = self.__next_write_idx(whole_frame)
+            lost = self.__lost
+
+        if lost is not None and self.on_drop is not None:
+            self.on_drop(lost)
+
+        return accepted
+
+    def __next_write_idx(self, whole_frame):
+        ''' The body of next_write_idx, which should be
+        called with self.lock held. If a frame is lost,
+        self.__lost is set to why.
+        '''
+        if self.n_buffers is 1:
+            self.write_idx = 0
+        else:
+            # Firstly update the read index to the most current one.
+            self.update_read_idx()
+
+            next_idx = (self.write_idx+1)%self.n_buffers
+            # The policy is that we don't overwrite the buffer that is 
+            # currently being read from.
+            if next_idx == self.read_idx:
+                policy = self.__backpressure
+
+                if (policy == REPLACE_PENDING and 
+                        not self.pixel_buffers.persistent):
+                    # Write over the most recent upload, which 
+                    # can't have finished or it would be being
+                    # read from. It is no longer of interest,
+                    # unless this only writes part of the texture
+                    # on top of it.
+                    self.__forget_upload(self.write_idx)
+
+                    if whole_frame:
+                        self.counters['frames_replaced'] += 1
+                        self.__last_replaced = True
+                        self.__lost = 'replaced'
+
+                    self.counters['frames_accepted'] += 1
+                    return True
+
+                elif policy == BLOCK and self.__wait_for_oldest():
+                    next_idx = (self.write_idx+1)%self.n_buffers
+
+                elif policy == GROW and self.__grow():
+                    next_idx = (self.write_idx+1)%self.n_buffers
+
+                else:
+                    self.counters['frames_dropped'] += 1
+                    self.__lost = 'dropped'
+                    return False
+
+            # The upload to the next buffer must have finished, but 
+            # might not have been found to have. Forget it so the
+            # buffer can't be read from until the new upload is done.
+            self.__forget_upload(next_idx)
+
+            self.write_idx = next_idx
+        
+        self.counters['frames_accepted'] += 1
+        return True
+
+    def cancel_write(self):
+        ''' Go back to the write index before the last call to
+        next_write_idx(), as the upload didn't happen.
+        '''
+        with self.lock:
+            self.write_idx = self.__last_write_idx
+            self.counters['frames_accepted'] -= 1
+
+            if self.__last_sequence is not None:
+                idx, sequence = self.__last_sequence
+                self.__buffer_sequences[idx] = sequence
+
+            if self.__last_replaced:
+                self.counters['frames_replaced'] -= 1
+
+    def __forget_upload(self, idx):
+        ''' Forget the upload in buffer idx, as it is about to be
+        written to, noting its sequence number for cancel_write().
+        '''
+        self.__last_sequence = (idx, self.__buffer_sequences[idx])
+        self.__buffer_sequences[idx] = None
+
+    def finish_write(self):
+        ''' Set the sync for the upload to buffer write_idx,
+        which has just been done.
+        '''
+        frame_fences = self.frame_fences
+
+        if frame_fences is not None:
+            fence = frame_fences.frame
+        else:
+            with self.lock:
+                if self.__spare_syncs:
+                    fence = self.__spare_syncs.pop()
+                else:
+                    fence = None
+
+            if fence is None:
+                fence = _new_sync()
+            else:
+                fence.insert_fence()
+
+        with self.lock:
+            self.submitted += 1
+            self.newest_idx = self.write_idx
+            self.__buffer_sequences[self.write_idx] = self.submitted
+            self.__pending.append((self.submitted, self.write_idx, fence,
+                time.time()))
+
+    def __wait_for_oldest(self):
+        ''' Block until the oldest unfinished upload finishes,
+        or block_timeout is reached. Return True if the buffer
+        after the write index is then free to be written to,
+        otherwise False.
+        '''
+        if not self.__pending:
+            return False
+
+        sequence, idx, fence, sync_time = self.__pending[0]
+        frame_fences = self.frame_fences
+
+        # The sync is kept so the read index can still be updated
+        # from it later if this times out. The lock isn't held 
+        # whilst waiting so the textures can still be bound.
+        self.lock.release()
+        try:
+            if frame_fences is not None:
+                frame_fences.wait_for_frame(fence, self.__block_timeout)
+            else:
+                fence.block_until_signalled(timeout=self.__block_timeout,
+                        delete=False)
+        finally:
+            self.lock.acquire()
+
+        # Someone else might have moved it on in the meantime
+        self.update_read_idx()
+
+        return (self.write_idx+1)%self.n_buffers != self.read_idx
+
+    def __grow(self):
+        ''' Add a new buffer after the current write index, if
+        there are fewer than max_buffers. Return True if the 
+        buffer was added, otherwise False.
+        '''
+        if (self.__max_buffers is None or
+                self.n_buffers >= self.__max_buffers or 
+                self.__insert_buffer is None or
+                self.pixel_buffers.persistent):
+            return False
+
+        idx = self.write_idx + 1
+
+        if not self.__insert_buffer(idx):
+            return False
+
+        self.pixel_buffers.insert(idx)
+
+        # The new buffer is uploaded to straight away.
+        self.__buffer_sequences.insert(idx, None)
+
+        self.__pending = collections.deque(
+                (sequence, each_idx + (each_idx >= idx), fence, sync_time)
+                for sequence, each_idx, fence, sync_time in self.__pending)
+
+        self.n_buffers += 1
+
+        if self.read_idx >= idx:
+            self.read_idx += 1
+
+        if self.newest_idx >= idx:
+            self.newest_idx += 1
+
+        return True
+
+    def queue_upload(self, method, args, replaceable=False):
+        ''' If there is an upload worker and this isn't its thread,
+        queue method(*args) to be called by the worker and return
+        whether it was queued. Otherwise return None, and the upload
+        should be done straight away.
+
+        replaceable says whether the upload can be replaced by
+        a later one with the REPLACE_PENDING policy.
+        '''
+        worker = self.upload_worker
+
+        if worker is None or worker.is_worker_thread():
+            return None
+
+        if replaceable and self.__backpressure == REPLACE_PENDING:
+            with self.lock:
+                replacing = self.__mailbox is not None
+                self.__mailbox = (method, args)
+
+            if replacing:
+                # The queued upload will use the new frame instead
+                self.counters['frames_replaced'] += 1
+
+                if self.on_drop is not None:
+                    self.on_drop('replaced')
+
+                return True
+
+            method, args = self.__upload_mailbox, ()
+
+        if not worker.submit(method, args, 
+                block=(self.__backpressure == BLOCK), 
+                timeout=self.__block_timeout):
+
+            self.counters['frames_dropped'] += 1
+
+            if method == self.__upload_mailbox:
+                with self.lock:
+                    self.__mailbox = None
+
+            if self.on_drop is not None:
+                self.on_drop('dropped')
+
+            return False
+
+        return True
+
+    def __upload_mailbox(self):
+        ''' Do the upload that is waiting in the mailbox. This is
+        queued on the upload worker by queue_upload.
+        '''
+        with self.lock:
+            method, args = self.__mailbox
+            self.__mailbox = None
+
+        method(*args)
+
+class _UploadStats(object):
+    ''' Rolling statistics of the time taken by each phase of
+    the uploads of a stream (see TextureStream2D.stats()), over
+    the last window times. An upload is timed by calling start(),
+    then lap() at the end of each phase, then finish().
+    '''
+    def __init__(self, window=1000):
+        self.__window = window
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__times = dict([
+                (phase, collections.deque(maxlen=self.__window))
+                for phase in UPLOAD_PHASES])
+            self.__counts = dict.fromkeys(UPLOAD_PHASES, 0)
+            self.__bytes = collections.deque(maxlen=self.__window)
+
+        self.__upload = {}
+        self.__start_time = self.__lap_time = time.time()
+
+    def start(self):
+        ''' Start timing an upload.
+        '''
+        self.__upload = {}
+        self.__start_time = self.__lap_time = time.time()
+
+    def lap(self, phase):
+        ''' Record the time since the last lap (or the start) as
+        the time taken by phase.
+        '''
+        now = time.time()
+        self.__upload[phase] = now - self.__lap_time
+        self.add(phase, now - self.__lap_time)
+        self.__lap_time = now
+
+    def finish(self, n_bytes):
+        ''' Finish timing an upload of n_bytes bytes, and return
+        a dictionary of the time taken by each of its phases.
+        '''
+        duration = time.time() - self.__start_time
+        self.__upload['upload'] = duration
+
+        with self.__lock:
+            self.__bytes.append(n_bytes)
+
+        self.add('upload', duration)
+
+        return self.__upload
+
+    def add(self, phase, duration):
+        ''' Add a time taken by phase.
+        '''
+        with self.__lock:
+            self.__times[phase].append(duration)
+            self.__counts[phase] += 1
+
+    def stats(self):
+        with self.__lock:
+            times = dict([(phase, numpy.array(self.__times[phase]))
+                for phase in UPLOAD_PHASES])
+            counts = dict(self.__counts)
+            n_bytes = sum(self.__bytes)
+
+        stats = {}
+        for phase in UPLOAD_PHASES:
+            phase_times = times[phase]
+
+            if len(phase_times):
+                mean = float(phase_times.mean())
+                p50, p99 = [float(each) for each in
+                        numpy.percentile(phase_times, [50, 99])]
+            else:
+                mean = p50 = p99 = None
+
+            stats[phase] = {'count': counts[phase], 'mean': mean,
+                    'p50': p50, 'p99': p99}
+
+        upload_time = times['upload'].sum()
+
+        if upload_time > 0:
+            stats['bytes_per_second'] = n_bytes / upload_time
+        else:
+            stats['bytes_per_second'] = 0.0
+
+        return stats
+
+class _GPUTimer(object):
+    ''' Times uploads on the card with a pair of GL_TIMESTAMP
+    queries for each buffer of a ring, put either side of the
+    upload. Like the syncs, the queries for a buffer are only
+    reused once its upload is done with, and the results are
+    only read back once they are available, so nothing waits
+    for the card. Timestamps are used rather than GL_TIME_ELAPSED
+    so they can't clash with a time elapsed query of the caller.
+
+    The queries belong to the context they were made in, so
+    those for each buffer are only made by the first start() for
+    it, and everything but making the timer must be done on the
+    thread that does the uploads (the upload worker's, if there
+    is one).
+
+    GLExtensionNotAvailable is raised if timer queries
+    (ARB_timer_query) are not available.
+    '''
+    def __init__(self, n_buffers):
+        if not (GL.glGenQueries and GL.glQueryCounter and
+                GL.glGetQueryObjectui64v):
+            raise GLExtensionNotAvailable
+
+        # Implementations can have timer queries with no bits
+        if not GL.glGetQueryiv(GL.GL_TIMESTAMP, GL.GL_QUERY_COUNTER_BITS):
+            raise GLExtensionNotAvailable
+
+        # None for the buffers whose queries haven't been made yet
+        self.__queries = [None] * n_buffers
+        self.__pending = [False] * n_buffers
+
+    def insert(self, idx):
+        ''' Make room for the queries of a new buffer at idx.
+        '''
+        self.__queries.insert(idx, None)
+        self.__pending.insert(idx, False)
+
+    def delete(self):
+        ''' Delete all the queries.
+        '''
+        for queries in self.__queries:
+            if queries is not None:
+                GL.glDeleteQueries(2, queries)
+
+        self.__queries = []
+        self.__pending = []
+
+    def start(self, idx):
+        ''' Start timing an upload to buffer idx. The result of
+        an earlier upload to it that isn't available yet is lost.
+        '''
+        if self.__queries[idx] is None:
+            self.__queries[idx] = list(GL.glGenQueries(2))
+
+        self.__pending[idx] = False
+        GL.glQueryCounter(self.__queries[idx][0], GL.GL_TIMESTAMP)
+
+    def stop(self, idx):
+        ''' Finish timing the upload to buffer idx.
+        '''
+        GL.glQueryCounter(self.__queries[idx][1], GL.GL_TIMESTAMP)
+        self.__pending[idx] = True
+
+    def poll(self):
+        ''' Return a list of (idx, seconds) for each buffer with an
+        upload time that has become available since the last poll.
+        '''
+        times = []
+        for idx, queries in enumerate(self.__queries):
+            if not self.__pending[idx]:
+                continue
+
+            start_query, stop_query = queries
+
+            # The queries finish in order, so the start is ready if
+            # the stop is.
+            if not GL.glGetQueryObjectiv(stop_query,
+                    GL.GL_QUERY_RESULT_AVAILABLE):
+                continue
+
+            start, stop = ctypes.c_uint64(0), ctypes.c_uint64(0)
+            GL.glGetQueryObjectui64v(start_query, GL.GL_QUERY_RESULT,
+                    ctypes.byref(start))
+            GL.glGetQueryObjectui64v(stop_query, GL.GL_QUERY_RESULT,
+                    ctypes.byref(stop))
+
+            self.__pending[idx] = False
+            times.append((idx, (stop.value - start.value) * 1e-9))
+
+        return times
+
+def _gl_constant(value, constants):
+    ''' Return the GL constant in constants (a sequence or the
+    keys of a dictionary) that is equal to value, or value as an
+    int if there isn't one.
+    '''
+    for constant in constants:
+        if constant == value:
+            return constant
+
+    return int(value)
+
+def _bytes_per_texel(gl_type, gl_format):
+    ''' Return the bytes per texel of gl_type and gl_format,
+    from GL_TYPES and GL_FORMATS.
+    '''
+    if GL_TYPES[gl_type][1]:
+        return GL_TYPES[gl_type][0] * GL_FORMATS[gl_format]
+    else:
+        return GL_TYPES[gl_type][0]
+
+def _new_sync():
+    ''' Return a new GLSyncObject, or a GLDummySyncObject if
+    syncs aren't available.
+    '''
+    try:
+        return GLSyncObject()
+    except GLExtensionNotAvailable:
+        return GLDummySyncObject()
+
+def _new_pixel_buffers(n_buffers, buffer_size, buffer_usage, 
+        persistent_mapping=False, upload_method=None):
+    ''' Return a new set of n_buffers pixel buffers of
+    buffer_size bytes each, that get the data to GL with
+    upload_method (one of UPLOAD_METHODS) if that is possible.
+    If upload_method isn't given, they are persistently mapped if
+    that is asked for and possible. Otherwise they are orphaned.
+    '''
+    if upload_method is None:
+        if persistent_mapping:
+            upload_method = PERSISTENT
+        else:
+            upload_method = ORPHAN
+
+    if upload_method == PERSISTENT:
+        try:
+            return _PersistentPixelBuffers(n_buffers, buffer_size)
+        except GLExtensionNotAvailable:
+            pass
+
+    elif upload_method == CLIENT_MEMORY:
+        return _ClientMemoryPixelBuffers(n_buffers, buffer_size)
+
+    elif upload_method in (INVALIDATE, BUFFER_SUB_DATA):
+        try:
+            return _OrphanedPixelBuffers(n_buffers, buffer_size,
+                    buffer_usage, upload_method)
+        except GLExtensionNotAvailable:
+            pass
+
+    return _OrphanedPixelBuffers(n_buffers, buffer_size, buffer_usage)
+
+def _aligned(n_bytes, alignment=8):
+    ''' Round n_bytes up to a multiple of alignment.
+    '''
+    return -(-n_bytes//alignment) * alignment
+
+def _mapped_array(pointer, shape, dtype):
+    ''' Return a numpy array of the given shape and dtype
+    that uses the memory at pointer (such as a mapped buffer)
+    directly. The memory must remain valid for as long as
+    the array is used.
+    '''
+    dtype = numpy.dtype(dtype)
+    n_bytes = int(numpy.prod(shape)) * dtype.itemsize
+    memory = (ctypes.c_ubyte * n_bytes).from_address(pointer)
+    return numpy.frombuffer(memory, dtype=dtype).reshape(shape)
+
+def _copy_to_pixel_buffer(pointer, data, bytes_per_texel, max_bytes,
+        component_size=None, convert_dtype=None):
+    ''' Copy the image in data, which needn't be contiguous or
+    native endian, into the mapped pixel buffer memory at pointer,
+    using no more than max_bytes of it. Return the number of bytes
+    copied and the (row_length, alignment, swap_bytes) arguments to
+    _set_unpack_layout() that GL should read the image back with.
+
+    Where GL can do the work through its unpack parameters, the
+    memory the image is in is copied as it is with a single
+    memmove:
+
+    If the rows are contiguous but spaced out (a cropped view or
+    a padded camera buffer), the memory they span is copied, and
+    GL_UNPACK_ROW_LENGTH (or GL_UNPACK_ALIGNMENT, if the rows are
+    just padded to it) skips the gaps. This is only done if the
+    gaps are no bigger than the image.
+
+    If the data is byte swapped, GL_UNPACK_SWAP_BYTES swaps it back,
+    provided each array element is a component of component_size
+    bytes.
+
+    Otherwise numpy copies the image row by row into a tightly
+    packed native array over the buffer. Either way, no temporary
+    copy of the image is made.
+
+    component_size is the size in bytes of each component of the GL
+    type, or None if GL can't unpack the data (as for compressed
+    blocks).
+
+    If convert_dtype is given and the data is floats of a different
+    size, numpy converts it to convert_dtype as it copies it (a block at
+    a time, so again without a temporary copy of the image). This
+    is used to turn float32 data into half floats.
+
+    ValueError is raised if the image (converted or not) is more
+    than max_bytes.
+    '''
+    if (convert_dtype is not None and data.dtype.kind == 'f' and
+            data.itemsize != convert_dtype.itemsize):
+
+        if data.size * convert_dtype.itemsize > max_bytes:
+            raise ValueError('The data array is larger than the '\
+                    'pixel buffer.')
+
+        converted = _mapped_array(pointer, data.shape, convert_dtype)
+        converted[...] = data
+
+        return converted.nbytes, (0, 1, False)
+
+    if data.nbytes > max_bytes:
+        raise ValueError('The data array is larger than the pixel buffer.')
+
+    rows, cols = data.shape[0:2]
+    row_bytes = cols * bytes_per_texel
+
+    swapped = not data.dtype.isnative and data.itemsize > 1
+    swap_bytes = swapped and data.itemsize == component_size
+
+    if component_size is not None and (swap_bytes or not swapped):
+
+        if data.flags.c_contiguous:
+            ctypes.memmove(pointer, data.ctypes.data, data.nbytes)
+            return data.nbytes, (0, 1, swap_bytes)
+
+        pitch = data.strides[0]
+        span = (rows - 1) * pitch + row_bytes
+
+        layout = None
+        if data[0].flags.c_contiguous and pitch > row_bytes:
+            if pitch % bytes_per_texel == 0:
+                layout = (pitch // bytes_per_texel, 1, swap_bytes)
+            else:
+                # Rows padded out to the alignment
+                for alignment in (2, 4, 8):
+                    if (component_size < alignment and
+                            pitch == _aligned(row_bytes, alignment)):
+                        layout = (0, alignment, swap_bytes)
+                        break
+
+        if (layout is not None and span <= max_bytes and
+                span <= 2 * data.nbytes):
+            ctypes.memmove(pointer, data.ctypes.data, span)
+            return span, layout
+
+    _mapped_array(pointer, data.shape,
+            data.dtype.newbyteorder('='))[...] = data
+
+    return data.nbytes, (0, 1, False)
+
+def _set_unpack_layout(row_length=0, alignment=4, swap_bytes=False):
+    ''' Set how GL reads images out of memory or a pixel buffer,
+    with the GL_UNPACK_ROW_LENGTH, GL_UNPACK_ALIGNMENT and
+    GL_UNPACK_SWAP_BYTES pixel store parameters. The defaults are
+    GL's own, so calling this with no arguments puts them back.
+    '''
+    GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, row_length)
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, alignment)
+    GL.glPixelStorei(GL.GL_UNPACK_SWAP_BYTES, swap_bytes)
+
+def _gl_integer(pname):
+    ''' Return the integer state pname from glGetIntegerv.
+    '''
+    return int(numpy.ravel(GL.glGetIntegerv(pname))[0])
+
+def _compile_program(vertex_source, fragment_source):
+    ''' Compile and link a program from the source of a vertex
+    and a fragment shader, and return its name. RuntimeError is
+    raised, with the log, if either doesn't compile or it doesn't
+    link.
+    '''
+    program = GL.glCreateProgram()
+
+    for source, shader_type in ((vertex_source, GL.GL_VERTEX_SHADER),
+            (fragment_source, GL.GL_FRAGMENT_SHADER)):
+        shader = GL.glCreateShader(shader_type)
+        GL.glShaderSource(shader, source)
+        GL.glCompileShader(shader)
+
+        if not GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS):
+            raise RuntimeError('Problem compiling a shader: ' + 
+                    str(GL.glGetShaderInfoLog(shader)))
+
+        GL.glAttachShader(program, shader)
+        GL.glDeleteShader(shader)
+
+    GL.glLinkProgram(program)
+
+    if not GL.glGetProgramiv(program, GL.GL_LINK_STATUS):
+        raise RuntimeError('Problem linking a program: ' + 
+                str(GL.glGetProgramInfoLog(program)))
+
+    return program
+
+def _region_contains(outer, inner):
+    ''' Return whether the (x, y, width, height) region inner
+    lies entirely within the region outer.
+    '''
+    return (inner[0] >= outer[0] and inner[1] >= outer[1] and 
+            inner[0] + inner[2] <= outer[0] + outer[2] and 
+            inner[1] + inner[3] <= outer[1] + outer[3])
+
+def _region_bounds(regions):
+    ''' Return the smallest (x, y, width, height) region that
+    contains all of the passed regions.
+    '''
+    x0 = min([each[0] for each in regions])
+    y0 = min([each[1] for each in regions])
+    x1 = max([each[0] + each[2] for each in regions])
+    y1 = max([each[1] + each[3] for each in regions])
+
+    return (x0, y0, x1 - x0, y1 - y0)
+
+class _RectanglePacker(object):
+    ''' Packs rectangles into a width by height area, keeping
+    a list of the free rectangles. Each allocation goes in the
+    free rectangle it fits best, which is split in two along the
+    shorter leftover side (a guillotine packer). Freed rectangles
+    go back in the list, merged with any free neighbours they
+    line up with.
+    '''
+    def __init__(self, width, height):
+        self.free_rects = [(0, 0, width, height)]
+
+    def allocate(self, width, height):
+        ''' Return the (x, y) position of a free width by height
+        rectangle, which is then no longer free, or None if there
+        isn't room.
+        '''
+        best = None
+        best_fit = None
+        for n, (x, y, w, h) in enumerate(self.free_rects):
+            if w >= width and h >= height:
+                fit = (w*h - width*height, min(w - width, h - height))
+                if best_fit is None or fit < best_fit:
+                    best, best_fit = n, fit
+
+        if best is None:
+            return None
+
+        x, y, w, h = self.free_rects.pop(best)
+
+        if (w - width) < (h - height):
+            # The right keeps to the allocation's rows
+            right = (x + width, y, w - width, height)
+            below = (x, y + height, w, h - height)
+        else:
+            # The part below keeps to the allocation's columns
+            right = (x + width, y, w - width, h)
+            below = (x, y + height, width, h - height)
+
+        for rect in (right, below):
+            if rect[2] > 0 and rect[3] > 0:
+                self.free_rects.append(rect)
+
+        return (x, y)
+
+    def free(self, rect):
+        ''' Make rect, an (x, y, width, height) tuple that was
+        allocated, free again.
+        '''
+        merged = True
+        while merged:
+            merged = False
+            x, y, w, h = rect
+            for n, (fx, fy, fw, fh) in enumerate(self.free_rects):
+                if fx == x and fw == w and (fy + fh == y or y + h == fy):
+                    rect = (x, min(y, fy), w, h + fh)
+                elif fy == y and fh == h and (fx + fw == x or x + w == fx):
+                    rect = (min(x, fx), y, w + fw, h)
+                else:
+                    continue
+
+                del self.free_rects[n]
+                merged = True
+                break
+
+        self.free_rects.append(rect)
+
+class _OrphanedPixelBuffers(object):
+    ''' The pixel buffers used by TextureStream2D by default.
+    There is one pixel buffer object per buffer, and each is
+    orphaned before it is written so the driver can hand back
+    fresh memory rather than wait for any transfer still using
+    the old memory.
+
+    How it is orphaned and written depends on method:
+
+    ORPHAN: glBufferData with no data, then glMapBuffer.
+    INVALIDATE: glMapBufferRange with GL_MAP_INVALIDATE_BUFFER_BIT.
+    GLExtensionNotAvailable is raised if there is no
+    glMapBufferRange.
+    BUFFER_SUB_DATA: map() hands out client memory, and unmap()
+    orphans the buffer with glBufferData and copies the client
+    memory into it with glBufferSubData.
+    '''
+    persistent = False
+
+    def __init__(self, n_buffers, buffer_size, buffer_usage, method=ORPHAN):
+
+        if method == INVALIDATE and not GL.glMapBufferRange:
+            raise GLExtensionNotAvailable
+
+        self.method = method
+
+        self.__buffer_size = buffer_size
+        self.__buffer_usage = buffer_usage
+
+        if method == BUFFER_SUB_DATA:
+            self.__memory = numpy.empty(buffer_size, dtype='uint8')
+        else:
+            self.__memory = None
+
+        self.__pixel_buffers = GL.glGenBuffers(n_buffers)
+        if n_buffers == 1:
+            self.__pixel_buffers = [self.__pixel_buffers]
+        else:
+            self.__pixel_buffers = list(self.__pixel_buffers)
+
+        for pixel_buffer in self.__pixel_buffers:
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pixel_buffer)
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.__buffer_size, 
+                    None, self.__buffer_usage)
+
+        # we're finished setting up the buffers so
+        # we bind it to 0
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def insert(self, idx):
+        ''' Insert a new buffer at idx.
+        '''
+        pixel_buffer = GL.glGenBuffers(1)
+
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pixel_buffer)
+        GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.__buffer_size, 
+                None, self.__buffer_usage)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        self.__pixel_buffers.insert(idx, pixel_buffer)
 
-    def update_texture_with_clear(self, data):
-        ''' Update the texture with a passed data array.
+    def delete(self):
+        ''' Delete all the buffers.
+        '''
+        GL.glDeleteBuffers(len(self.__pixel_buffers), self.__pixel_buffers)
+        self.__pixel_buffers = []
 
-        The data is expected to be a three-dimensional
-        array of size NxMxP (c-ordering), where N and M
-        are the dimensions of the image and P is the
-        number of array elements per texel. The type
-        should agree with that set by the gl_type argument
-        at instantiation. P only really makes a lot of
-        sense if each array element that together make up
-        a texel are the same size. For example, if the
-        type is GL_UNSIGNED_SHORT_5_5_5_1, then its 2
-        bytes per texel, but with a differing number of
-        bits per colour, in which case the array can just
-        be two-dimensional.  The crucial test is that
-        data.itemsize*P is equal to the number of bytes
-        per texel expected by gl_type.  Its up to you how
-        the data is packed beyond that.
+    def map(self, idx, stats=None):
+        ''' Bind buffer idx, orphan it and map it. Return
+        a pointer to the mapped memory. If stats is given, the
+        orphaning and mapping are timed with it.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffers[idx])
 
-        This method will fill the texture from the
-        beginning of the texture memory.  If the shape of
-        data is different to a previous call to this
-        method, then the texture is cleared first. The
-        assumption is that the size will change rarely.
-        
-        If the data is bigger than the texture, an
-        exception is raised.
+        if self.method == BUFFER_SUB_DATA:
+            return self.__memory.ctypes.data
 
-        If an attempt is made to upload a texture whilst
-        non of the previous uploads have finished and
-        there are no more remaining buffers that are 
-        currently unused (either for upload or for
-        reading) then the data will just be ignored.
+        if self.method == INVALIDATE:
+            pointer = GL.glMapBufferRange(GL.GL_PIXEL_UNPACK_BUFFER, 0,
+                    self.__buffer_size,
+                    GL.GL_MAP_WRITE_BIT | GL.GL_MAP_INVALIDATE_BUFFER_BIT)
+        else:
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.__buffer_size,
+                    None, self.__buffer_usage)
+
+            if stats is not None:
+                stats.lap('orphan')
+
+            pointer = GL.glMapBuffer(GL.GL_PIXEL_UNPACK_BUFFER,
+                    GL.GL_WRITE_ONLY)
+
+        if stats is not None:
+            stats.lap('map')
+
+        return pointer
+
+    def unmap(self, idx):
+        ''' Bind buffer idx and unmap it. The buffer is left
+        bound, and the offset of the mapped memory in it is 
+        returned.
         '''
-        if not self.__set_next_write_idx():
-            return None
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffers[idx])
 
-        GL.glActiveTexture(self.__texture_unit)
-        
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 
-                self.__textures[self.__write_idx])
-        
-        # get the bytes per texel from GL_TYPES and GL_FORMATS
-        if GL_TYPES[self.__gl_type][1]:
-            bytes_per_texel = \
-                    GL_TYPES[self.__gl_type][0] * GL_FORMATS[self.__gl_format]
+        if self.method == BUFFER_SUB_DATA:
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.__buffer_size,
+                    None, self.__buffer_usage)
+            GL.glBufferSubData(GL.GL_PIXEL_UNPACK_BUFFER, 0,
+                    self.__buffer_size, self.__memory)
         else:
-            bytes_per_texel = GL_TYPES[self.__gl_type][0]
-        
-        # Compute the buffer size from the defaults
-        buffer_size = self.__size[0]*self.__size[1]*bytes_per_texel
-        
-        # Clear the texture if the new data is smaller than
-        # the old data in either dimension.
-        if data.shape[0:2] < self.__texture_silhouette:
-            zero_texture = numpy.zeros(buffer_size, dtype='uint8')
-            
-            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 
-                    self.__pixel_buffers[self.__write_idx])
-            
-            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, buffer_size, 
-                        zero_texture, self.__buffer_usage)
+            GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
 
-            self.__texture_silhouette = data.shape[0:2]
-            # Unbind the buffer
-            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
-        
-        self.__update_texture(data)
-        
-        # Unbind the texture
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        return 0
+
+    def clear(self, idx):
+        ''' Bind buffer idx and fill it with zeros.
+        '''
+        zero_texture = numpy.zeros(self.__buffer_size, dtype='uint8')
+
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffers[idx])
+
+        GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.__buffer_size, 
+                    zero_texture, self.__buffer_usage)
+
+class _ClientMemoryPixelBuffers(object):
+    ''' Stand-ins for pixel buffers for TextureStream2D that use
+    none at all. Every buffer is the same piece of client memory,
+    and unmap() leaves no pixel buffer bound and returns the
+    address of the memory as the offset, so glTexSubImage2D reads
+    the data straight out of it. GL has copied the data by the
+    time glTexSubImage2D returns, so the memory can be reused
+    straight away.
+    '''
+    persistent = False
+    method = CLIENT_MEMORY
+
+    def __init__(self, n_buffers, buffer_size):
+        self.__memory = numpy.zeros(buffer_size, dtype='uint8')
+
+    def insert(self, idx):
+        pass
+
+    def delete(self):
+        self.__memory = None
+
+    def map(self, idx, stats=None):
+        ''' Unbind any pixel buffer and return a pointer to the
+        memory. If stats is given, this is timed with it.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        if stats is not None:
+            stats.lap('map')
+
+        return self.__memory.ctypes.data
+
+    def unmap(self, idx):
+        ''' Unbind any pixel buffer and return the address of
+        the memory.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+        return self.__memory.ctypes.data
+
+    def clear(self, idx):
+        ''' Unbind any pixel buffer and fill the memory with
+        zeros.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+        self.__memory[:] = 0
+
+class _PersistentPixelBuffers(object):
+    ''' Pixel buffers for TextureStream2D that live in a single
+    buffer object with immutable storage, which is mapped
+    persistently and coherently when it is created. Buffer idx
+    is then just the idx'th slice of that mapping, so an upload
+    needs no GL calls to get at the memory, and the buffer is
+    never reallocated.
+
+    There is no orphaning, so a slice must not be written whilst
+    the GPU could still be copying out of it. TextureStream2D
+    never writes to a buffer newer than the one currently being
+    read from, and the fences guarantee that every buffer older
+    than that one has been copied out of.
+
+    GLExtensionNotAvailable is raised if ARB_buffer_storage is not
+    available.
+    '''
+    persistent = True
+    method = PERSISTENT
+
+    # Each slice is aligned to this many bytes.
+    ALIGNMENT = 64
+
+    ACCESS = (GL.GL_MAP_WRITE_BIT | GL.GL_MAP_PERSISTENT_BIT | 
+            GL.GL_MAP_COHERENT_BIT)
+
+    def __init__(self, n_buffers, buffer_size):
+
+        if not (GL.glBufferStorage and GL.glMapBufferRange):
+            raise GLExtensionNotAvailable
+
+        self.__buffer_size = buffer_size
+        self.__stride = _aligned(buffer_size, self.ALIGNMENT)
+
+        self.__pixel_buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffer)
+        GL.glBufferStorage(GL.GL_PIXEL_UNPACK_BUFFER, 
+                self.__stride*n_buffers, None, self.ACCESS)
+
+        self.__pointer = GL.glMapBufferRange(GL.GL_PIXEL_UNPACK_BUFFER, 
+                0, self.__stride*n_buffers, self.ACCESS)
+
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        if not self.__pointer:
+            GL.glDeleteBuffers(1, [self.__pixel_buffer])
+            raise GLExtensionNotAvailable
+
+    def delete(self):
+        ''' Unmap and delete the buffer.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffer)
+        GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        GL.glDeleteBuffers(1, [self.__pixel_buffer])
+
+    def map(self, idx, stats=None):
+        ''' Bind the buffer and return a pointer to slice idx
+        of the persistent mapping. If stats is given, this is
+        timed with it.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffer)
+
+        if stats is not None:
+            stats.lap('map')
+
+        return self.__pointer + idx*self.__stride
+
+    def unmap(self, idx):
+        ''' Nothing needs unmapping, but the buffer is bound and
+        the offset of slice idx in it is returned.
+        '''
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.__pixel_buffer)
+        return idx*self.__stride
+
+    def clear(self, idx):
+        ''' Bind the buffer and fill slice idx with zeros.
+        '''
+        ctypes.memset(self.map(idx), 0, self.__buffer_size)
 
 class GLExtensionNotAvailable(Exception):
     pass
 
+class TextureAtlasFull(Exception):
+    pass
+
 class GLDummySyncObject(object):
     ''' A dummy sync object that always returns true
     for the state of the fence sync.
@@ -559,10 +5499,16 @@ class GLDummySyncObject(object):
     GL_CONDITION_SATISFIED = True
     GL_WAIT_FAILED = False
 
+    def insert_fence(self):
+        pass
+
     def delete_sync(self):
         pass
 
-    def block_until_signalled(self, timeout=1.0):
+    def wait_on_server(self):
+        pass
+
+    def block_until_signalled(self, timeout=1.0, delete=True):
         return self.GL_CONDITION_SATISFIED
 
     def get_fence_signalled(self):
@@ -571,6 +5517,12 @@ class GLDummySyncObject(object):
     def get_fence_signalled_and_delete(self):
         return True
 
+    def get_deleted(self):
+        return False
+
+    def when_signalled(self, callback, poller=None):
+        _fence_poller(poller).add(self, callback)
+
 
 class GLSyncObject(object):
     ''' A pythonic wrapper around the GL fence sync
@@ -591,25 +5543,48 @@ class GLSyncObject(object):
             GL_sync.GL_WAIT_FAILED: GL_WAIT_FAILED}
 
     def __init__(self):
+
+        self.__sync = None
         
         if not GL_sync.glFenceSync:
             raise GLExtensionNotAvailable 
         
-        self.__sync = \
-                GL_sync.glFenceSync(GL_sync.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.insert_fence()
 
     def __del__(self):
         self.delete_sync()
 
+    def insert_fence(self):
+        ''' Delete the fence, if it hasn't been already, and put
+        a new one into the command stream in its place. This lets
+        the object be reused, rather than a new one being made
+        for every fence.
+        '''
+        self.delete_sync()
+
+        self.__sync = \
+                GL_sync.glFenceSync(GL_sync.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
     def delete_sync(self):
         if self.__sync is not None:
             GL_sync.glDeleteSync(self.__sync)
             self.__sync = None
 
-    def block_until_signalled(self, timeout=1.0):
+    def wait_on_server(self):
+        ''' Have the card wait for the fence before it carries on
+        with the commands that follow, without blocking here
+        (glWaitSync). This is how a context waits for work done
+        in another context, which must have flushed the fence.
+        '''
+        # PyOpenGL's GL_TIMEOUT_IGNORED has the wrong value
+        if self.__sync is not None:
+            GL_sync.glWaitSync(self.__sync, 0, 0xFFFFFFFFFFFFFFFF)
+
+    def block_until_signalled(self, timeout=1.0, delete=True):
         ''' Blocks until the fence has been signalled
         with the timeout given by timeout (in seconds).
-        Always delete the sync object before returning.
+        Always delete the sync object before returning,
+        unless delete is False.
         
         This uses the built in glClientWaitSync method
         and passes back the return value. The return
@@ -634,7 +5609,9 @@ class GLSyncObject(object):
             status = GL_sync.glClientWaitSync(self.__sync,
                     GL_sync.GL_SYNC_FLUSH_COMMANDS_BIT, ns_timeout)
             
-            self.delete_sync()
+            if delete:
+                self.delete_sync()
+
             return self.TIMEOUT_STATUS[status]
         
         else:
@@ -647,9 +5624,12 @@ class GLSyncObject(object):
         '''
         if self.__sync is not None:
             fence_status = GL.GLint(0)
+            # The length isn't wanted. PyOpenGL (3.1.5 at least)
+            # only takes None for it, and a plain int for the
+            # buffer size.
             GL_sync.glGetSynciv(self.__sync,
                     GL_sync.GL_SYNC_STATUS,
-                    GL.GLint(1), GL.GLint(0), fence_status)
+                    1, None, fence_status)
             
             return (GL_sync.GL_SIGNALED == fence_status.value)
 
@@ -668,3 +5648,466 @@ class GLSyncObject(object):
         
         return signalled
 
+    def get_deleted(self):
+        ''' Returns whether the sync has been deleted, after
+        which get_fence_signalled() is always False.
+        '''
+        return self.__sync is None
+
+    def when_signalled(self, callback, poller=None):
+        ''' Call callback with this object once the fence has
+        been signalled, rather than waiting for it. The fence is
+        checked each time poller (a FencePoller) is polled, which
+        is the module's poller from get_fence_poller() unless one
+        is given. For example, to carry on once an upload is done
+        without blocking the GUI thread:
+
+        get_fence_poller().attach_to_qt()
+        GLSyncObject().when_signalled(lambda fence: carry_on())
+
+        The poller holds on to the object until then, so it
+        needn't be kept. The fence isn't deleted before the
+        callback, so it can still be checked by it. If it is
+        deleted by anything else first (such as by 
+        block_until_signalled()), it is taken to have been
+        signalled.
+        '''
+        _fence_poller(poller).add(self, callback)
+
+class FrameFences(object):
+    ''' A single fence a frame, shared by any number of texture
+    streams (see the frame_fences argument of TextureStream2D).
+    Rather than each stream setting a sync after each upload and
+    checking it when binding, the streams note which frame each
+    upload was made in, end_frame() sets one fence at the end of
+    each frame, and the uploads of a frame have finished once its
+    fence has been signalled. The fences are checked at most once
+    a frame, however many streams ask, so the sync overhead
+    doesn't grow with the number of streams.
+
+    frame is the number of the frame uploads are being made in,
+    starting from 0.
+
+    All the streams must upload from the thread (and context)
+    end_frame() is called on.
+    '''
+    def __init__(self):
+        self.frame = 0
+
+        self.__lock = threading.Lock()
+        # The frames that haven't been seen to finish, oldest
+        # first, as tuples of (frame, sync).
+        self.__pending = collections.deque()
+        self.__spare_syncs = []
+        self.__completed_frame = -1
+        self.__checked = False
+
+    def end_frame(self):
+        '''Set the fence for the current frame, after everything
+        that has been done in it (such as at the end of the
+        rendering code), and move on to the next frame.
+        '''
+        with self.__lock:
+            if self.__spare_syncs:
+                sync = self.__spare_syncs.pop()
+                sync.insert_fence()
+            else:
+                sync = _new_sync()
+
+            self.__pending.append((self.frame, sync))
+            self.frame += 1
+            self.__checked = False
+
+    def get_completed_frame(self):
+        '''Return the number of the newest frame that has
+        finished, or -1 if none have. The fences are only checked
+        the first time this is called after end_frame(), starting
+        from the oldest and stopping at the first that hasn't been
+        signalled, so it is usually a single query.
+        '''
+        with self.__lock:
+            if not self.__checked:
+                self.__update_completed_frame()
+                self.__checked = True
+
+            return self.__completed_frame
+
+    def wait_for_frame(self, frame, timeout=1.0):
+        '''Block until frame has finished, or for up to timeout
+        seconds. Return whether it has finished. A frame that
+        hasn't been ended yet can't finish, so False is returned
+        straight away for it.
+        '''
+        with self.__lock:
+            sync = None
+            for pending_frame, pending_sync in self.__pending:
+                if pending_frame == frame:
+                    sync = pending_sync
+                    break
+
+        if sync is not None:
+            sync.block_until_signalled(timeout=timeout, delete=False)
+
+        with self.__lock:
+            self.__update_completed_frame()
+            return self.__completed_frame >= frame
+
+    def __update_completed_frame(self):
+        ''' The frames finish in order, so only the oldest fence
+        needs checking, and the next if it has been signalled,
+        and so on.
+        '''
+        while self.__pending:
+            frame, sync = self.__pending[0]
+
+            if not sync.get_fence_signalled_and_delete():
+                break
+
+            self.__pending.popleft()
+            self.__spare_syncs.append(sync)
+            self.__completed_frame = frame
+
+class FencePoller(object):
+    ''' Calls back when fences are signalled (see
+    GLSyncObject.when_signalled()), so that work can be chained on
+    to the end of an upload without anything spinning or blocking
+    in glClientWaitSync.
+
+    A single poller checks all the fences added to it, each time
+    poll() is called. It can be driven by a Qt timer with
+    attach_to_qt(), or poll() can be called from any other event
+    loop, such as once a frame from the rendering code. The
+    callbacks are made from poll(), on whichever thread calls it,
+    in the order the fences were added.
+    '''
+    def __init__(self, make_current=None):
+        ''' make_current, if given, is called (with no arguments)
+        before the fences are checked, and should make a GL context
+        current that can see them. It isn't needed if poll() is
+        only called with such a context already current.
+        '''
+        self.__make_current = make_current
+        self.__lock = threading.Lock()
+        self.__waiting = []
+        self.__timer = None
+
+    def add(self, fence, callback):
+        ''' Call callback(fence) from poll() once fence (a
+        GLSyncObject or GLDummySyncObject) has been signalled.
+        A fence whose sync is deleted in the meantime can't be
+        checked, so it is taken to have been signalled, as it
+        normally is by the time it's deleted.
+        '''
+        with self.__lock:
+            self.__waiting.append((fence, callback))
+
+        # Restarted here, as it stops when there's nothing to do
+        if self.__timer is not None and not self.__timer.isActive():
+            self.__timer.start()
+
+    def get_waiting_count(self):
+        '''Return the number of fences that haven't been signalled
+        yet.
+        '''
+        with self.__lock:
+            return len(self.__waiting)
+
+    def poll(self):
+        '''Check each fence, and make the callbacks for those that
+        have been signalled. Return the number of fences that are
+        still waiting. Exceptions raised by the callbacks are
+        printed rather than passed on, so one callback can't stop
+        the others.
+        '''
+        with self.__lock:
+            waiting = list(self.__waiting)
+
+        if not waiting:
+            if self.__timer is not None:
+                self.__timer.stop()
+
+            return 0
+
+        if self.__make_current is not None:
+            self.__make_current()
+
+        signalled = [each for each in waiting 
+                if each[0].get_deleted() or each[0].get_fence_signalled()]
+
+        if signalled:
+            signalled_ids = set(id(each) for each in signalled)
+
+            with self.__lock:
+                self.__waiting = [each for each in self.__waiting
+                        if id(each) not in signalled_ids]
+
+            for fence, callback in signalled:
+                try:
+                    callback(fence)
+                except Exception:
+                    traceback.print_exc()
+
+        return self.get_waiting_count()
+
+    def attach_to_qt(self, interval=1, parent=None):
+        '''Poll from a QTimer, every interval milliseconds whilst
+        there are fences waiting, and return the timer. The timer
+        belongs to the thread this is called from (normally the GUI
+        thread), and fences should be added from that thread too.
+        This needs PySide.
+        '''
+        from PySide import QtCore
+
+        self.detach()
+
+        self.__timer = QtCore.QTimer(parent)
+        self.__timer.setInterval(interval)
+        self.__timer.timeout.connect(self.poll)
+
+        if self.get_waiting_count():
+            self.__timer.start()
+
+        return self.__timer
+
+    def detach(self):
+        '''Stop polling from the Qt timer, if there is one.
+        '''
+        if self.__timer is not None:
+            self.__timer.stop()
+            self.__timer.timeout.disconnect(self.poll)
+            self.__timer = None
+
+_default_fence_poller = None
+
+def get_fence_poller():
+    ''' Return the module's FencePoller, which is used by
+    when_signalled() unless another is given, creating it the
+    first time.
+    '''
+    global _default_fence_poller
+
+    if _default_fence_poller is None:
+        _default_fence_poller = FencePoller()
+
+    return _default_fence_poller
+
+def _fence_poller(poller):
+    if poller is None:
+        return get_fence_poller()
+    else:
+        return poller
+
+
+# The real PyOpenGL namespaces. Everything in this module makes its
+# GL calls through the module globals GL and GL_sync, which
+# set_gl_namespace() can replace.
+_REAL_GL = GL
+_REAL_GL_sync = GL_sync
+
+def set_gl_namespace(gl=None):
+    ''' Make every GL call in this module go through gl instead of
+    PyOpenGL, much like the gl_class passed to the Renderer in
+    qml_with_simplegl_bugtest. gl needs to look like OpenGL.GL,
+    including the sync functions and constants. RecordingGL and
+    NullGL are provided for measuring and testing the code here.
+    Pass None to go back to PyOpenGL.
+
+    This affects everything in the module from then on, so it
+    should be done before any objects are created, and objects
+    should not be used across a change.
+    '''
+    global GL, GL_sync
+
+    if gl is None:
+        GL, GL_sync = _REAL_GL, _REAL_GL_sync
+    else:
+        GL = GL_sync = gl
+
+def get_gl_namespace():
+    ''' Return the GL namespace in use, as set by set_gl_namespace().
+    '''
+    return GL
+
+@contextlib.contextmanager
+def gl_namespace(gl):
+    ''' A context manager that sets the GL namespace to gl
+    (see set_gl_namespace()) and puts the previous one back
+    on exit. For example:
+
+    with gl_namespace(RecordingGL(NullGL())) as gl:
+        stream = TextureStream2D(...)
+        stream.update_texture(data)
+        print gl.counts
+    '''
+    global GL, GL_sync
+
+    previous = GL, GL_sync
+    set_gl_namespace(gl)
+
+    try:
+        yield gl
+    finally:
+        GL, GL_sync = previous
+
+class _PyOpenGL(object):
+    ''' The PyOpenGL namespace as this module uses it, with the
+    sync functions and constants taken from GL_sync.
+    '''
+    def __getattr__(self, name):
+        if name.startswith(('gl', 'GL')) and hasattr(_REAL_GL_sync, name):
+            return getattr(_REAL_GL_sync, name)
+        else:
+            return getattr(_REAL_GL, name)
+
+def _null_gl_function(*args, **kwargs):
+    return None
+
+_null_gl_function.wrappedOperation = _null_gl_function
+
+class RecordingGL(object):
+    ''' A GL namespace that passes everything on to another
+    namespace, gl (PyOpenGL by default), counting the calls to
+    each GL function in counts, a collections.Counter keyed by
+    function name. If record is True, every call is also
+    appended to calls as a tuple of (name, args).
+
+    Use it with set_gl_namespace() to find how many GL calls
+    each upload or bind makes. reset() clears the counts and
+    the calls.
+    '''
+    def __init__(self, gl=None, record=False):
+
+        if gl is None:
+            gl = _PyOpenGL()
+
+        self.__gl = gl
+        self.__record = record
+        self.__lock = threading.Lock()
+
+        self.counts = collections.Counter()
+        self.calls = []
+
+    def reset(self):
+        with self.__lock:
+            self.counts.clear()
+            del self.calls[:]
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__gl, name)
+
+        # Missing functions are left as they are, so they still
+        # test False.
+        if name.startswith('gl') and attribute:
+            attribute = self.__wrap(name, attribute)
+
+        # Only looked up once
+        setattr(self, name, attribute)
+
+        return attribute
+
+    def __wrap(self, name, function):
+
+        def recorded(*args, **kwargs):
+            with self.__lock:
+                self.counts[name] += 1
+
+                if self.__record:
+                    self.calls.append((name, args))
+
+            return function(*args, **kwargs)
+
+        # PyOpenGL functions have the raw function underneath
+        wrapped = getattr(function, 'wrappedOperation', function)
+
+        if wrapped is function:
+            recorded.wrappedOperation = recorded
+        else:
+            recorded.wrappedOperation = self.__wrap(name, wrapped)
+
+        return recorded
+
+class NullGL(object):
+    ''' A GL namespace that does nothing, so the code here can be
+    run with no context at all, to measure the time spent in
+    Python, or wrapped in RecordingGL to count the GL calls.
+
+    The constants and types are those of PyOpenGL. glGen* return
+    new names, buffers are backed by memory so that mapping them
+    gives a usable pointer, fences are always signalled and timer
+    queries have no bits, so aren't used. Every other function
+    returns None.
+    '''
+    def __init__(self):
+        self.__next_name = 1
+        self.__bound_buffers = {}
+        self.__buffer_memory = {}
+
+    def __getattr__(self, name):
+        if name.startswith('gl'):
+            return _null_gl_function
+        else:
+            return getattr(_REAL_GL, name)
+
+    def __new_names(self, n):
+        names = range(self.__next_name, self.__next_name + n)
+        self.__next_name += n
+
+        if n == 1:
+            return names[0]
+        else:
+            return numpy.array(names, dtype='uint32')
+
+    def glGenTextures(self, n):
+        return self.__new_names(n)
+
+    def glGenBuffers(self, n):
+        return self.__new_names(n)
+
+    def glGenQueries(self, n):
+        return self.__new_names(n)
+
+    def glBindBuffer(self, target, buffer):
+        self.__bound_buffers[target] = buffer
+
+    def glBufferData(self, target, size, data, usage):
+        buffer = self.__bound_buffers[target]
+        memory = self.__buffer_memory.get(buffer)
+
+        # Orphaning reuses the memory
+        if memory is None or len(memory) != size:
+            self.__buffer_memory[buffer] = ctypes.create_string_buffer(size)
+
+    def glBufferStorage(self, target, size, data, flags):
+        self.glBufferData(target, size, data, None)
+
+    def glDeleteBuffers(self, n, buffers):
+        for buffer in buffers:
+            self.__buffer_memory.pop(buffer, None)
+
+    def glMapBuffer(self, target, access):
+        return self.glMapBufferRange(target, 0, None, access)
+
+    def glMapBufferRange(self, target, offset, length, access):
+        buffer = self.__bound_buffers[target]
+        return ctypes.addressof(self.__buffer_memory[buffer]) + offset
+
+    def glUnmapBuffer(self, target):
+        return True
+
+    def glFenceSync(self, condition, flags):
+        return self.__new_names(1)
+
+    def glClientWaitSync(self, sync, flags, timeout):
+        return _REAL_GL_sync.GL_ALREADY_SIGNALED
+
+    def glGetSynciv(self, sync, pname, buf_size, length, values):
+        values.value = _REAL_GL_sync.GL_SIGNALED
+
+    def glGetQueryiv(self, target, pname):
+        return 0
+
+    def glGetError(self):
+        return _REAL_GL.GL_NO_ERROR
+
+    def glGetString(self, name):
+        return 'NullGL'
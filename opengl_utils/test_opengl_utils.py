@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+''' Tests of the GL calls made by TextureStream2D, counted with
+RecordingGL over NullGL, so they need no context or GPU. Any change
+to the number of calls an upload or a bind makes shows up here.
+Run with:
+
+python -m unittest test_opengl_utils
+'''
+
+import gc
+import unittest
+
+import numpy
+from OpenGL import GL
+
+import opengl_utils
+
+class TextureStream2DCallCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gl = opengl_utils.RecordingGL(opengl_utils.NullGL())
+        opengl_utils.set_gl_namespace(self.gl)
+        self.stream = None
+
+    def tearDown(self):
+        # The syncs are deleted when they are garbage collected,
+        # which needs to be done whilst they are still NullGL's.
+        self.stream = None
+        gc.collect()
+
+        opengl_utils.set_gl_namespace(None)
+
+    def new_stream(self, **kwargs):
+        self.stream = opengl_utils.TextureStream2D((64, 32), GL.GL_RGBA,
+                GL.GL_UNSIGNED_BYTE, GL.GL_RGBA8, GL.GL_TEXTURE0,
+                **kwargs)
+
+        return self.stream
+
+    def counts(self):
+        return dict(self.gl.counts)
+
+    def test_update_texture(self):
+        stream = self.new_stream()
+        frame = numpy.zeros((32, 64, 4), dtype='uint8')
+
+        self.gl.reset()
+        stream.update_texture(frame)
+
+        counts = self.counts()
+        self.assertEqual(counts['glTexSubImage2D'], 1)
+        self.assertEqual(counts['glMapBuffer'], 1)
+        self.assertEqual(counts['glUnmapBuffer'], 1)
+        self.assertEqual(counts['glFenceSync'], 1)
+        self.assertEqual(sum(counts.values()), 17)
+
+    def test_bind_texture(self):
+        stream = self.new_stream()
+        stream.update_texture(numpy.zeros((32, 64, 4), dtype='uint8'))
+
+        self.gl.reset()
+        stream.bind_texture()
+
+        # The sync of the upload is checked and deleted once
+        self.assertEqual(self.counts(), {'glActiveTexture': 1,
+            'glBindTexture': 1, 'glGetSynciv': 1, 'glDeleteSync': 1})
+
+        self.gl.reset()
+        stream.bind_texture()
+
+        self.assertEqual(self.counts(), {'glActiveTexture': 1,
+            'glBindTexture': 1})
+
+    def test_unchanged_tiles(self):
+        stream = self.new_stream(tile_size=16)
+        frame = numpy.zeros((32, 64, 4), dtype='uint8')
+        stream.update_texture(frame)
+
+        # Nothing has changed, so nothing is uploaded
+        self.gl.reset()
+        stream.reset_upload_counters()
+        stream.update_texture(frame.copy())
+
+        self.assertEqual(self.counts(), {})
+
+        # One tile has changed
+        frame[20, 40] = 1
+        stream.update_texture(frame)
+
+        self.assertEqual(self.counts()['glTexSubImage2D'], 1)
+        self.assertEqual(stream.get_upload_counters()['bytes_uploaded'],
+                16*16*4)
+
+if __name__ == '__main__':
+    unittest.main()